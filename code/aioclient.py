@@ -0,0 +1,649 @@
+import asyncio
+import marshal
+import os
+import socket
+import time
+from pathlib import Path
+from xmlrpc.client import Binary, Fault
+from config import database_url, replica_workers, replica_timeout, read_timeout, lock_wait_timeout, \
+    lock_lease_time, transfer_chunk_size, delta_sync, delta_block_size, delta_min_match, delta_samples, \
+    dedup_delta_ratio, wire_codec, index_workers, list_page_size, binary_max_frame, async_max_inflight, write_back, \
+    write_back_delay, write_back_dirty_limit, write_back_fsync
+from binrpc import HEADER, StaleConnection, binary_address, pack_frame, to_wire, from_wire
+from metadata import MetadataCache, ReplicaSelector
+from compression import compress, decompress
+from storage import FileStore, calculate_file_hash, calculate_chunk_hashes
+import delta
+
+# 异步客户端：所有请求都走二进制协议（不受rpc_protocol影响），每个服务器一个连接，上面同时有任意多个请求
+# 用法：
+#     async with AsyncClient(root_dir) as client:
+#         content = await client.read('a.txt')
+
+
+SMALL_BLOCK = 1 << 16  # 不超过这个大小的数据在事件循环中直接压缩和读写，线程切换的开销比这些工作本身还大
+
+
+class AsyncConnection(object):  # 到一个服务器二进制协议端口的连接，多个协程的请求在上面流水线执行
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.pending = {}  # 请求id -> Future
+        self.next_id = 0
+        self.closed = False
+        self.task = asyncio.get_running_loop().create_task(self.read_loop())
+
+    @classmethod
+    async def open(cls, address):
+        reader, writer = await asyncio.open_connection(*address)
+        writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return cls(reader, writer)
+
+    async def call(self, method, params, timeout):
+        if self.closed:
+            raise StaleConnection('Connection closed')
+        self.next_id += 1
+        request_id = self.next_id
+        future = self.pending[request_id] = asyncio.get_running_loop().create_future()
+        try:
+            self.writer.write(pack_frame(request_id, marshal.dumps((method, to_wire(params)))))
+            await self.writer.drain()  # 发送缓冲区满时等待，大量请求不会无限堆积在内存中
+            ok, result = await asyncio.wait_for(future, timeout)
+        finally:
+            self.pending.pop(request_id, None)  # 超时或被取消后，迟到的响应直接丢弃
+        if not ok:
+            raise Fault(1, result)
+        return from_wire(result)
+
+    async def read_loop(self):  # 读取响应并交给等待的请求
+        try:
+            while True:
+                size, request_id = HEADER.unpack(await self.reader.readexactly(HEADER.size))
+                if size > binary_max_frame:
+                    break
+                payload = await self.reader.readexactly(size)
+                future = self.pending.get(request_id)
+                if future is not None and not future.done():
+                    future.set_result(marshal.loads(payload))
+        except (asyncio.IncompleteReadError, OSError, ValueError, EOFError):
+            pass
+        finally:
+            self.close()
+
+    def close(self):  # 所有未完成的请求都以ConnectionError结束
+        if self.closed:
+            return
+        self.closed = True
+        self.writer.close()
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError('Connection closed'))
+
+
+def read_block(f, offset, codec):  # 从offset读取一个传输块并按codec压缩，返回(实际使用的算法, 数据, 原始长度)
+    f.seek(offset)
+    data = f.read(transfer_chunk_size)
+    if codec is None:
+        return None, data, len(data)
+    used, packed = compress(data, codec)
+    return used, packed, len(data)
+
+def write_block(f, used, data):  # 解压收到的一块并追加写入，返回原始长度
+    data = decompress(used, data)
+    f.write(data)
+    return len(data)
+
+def next_batch(instructions):  # 从增量指令中取出一批：新数据不超过一个传输块，复用块的指令只占几个字节
+    batch = []
+    literal_bytes = 0
+    for item in instructions:
+        batch.append(item if isinstance(item, int) else Binary(item))
+        literal_bytes += 0 if isinstance(item, int) else len(item)
+        if literal_bytes >= transfer_chunk_size or len(batch) >= 4096:
+            break
+    return batch
+
+
+class AsyncClient(object):  # 异步客户端库：read、write、delete、list、sync等操作可以在一个进程中大量并发
+    def __init__(self, root_dir, max_inflight=async_max_inflight, write_back=write_back):
+        self.root_dir = Path(root_dir)  # 本地缓存目录
+        self.root_dir.mkdir(parents=True, exist_ok=True)  # 与App相同，第一次使用时创建
+        self.connections = {}  # (host, port) -> AsyncConnection
+        self.connect_lock = asyncio.Lock()
+        self.inflight = asyncio.Semaphore(max_inflight)  # 同时在途的请求数上限（背压）
+        # 在数据库上排队等锁的请求单独计数：它们可能阻塞很久，不能占满上面的额度，让持有锁的一方无法完成传输和解锁
+        self.lock_waits = asyncio.Semaphore(max_inflight)
+        self.transfers = asyncio.Semaphore(replica_workers)  # sync时同时进行的副本上传数
+        self.metadata = MetadataCache()
+        self.selector = ReplicaSelector()
+        self.capabilities = {}  # 文件服务器地址 -> 支持的传输方式
+        self.downloads = {}  # 文件名 -> 锁，同一文件的并发读只下载一次
+        self.background = set()  # 达到写quorum之后仍在后台进行的上传
+        self.write_back = write_back  # 写回模式：write写完本地就返回，由后台任务合并后上传
+        self.dirty = {}  # 文件名 -> 写入后的大小，已修改但还没有开始上传的文件
+        self.flushing = {}  # 文件名 -> 正在上传它的任务
+        self.dirty_bytes = 0  # dirty和flushing中文件的总大小
+        self.dirty_changed = asyncio.Condition()
+        self.flush_now = asyncio.Event()  # 脏数据超过上限时让后台任务不再等待合并窗口
+        self.flusher = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def close(self):  # 上传所有修改过的文件并等待后台上传完成，然后关闭所有连接
+        if self.dirty or self.flushing:
+            await self.flush()
+        if self.flusher is not None:
+            self.flusher.cancel()
+        if self.background:
+            await asyncio.gather(*self.background, return_exceptions=True)
+        for connection in self.connections.values():
+            connection.close()
+        self.connections = {}
+
+    async def connection(self, address):
+        connection = self.connections.get(address)
+        if connection is None or connection.closed:
+            async with self.connect_lock:
+                connection = self.connections.get(address)
+                if connection is None or connection.closed:
+                    connection = self.connections[address] = await AsyncConnection.open(address)
+        return connection
+
+    async def call(self, url, method, *params, timeout=None, lock_wait=False):  # 在url对应的服务器上调用method
+        address = binary_address(url)
+        async with self.lock_waits if lock_wait else self.inflight:
+            for attempt in (0, 1):  # 请求发出前连接已断开时，重连并重试一次
+                connection = await self.connection(address)
+                try:
+                    return await connection.call(method, params, timeout)
+                except StaleConnection:
+                    if attempt:
+                        raise
+
+    async def db(self, method, *params):
+        return await self.call(database_url, method, *params, lock_wait=method == 'acquire_lock')
+
+    async def multicall(self, *calls):  # 在数据库上用一次请求执行多个调用，calls为(方法名, 参数...)
+        results = await self.call(database_url, 'system.multicall',
+                                  [{'methodName': call[0], 'params': list(call[1:])} for call in calls],
+                                  lock_wait=any(call[0] == 'acquire_lock' for call in calls))
+        for item in results:
+            if isinstance(item, dict):
+                raise Fault(item['faultCode'], item['faultString'])
+        return [item[0] for item in results]
+
+    async def refresh(self):  # 拉取自上次刷新以来的元数据变更
+        await self.apply_changes(await self.db('get_changes', self.metadata.epoch, self.metadata.version))
+
+    async def apply_changes(self, res):  # 应用get_changes的结果，完整快照时分页拉取其余的文件信息
+        self.metadata.apply(res)
+        cursor = res.get('cursor')
+        while cursor is not None:
+            page = await self.db('list_files', cursor, list_page_size)
+            self.metadata.add_files(page['files'])
+            cursor = page['cursor']
+
+    async def placement(self, name):
+        if self.metadata.ring_params is None:
+            self.metadata.ring_params = await self.db('get_ring')
+        return self.metadata.placement(name)
+
+    async def get_capabilities(self, address):
+        if address not in self.capabilities:
+            self.capabilities[address] = await self.call(address, 'get_capabilities', timeout=replica_timeout)
+        return self.capabilities[address]
+
+    async def choose_codec(self, address):
+        return wire_codec if wire_codec in (await self.get_capabilities(address)).get('codecs', []) else None
+
+    async def hash_file(self, path):  # 大文件在线程池中计算哈希，不阻塞事件循环
+        if path.stat().st_size <= transfer_chunk_size:
+            return calculate_file_hash(path, transfer_chunk_size)
+        return await asyncio.get_running_loop().run_in_executor(None, calculate_file_hash, path, transfer_chunk_size)
+
+    async def blocking(self, size, func, *args):  # 压缩、解压和文件读写在线程池中执行，数据很小时直接执行，省去线程切换
+        if size <= SMALL_BLOCK:
+            return func(*args)
+        return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+    def partial(self, kind, name):  # 下载或写入中的文件放在缓存目录之外、同一文件系统上，完成后原子地替换进缓存目录
+        part_dir = self.root_dir.with_name(self.root_dir.name + '.partial') / kind
+        if not part_dir.exists():
+            part_dir.mkdir(parents=True)
+        return part_dir / name
+
+    def lease_keeper(self, lease):  # 长时间传输时定期续约
+        renewed = [time.time()]
+
+        async def keepalive():
+            if time.time() - renewed[0] > lock_lease_time / 3:
+                await self.db('renew_lock', lease)
+                renewed[0] = time.time()
+        return keepalive
+
+    # 读
+
+    async def read(self, name):  # 读文件：本地不是最新版本时先从副本下载，返回文件内容
+        path = self.root_dir / name
+        if name in self.dirty or name in self.flushing:  # 写回模式下本地的修改还没有上传，本地就是最新版本
+            return path.read_text()
+        if not self.metadata.replicas(name):  # 缓存中还没有这个文件，可能是其他客户端刚写入的
+            await self.refresh()
+        failed = set()  # 下载失败或太慢的副本
+        while True:
+            # 在持有最新版本的副本中按负载和延迟选择，出错或太慢时换下一个副本
+            replicas = [replica for replica in self.selector.order(self.metadata.replicas(name))
+                        if replica[0] not in failed]
+            if not replicas:
+                if failed:
+                    raise OSError('Unable to read {} from any replica.'.format(name))
+                return path.read_text()  # 集群中没有这个文件，只有本地的副本
+            serverid, address = replicas[0]
+            # 在同一个请求中排队等待共享锁，获得锁之后校验元数据缓存，并顺带交换副本的负载统计
+            lease, changes, _, stats = await self.multicall(
+                ('acquire_lock', serverid, name, 'S', lock_wait_timeout),
+                ('get_changes', self.metadata.epoch, self.metadata.version),
+                ('report_latency', self.selector.take_samples()),
+                ('get_server_stats', ))
+            self.selector.update_stats(stats)
+            if not lease:
+                raise TimeoutError('Timed out waiting for {} to be written.'.format(name))
+            try:
+                await self.apply_changes(changes)
+                cloud_filehash = self.metadata.file_hash(serverid, name)
+                if cloud_filehash != self.metadata.latest_hash(name):  # 等锁期间该副本变成了旧版本，按刷新后的缓存重新选择
+                    continue
+                if not await self.ensure_local(serverid, address, name, cloud_filehash):
+                    failed.add(serverid)
+                    continue
+                return path.read_text()
+            finally:
+                await self.db('release_lock', lease)  # 归还共享锁，操作被取消时也会执行
+
+    async def ensure_local(self, serverid, address, name, filehash):  # 本地副本与filehash不一致时下载
+        lock = self.downloads.get(name)
+        if lock is None:
+            lock = self.downloads[name] = asyncio.Lock()
+        async with lock:  # 同一文件的其他读请求等待这次下载，而不是各自下载一遍
+            path = self.root_dir / name
+            if path.exists() and await self.hash_file(path) == filehash:
+                return True
+            return await self.download(address, name, serverid)
+
+    async def download(self, address, name, serverid=None):  # 分块下载文件到本地缓存目录，返回是否成功
+        start = time.time()
+        try:
+            ok = await self.download_file(address, name)
+        except (OSError, Fault):
+            ok = False
+        if serverid is not None:
+            # 延迟按传输块数归一化，大文件和小文件的样本可以放在一起比较
+            size = (self.root_dir / name).stat().st_size if ok else 0
+            self.selector.record(serverid, (time.time() - start) / (1 + size // transfer_chunk_size))
+        return ok
+
+    async def download_file(self, address, name):
+        info = await self.call(address, 'stat_file', name, timeout=read_timeout)
+        if info is None:
+            raise FileNotFoundError(name)
+        size, filehash = info
+        codec = await self.choose_codec(address)
+        part = self.partial('download', name)
+        for _ in range(2):  # 续传的部分与服务器上的文件不一致时，从头重新下载一次
+            offset = part.stat().st_size if part.exists() else 0
+            if offset > size:
+                offset = 0
+            with part.open(mode='r+b' if part.exists() else 'wb') as f:
+                f.seek(offset)
+                f.truncate()
+                while offset < size:
+                    if codec is not None:
+                        used, data = await self.call(address, 'read_chunk', name, offset, transfer_chunk_size, codec,
+                                                     timeout=read_timeout)
+                    else:
+                        used, data = '', await self.call(address, 'read_chunk', name, offset, transfer_chunk_size,
+                                                         timeout=read_timeout)
+                    written = await self.blocking(len(data.data), write_block, f, used, data.data)
+                    if not written:
+                        break
+                    offset += written
+            if await self.hash_file(part) == filehash:
+                os.replace(part, self.root_dir / name)
+                return True
+            part.unlink()
+        return False
+
+    async def fetch(self, serverid, name):  # 从指定的服务器下载文件，返回是否成功
+        await self.refresh()
+        address = self.metadata.servers.get(serverid)
+        if address is None or self.metadata.file_hash(serverid, name) is None:
+            raise FileNotFoundError(name)
+        return await self.download(address, name)
+
+    # 写和删除
+
+    async def write(self, name, content):  # 写本地文件并更新到副本，返回[(是否成功, 信息), ...]和是否达到写quorum
+        path = self.root_dir / name
+        # 写到临时文件再替换，不截断原文件：后台正在上传（或增量上传时mmap）旧版本的任务继续读旧的inode
+        part = self.partial('write', name)
+        with part.open(mode='w') as f:
+            f.write(content)
+            if self.write_back and write_back_fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(part, path)
+        if self.write_back and write_back_fsync:  # 替换本身也要落盘，崩溃后不会回到旧版本
+            fd = os.open(self.root_dir, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        if not self.write_back:
+            return await self.upload(name)
+        await self.mark_dirty(name, path.stat().st_size)  # 写回模式下只记录，由后台任务上传
+        return [], True
+
+    async def upload(self, name):  # 把本地文件上传到一致性哈希环决定的副本，W个副本确认后返回，其余在后台继续
+        path = self.root_dir / name
+        await self.refresh()
+        targets = await self.placement(name)
+        quorum = min(self.metadata.ring_params['write_quorum'], len(targets))  # 与targets一起读取
+        lastmodified = os.path.getmtime(path)
+        loop = asyncio.get_running_loop()
+        filehash, chunk_hashes = await loop.run_in_executor(None, calculate_chunk_hashes, path, transfer_chunk_size)
+        tasks = [asyncio.ensure_future(self.upload_replica(serverid, address, path, name, lastmodified,
+                                                           filehash, chunk_hashes))
+                 for serverid, address in targets]
+        return await self.wait_quorum(tasks, quorum)
+
+    # 写回
+
+    async def mark_dirty(self, name, size):  # 记录修改过的文件，同一文件的多次修改只保留最新版本
+        async with self.dirty_changed:
+            self.dirty_bytes += size - self.dirty.get(name, 0)
+            self.dirty[name] = size
+            if self.flusher is None or self.flusher.done():
+                self.flusher = asyncio.ensure_future(self.flush_loop())
+            self.dirty_changed.notify_all()
+            if self.dirty_bytes > write_back_dirty_limit:  # 脏数据太多，立即上传，写入者等待上传腾出空间
+                self.flush_now.set()
+                await self.dirty_changed.wait_for(lambda: self.dirty_bytes <= write_back_dirty_limit)
+
+    async def flush_loop(self):  # 后台任务：文件被修改后等待write_back_delay，期间对它的多次修改只上传一次
+        while True:
+            async with self.dirty_changed:
+                await self.dirty_changed.wait_for(lambda: self.dirty)
+            try:
+                await asyncio.wait_for(self.flush_now.wait(), write_back_delay)
+            except asyncio.TimeoutError:
+                pass
+            self.flush_now.clear()
+            results = await self.flush_dirty()
+            if not all(reached for _, reached in results.values()):  # 失败的文件已重新排队，稍后重试
+                await asyncio.sleep(write_back_delay)
+
+    async def flush_dirty(self):  # 上传当前修改过的文件，返回{文件名: (每个副本的结果, 是否达到写quorum)}
+        # 正在上传的文件留到下一轮，同一文件不会有两个上传同时进行
+        batch = {name: size for name, size in self.dirty.items() if name not in self.flushing}
+        tasks = []
+        for name in batch:
+            del self.dirty[name]
+            tasks.append(asyncio.ensure_future(self.flush_file(name, batch[name])))
+            self.flushing[name] = tasks[-1]
+        return dict(zip(batch, await asyncio.gather(*tasks)))
+
+    async def flush_file(self, name, size):  # 上传一个修改过的文件，没有达到写quorum时重新排队
+        try:
+            async with self.transfers:
+                if (self.root_dir / name).exists():  # 已经被删除的文件不需要上传
+                    result = await self.upload(name)
+                else:
+                    result = [], True
+        except Exception as e:
+            result = [(False, 'Server: {}'.format(e))], False
+        async with self.dirty_changed:
+            del self.flushing[name]
+            if not result[1] and name not in self.dirty:
+                self.dirty[name] = size
+            else:
+                self.dirty_bytes -= size
+            self.dirty_changed.notify_all()
+        return result
+
+    async def flush(self):  # 立即上传所有修改过的文件并等待完成，返回值与flush_dirty相同
+        results = {}
+        while True:
+            uploading = dict(self.flushing)
+            results.update(await self.flush_dirty())
+            for name, task in uploading.items():
+                results[name] = await task
+            # 等待期间又被修改的文件再上传一轮，有文件失败时不再重试
+            if not self.dirty or not all(reached for _, reached in results.values()):
+                return results
+
+    async def wait_quorum(self, tasks, quorum):  # 等到quorum个任务成功（quorum为None时等所有任务），其余留在后台
+        pending = set(tasks)
+        succeeded = 0
+        while pending and (quorum is None or succeeded < quorum):
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            succeeded += sum(1 for task in done if not task.exception() and task.result()[0])
+        for task in pending:
+            self.background.add(task)
+            task.add_done_callback(self.background.discard)
+        results = []
+        for task in tasks:
+            if task in pending:
+                results.append((None, 'Still replicating in the background.'))
+            elif task.exception() is not None:
+                results.append((False, str(task.exception())))
+            else:
+                results.append(task.result())
+        return results, quorum is None or succeeded >= quorum
+
+    async def upload_replica(self, serverid, address, path, name, lastmodified, filehash, chunk_hashes):  # 向一个副本上传文件
+        lease = await self.db('acquire_lock', serverid, name, 'X', lock_wait_timeout)  # 排队获取排他锁
+        if not lease:
+            return False, 'Server_id:{} Timed out waiting for the lock.'.format(serverid)
+        try:
+            keepalive = self.lease_keeper(lease)
+            capabilities = await self.get_capabilities(address)
+            codec = await self.choose_codec(address)
+            back = None
+            if capabilities['dedup']:
+                back = await self.dedup_upload(address, path, name, filehash, chunk_hashes, keepalive, codec,
+                                               lastmodified)
+            elif delta_sync:
+                back = await self.delta_upload(address, path, name, filehash, keepalive, lastmodified)
+            if back is None:
+                back = await self.upload_file(address, path, name, filehash, keepalive, codec, lastmodified)
+        except BaseException:
+            await self.db('release_lock', lease)
+            raise
+        # 登记文件信息和归还排他锁合并为一次请求
+        calls = [('add_file', [[name, serverid, lastmodified, filehash]])] if back == 'success' else []
+        results = await self.multicall(*calls, ('release_lock', lease))
+        if back == 'success' and results[0] == []:
+            return True, 'Server_id:{} Successfully upload.'.format(serverid)
+        if back == 'success' and results[0]:  # 数据库中的删除记录晚于本地文件的修改时间（例如本机时钟落后），这个版本不会被登记
+            return False, 'Server_id:{} Rejected: {} was deleted after this version was written.'.format(serverid, name)
+        return False, 'Server_id:{} Fail to upload.'.format(serverid)
+
+    async def upload_file(self, address, path, name, filehash, keepalive, codec, lastmodified):  # 分块上传文件，支持断点续传
+        size = os.path.getsize(path)
+        for _ in range(2):  # 续传的部分与本地文件不一致时，从头重传一次
+            offset = await self.call(address, 'open_upload', name, timeout=replica_timeout)
+            if offset < 0:
+                return 'Invalid file name'
+            if offset > size:
+                await self.call(address, 'abort_upload', name, timeout=replica_timeout)
+                offset = 0
+            with open(path, 'rb') as f:
+                while offset < size:
+                    used, data, length = await self.blocking(min(size - offset, transfer_chunk_size), read_block,
+                                                             f, offset, codec)
+                    params = (Binary(data), ) if codec is None else (Binary(data), used)
+                    # 服务器缺数据时返回它已收到的位置，下一块从那里开始
+                    offset = await self.call(address, 'write_chunk', name, offset, *params, timeout=replica_timeout)
+                    await keepalive()
+            back = await self.call(address, 'commit_upload', name, filehash, lastmodified, timeout=replica_timeout)
+            if back != 'Hash mismatch':
+                return back
+        return back
+
+    async def delta_upload(self, address, path, name, filehash, keepalive, lastmodified):
+        # rsync式增量上传；服务器上没有旧文件、或者预计复用不了多少旧文件时返回None，由调用者改用其他方式上传
+        size = os.path.getsize(path)
+        if size < delta_block_size * 2:
+            return None
+        res = await self.call(address, 'get_block_checksums', name, delta_block_size, timeout=replica_timeout)
+        if res is None:
+            return None
+        base_size, blob = res
+        if base_size < size * delta_min_match:  # 旧文件比新文件小得多，大部分内容都要发送
+            return None
+        checksums = delta.unpack_checksums(blob.data)
+        loop = asyncio.get_running_loop()
+        # 先抽样估计能复用的比例，内容基本都变了时不做逐字节的滚动计算
+        matched = await loop.run_in_executor(None, delta.sample_matches, path, checksums, delta_block_size, delta_samples)
+        if matched < delta_min_match:
+            return None
+        await self.call(address, 'abort_upload', name, timeout=replica_timeout)  # 增量上传总是从头重建文件
+        instructions = delta.compute_delta(path, checksums, base_size, delta_block_size, transfer_chunk_size)
+        offset = 0
+        literal = 0
+        while True:
+            batch = await loop.run_in_executor(None, next_batch, instructions)  # 滚动校验和在线程池中计算
+            if not batch:
+                break
+            literal += sum(len(item.data) for item in batch if not isinstance(item, int))
+            if literal > size * (1 - delta_min_match):  # 实际复用的比抽样估计的少得多，停止计算
+                return None  # 服务器上已重建的部分就是新文件的开头，完整上传从那里续传
+            offset = await self.call(address, 'write_delta', name, offset, delta_block_size, batch,
+                                     timeout=replica_timeout)
+            if offset < 0:
+                return None
+            await keepalive()
+        return await self.call(address, 'commit_upload', name, filehash, lastmodified, timeout=replica_timeout)
+
+    async def dedup_upload(self, address, path, name, filehash, chunk_hashes, keepalive, codec, lastmodified):  # 只发送服务器上还没有的块
+        for attempt in range(2):  # 块在提交前被服务器回收时重试一次
+            missing = set(await self.call(address, 'missing_chunks', chunk_hashes, timeout=replica_timeout))
+            # 大部分块都缺少时可能只是块错位了（例如在文件开头插入了数据），先尝试增量上传；
+            # 抽样发现旧文件复用不了多少（例如全新的内容）时delta_upload返回None，照常发送缺少的块
+            if not attempt and delta_sync and len(missing) > len(chunk_hashes) * dedup_delta_ratio:
+                back = await self.delta_upload(address, path, name, filehash, keepalive, lastmodified)
+                if back is not None:
+                    return back
+            with open(path, 'rb') as f:
+                for index, chunk in enumerate(chunk_hashes):
+                    if chunk in missing:
+                        used, data, _ = await self.blocking(transfer_chunk_size, read_block,
+                                                            f, index * transfer_chunk_size, codec)
+                        params = (Binary(data), ) if codec is None else (Binary(data), used)
+                        await self.call(address, 'put_chunk', *params, timeout=replica_timeout)
+                        missing.discard(chunk)
+                        await keepalive()
+            back = await self.call(address, 'commit_chunks', name, chunk_hashes, filehash, lastmodified,
+                                   timeout=replica_timeout)
+            if back != 'Missing chunks':
+                return back
+        return back
+
+    async def delete(self, name):  # 删除本地文件和所有持有该文件的副本，返回[(是否成功, 信息), ...]
+        path = self.root_dir / name
+        async with self.dirty_changed:
+            if name in self.dirty:  # 还没有上传的修改不再上传
+                self.dirty_bytes -= self.dirty.pop(name)
+                self.dirty_changed.notify_all()
+        if name in self.flushing:  # 等正在进行的上传结束，避免它在删除之后把文件传回副本
+            await self.flushing[name]
+        if path.exists():
+            path.unlink()
+        # 先在数据库中记录删除时间：错过这次删除的服务器重新加入时，它手里的旧版本不会再被登记和迁移
+        deleted = time.time()
+        _, changes = await self.multicall(('add_tombstone', name, deleted),
+                                          ('get_changes', self.metadata.epoch, self.metadata.version))
+        await self.apply_changes(changes)
+        targets = sorted(set(await self.placement(name)) | set(self.metadata.holders(name)))
+        tasks = [asyncio.ensure_future(self.delete_replica(serverid, address, name, deleted))
+                 for serverid, address in targets]
+        results, _ = await self.wait_quorum(tasks, None)
+        return results
+
+    async def delete_replica(self, serverid, address, name, deleted):  # 副本记录删除时间，由反熵传播给错过这次删除的副本
+        lease = await self.db('acquire_lock', serverid, name, 'X', lock_wait_timeout)
+        if not lease:
+            return False, 'Server_id:{}:Timed out waiting for the lock.'.format(serverid)
+        try:
+            back = await self.call(address, 'remove_file', name, deleted, timeout=replica_timeout)
+        except BaseException:
+            await self.db('release_lock', lease)
+            raise
+        calls = [('delete_file', serverid, name)] if back == 'success' else []
+        await self.multicall(*calls, ('release_lock', lease))
+        if back == 'success':
+            return True, 'Server_id:{}:Successfully delete.'.format(serverid)
+        return False, 'Server_id:{}:{}'.format(serverid, back)
+
+    # 列表和同步
+
+    async def list(self, prefix=None, latest=False):  # 逐页列出服务器上的文件，边拉取边返回
+        # latest为False时返回[filename, serverid, lastmodified, filehash]，为True时每个文件只返回最新版本
+        # [filename, lastmodified, filehash, 副本数]
+        after = None
+        while True:
+            if latest:
+                page = await self.db('list_latest', after, list_page_size, prefix)
+            else:
+                page = await self.db('list_files', after, list_page_size, None, prefix)
+            for row in page['files']:
+                yield row
+            after = page['cursor']
+            if after is None:
+                return
+
+    async def sync(self):  # 增量同步本地缓存：只上传集群中还没有本地内容的文件，返回(未变化的文件数, 上传结果)
+        if self.dirty or self.flushing:  # 写回模式下先上传修改过的文件
+            await self.flush()
+        await self.refresh()
+        # 索引中同时记录每个传输块的哈希值，变化过的文件只读取一遍
+        local = FileStore(self.root_dir, self.root_dir.with_name(self.root_dir.name + '.index.json'),
+                          chunk_size=transfer_chunk_size)
+        loop = asyncio.get_running_loop()
+        names = await loop.run_in_executor(None, local.index_names)
+        hashing = asyncio.Semaphore(index_workers)
+        tasks = []  # 一个文件建好索引就开始上传，与其余文件的哈希计算同时进行
+
+        async def index_file(name):  # 返回文件是否不需要上传
+            try:
+                async with hashing:
+                    _, lastmodified, filehash, chunk_hashes = await loop.run_in_executor(None, local.stat_chunks, name)
+            except FileNotFoundError:  # 同步期间被删除了
+                return False
+            stale = [(serverid, address) for serverid, address in await self.placement(name)
+                     if self.metadata.file_hash(serverid, name) != filehash]
+            for serverid, address in stale:
+                tasks.append(asyncio.ensure_future(self.bounded_upload(serverid, address, self.root_dir / name, name,
+                                                                       lastmodified, filehash, chunk_hashes)))
+            return not stale
+
+        unchanged = sum(await asyncio.gather(*[index_file(name) for name in names]))
+        await loop.run_in_executor(None, local.save_index)
+        results, _ = await self.wait_quorum(tasks, None)
+        return unchanged, results
+
+    async def bounded_upload(self, *args):  # 同时进行的副本上传不超过replica_workers个
+        async with self.transfers:
+            return await self.upload_replica(*args)
+
+    async def stats(self):  # 返回[(名称, 地址, get_stats的结果或异常), ...]
+        await self.refresh()
+        endpoints = [('Database', database_url)] + [('Server_id:{}'.format(serverid), address)
+                                                    for serverid, address in self.metadata.server_info()]
+        results = await asyncio.gather(*[self.call(address, 'get_stats', timeout=read_timeout)
+                                         for _, address in endpoints], return_exceptions=True)
+        return [(title, address, stats) for (title, address), stats in zip(endpoints, results)]
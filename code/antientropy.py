@@ -0,0 +1,215 @@
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from xmlrpc.client import Fault
+from config import database_url, replica_timeout, antientropy_interval, merkle_depth, antientropy_lock_timeout, \
+    tombstone_ttl
+from hashring import HashRing
+from merkle import MerkleTree, FANOUT
+from transport import connect
+
+# 反熵修复：文件服务器为每个副本维护一棵Merkle树，覆盖双方按哈希环都应持有的文件的(文件名, sha256)
+# 定期与每个副本从根开始逐层比较，只沿哈希不同的节点向下，请求数与层数成正比，传输量与不一致的文件数成正比
+# 每个服务器只从对方拉取比自己新的文件，双方各自修复自己，最终一致
+# 客户端删除的文件在树上留下删除标记(文件名, '', 删除时间)，删除标记与文件版本一样按时间比较，
+# 错过删除的服务器重新加入后删除自己的旧版本，而不是让其他服务器把它拉回去
+
+
+def version(entry):  # 比较两个版本的键：时间较晚的胜出，时间相同时删除标记胜出，再相同时按哈希值决定，双方的判断一致
+    filehash, when = entry
+    return when, filehash == '', filehash
+
+
+class AntiEntropy(object):
+    def __init__(self, store, serverid, address, tombstone_path):
+        self.store = store
+        self.serverid = serverid
+        self.address = address
+        self.mutex = threading.Lock()
+        self.tombstone_path = Path(tombstone_path)
+        self.tombstones = {}  # 文件名 -> 删除时间，持久化保存，服务器重启后仍然有效
+        if self.tombstone_path.exists():
+            try:
+                self.tombstones = json.loads(self.tombstone_path.read_text())
+            except ValueError:
+                pass
+        self.servers = {}  # serverid -> address，建树时的集群成员
+        self.ring = None
+        self.replicas = 1
+        self.trees = {}  # 对端serverid -> MerkleTree
+        self.wake = threading.Event()
+        self.wake.set()  # 启动后立即进行一轮，重新加入的服务器尽快补上错过的写入
+
+    def peers(self, name):  # 与本服务器一起持有该文件的其他服务器，文件不应放在本服务器上时为空
+        placement = self.ring.lookup(name, self.replicas)
+        return [serverid for serverid in placement if serverid != self.serverid] if self.serverid in placement else []
+
+    def entry(self, name):  # 本服务器上该文件的[filehash, 修改时间]，被删除时为['', 删除时间]，都没有时为None，调用者需持有mutex
+        try:
+            _, lastmodified, filehash = self.store.stat(name)
+        except OSError:  # 文件不存在或刚被删除
+            return ['', self.tombstones[name]] if name in self.tombstones else None
+        if name in self.tombstones:  # 删除之后又写入了新版本
+            del self.tombstones[name]
+            self.save_tombstones()
+        return [filehash, lastmodified]
+
+    def put(self, name):  # 调用者需持有mutex
+        entry = self.entry(name)
+        for peer in self.peers(name):
+            if entry is None:
+                self.trees[peer].remove(name)
+            else:
+                self.trees[peer].put(name, *entry)
+
+    def rebuild(self, servers, ring_params):  # 集群成员变化后按新的哈希环重建所有树，文件信息来自存储的索引，不读取文件内容
+        with self.mutex:
+            self.servers = servers
+            self.ring = HashRing(servers, ring_params['vnodes'])
+            self.replicas = ring_params['replication_factor']
+            self.trees = {serverid: MerkleTree(merkle_depth) for serverid in servers if serverid != self.serverid}
+            for name in set(self.store.names()) | set(self.tombstones):
+                self.put(name)
+
+    def changed(self, name):  # 文件被写入或删除后更新树
+        with self.mutex:
+            if self.ring is not None:  # 还没有建树时不需要更新，建树时会读到这个文件
+                self.put(name)
+
+    def deleted(self, name, when):  # 客户端删除了本服务器上的文件，记录删除标记，调用者随后调用changed
+        with self.mutex:
+            self.tombstones[name] = max(when, self.tombstones.get(name, when))
+            self.save_tombstones()
+
+    def expire(self):  # 清除超过tombstone_ttl的删除标记，各服务器上的删除时间相同，会在同一时间清除
+        deadline = time.time() - tombstone_ttl
+        with self.mutex:
+            expired = [name for name, when in self.tombstones.items() if when < deadline]
+            if not expired:
+                return
+            for name in expired:
+                del self.tombstones[name]
+            self.save_tombstones()
+        for name in expired:
+            self.changed(name)
+
+    def save_tombstones(self):  # 调用者需持有mutex
+        if not self.tombstone_path.parent.exists():
+            self.tombstone_path.parent.mkdir(parents=True)
+        tmp = self.tombstone_path.with_name(self.tombstone_path.name + '.tmp')
+        tmp.write_text(json.dumps(self.tombstones))
+        os.replace(tmp, self.tombstone_path)
+
+    def nodes(self, peer, level, indices):  # 本服务器为peer维护的树上第level层的节点哈希，没有这棵树时返回None
+        with self.mutex:
+            tree = self.trees.get(peer)
+            if tree is None:  # 对方是本服务器还不知道的新成员，尽快刷新集群成员
+                self.wake.set()
+                return None
+            return tree.nodes(level, indices) if 0 <= level <= merkle_depth else None
+
+    def entries(self, peer, indices):  # 本服务器为peer维护的树上给定叶子中的文件[[filename, filehash, lastmodified], ...]
+        # 删除标记的filehash为''，lastmodified为删除时间
+        with self.mutex:
+            tree = self.trees.get(peer)
+            return None if tree is None else tree.entries(indices)
+
+    def run(self):  # 后台线程
+        while True:
+            self.wake.wait(antientropy_interval)
+            self.wake.clear()
+            try:
+                self.round()
+            except (OSError, Fault) as e:
+                print('Anti-entropy round failed: {}'.format(e))
+
+    def round(self):  # 一轮修复：刷新集群成员，依次与每个副本比较
+        self.expire()
+        with connect(database_url) as proxy:
+            servers = {serverid: address for serverid, address in proxy.get_server_info()}
+            if servers != self.servers or self.ring is None:
+                self.rebuild(servers, proxy.get_ring())
+        for peer, address in sorted(self.servers.items()):
+            if peer == self.serverid:
+                continue
+            try:
+                pulled = self.sync_with(peer, address)
+            except (OSError, Fault):  # 对方暂时不可用，下一轮再比较
+                continue
+            if pulled:
+                print('Anti-entropy: repaired {} files from server {}.'.format(pulled, peer))
+
+    def sync_with(self, peer, address):  # 与一个副本比较，拉取对方较新的文件、执行对方较新的删除，返回修复的文件数
+        indices = [0]
+        with connect(address, replica_timeout) as proxy:
+            for level in range(merkle_depth + 1):
+                theirs = proxy.merkle_nodes(self.serverid, level, indices)
+                ours = self.nodes(peer, level, indices)
+                if theirs is None or ours is None:  # 对方还没有为本服务器建树（例如刚加入），下一轮再比较
+                    return 0
+                differing = [index for index, a, b in zip(indices, ours, theirs) if a != b]
+                if not differing:
+                    return 0
+                indices = [child for index in differing for child in range(index * FANOUT, (index + 1) * FANOUT)]
+            entries = proxy.merkle_entries(self.serverid, differing)
+        mine = {name: (filehash, lastmodified) for name, filehash, lastmodified in self.entries(peer, differing) or []}
+        repaired = 0
+        for name, filehash, lastmodified in entries or []:
+            own = mine.get(name)
+            # 内容相同（或都已删除），或者本服务器的版本更新时不需要修复
+            if own is not None and (own[0] == filehash or version(own) > version((filehash, lastmodified))):
+                continue
+            if filehash == '':  # 对方删除了这个文件，本服务器的版本更旧或者没有这个文件
+                repaired += self.delete(name, lastmodified, own is not None)
+            else:
+                repaired += self.pull(name, address, filehash, lastmodified)
+        return repaired
+
+    def current(self, name):  # 本服务器上该文件当前的版本
+        with self.mutex:
+            return self.entry(name)
+
+    def pull(self, name, address, filehash, lastmodified):  # 持有本服务器上该文件的排他锁，让对方把文件推送过来，返回是否拉取
+        with connect(database_url) as proxy:
+            lease = proxy.acquire_lock(self.serverid, name, 'X', antientropy_lock_timeout)
+            if not lease:  # 文件正在被写，留到下一轮
+                return False
+            try:
+                own = self.current(name)  # 等锁期间本服务器可能已经收到了新的版本或删除
+                if own is not None and (own[0] == filehash or version(own) > version((filehash, lastmodified))):
+                    return False
+                with connect(address) as peer:
+                    if peer.replicate_to(name, self.address) != 'success':
+                        return False
+                _, current, currenthash = self.store.stat(name)
+                return proxy.add_file([[name, self.serverid, current, currenthash]]) == []
+            finally:
+                proxy.release_lock(lease)
+
+    def delete(self, name, when, exists):  # 执行对方记录的删除，本服务器上没有这个文件时只记录删除标记，返回是否删除了文件
+        if not exists:
+            self.deleted(name, when)
+            self.changed(name)
+            return False
+        with connect(database_url) as proxy:
+            lease = proxy.acquire_lock(self.serverid, name, 'X', antientropy_lock_timeout)
+            if not lease:
+                return False
+            try:
+                own = self.current(name)
+                if own is None or version(own) > version(('', when)):
+                    return False
+                if own[0] == '':
+                    self.deleted(name, when)
+                    self.changed(name)
+                    return False
+                # 通过本服务器的RPC删除，读缓存和树随之更新
+                with connect(self.address) as server:
+                    if server.remove_file(name, when) != 'success':
+                        return False
+                proxy.delete_file(self.serverid, name)
+                return True
+            finally:
+                proxy.release_lock(lease)
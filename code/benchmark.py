@@ -0,0 +1,226 @@
+import argparse
+import asyncio
+import json
+import math
+import multiprocessing
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from xmlrpc.client import ServerProxy
+from config import database_url
+from aioclient import AsyncClient
+
+WORDS = ['alpha', 'beta', 'gamma', 'delta', 'cloud', 'server', 'replica', 'lock', 'file', 'text']
+OPS = ['readtxt', 'mktxt', 'deltxt', 'upload_all', 'server_ls']
+
+
+def parse_mix(text):  # 'readtxt=60,mktxt=30' -> {'readtxt': 60, 'mktxt': 30}
+    mix = {}
+    for item in text.split(','):
+        op, weight = item.split('=')
+        if op not in OPS:
+            raise argparse.ArgumentTypeError('Unknown operation {}'.format(op))
+        mix[op] = float(weight)
+    return mix
+
+def make_content(size, rng):  # 生成大约size字节的文本
+    words = []
+    length = 0
+    while length < size:
+        words.append(rng.choice(WORDS))
+        length += len(words[-1]) + 1
+    return ' '.join(words)[:size]
+
+def percentile(values, p):  # 最近秩法计算百分位数
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, min(len(values) - 1, math.ceil(p / 100 * len(values)) - 1))]
+
+def wait_until(check, timeout, what):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if check():
+                return
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError('Timed out waiting for {}'.format(what))
+
+def start_cluster(work_dir, servers, base_port, server_args):  # 在工作目录中启动数据库和文件服务器，返回进程列表
+    log = open(work_dir / 'cluster.log', 'w')
+    processes = [subprocess.Popen([sys.executable, 'database.py'], cwd=work_dir, stdout=log, stderr=subprocess.STDOUT)]
+    with ServerProxy(database_url, allow_none=True) as proxy:
+        wait_until(lambda: proxy.get_all_server_addresses() is not None, 30, 'the database')
+        for i in range(servers):
+            processes.append(subprocess.Popen([sys.executable, 'server.py', str(i + 1), str(base_port + i)] + server_args,
+                                              cwd=work_dir, stdout=log, stderr=subprocess.STDOUT))
+        wait_until(lambda: len(proxy.get_all_server_addresses()) == servers, 60, 'the file servers')
+    return processes
+
+def stop_cluster(processes):  # 先让文件服务器正常退出（会清理数据库中的信息），再关闭数据库
+    for process in processes[1:]:
+        process.send_signal(2)
+    for process in processes[1:]:
+        try:
+            process.wait(10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+    processes[0].terminate()
+    processes[0].wait()
+
+def failures(results):  # 副本结果[(是否成功, 信息), ...]中失败的信息，都成功（或仍在后台进行）时返回None
+    messages = [message for ok, message in results if ok is False]
+    return '; '.join(messages) if messages else None
+
+def count_rpcs():  # 统计本进程发出的每一个RPC（multicall算一次）
+    counter = [0]
+    call = AsyncClient.call
+
+    async def counted(self, *args, **kwargs):
+        counter[0] += 1
+        return await call(self, *args, **kwargs)
+    AsyncClient.call = counted
+    return counter
+
+def run_user(work_dir, user, args, barrier, results):  # 一个模拟用户：独立的进程、事件循环和客户端状态
+    records = []
+    try:
+        asyncio.run(run_ops(work_dir, user, args, barrier, records))
+    except BaseException:
+        barrier.abort()  # 不让其他进程一直等待
+        raise
+    finally:
+        results.put(records)
+
+async def run_ops(work_dir, user, args, barrier, records):
+    counter = count_rpcs()
+    rng = random.Random(args.seed * 1000 + user)
+    root_dir = work_dir / 'local_cache' / 'user{}'.format(user)
+    root_dir.mkdir(parents=True, exist_ok=True)
+    private = ['user{}_{}.txt'.format(user, i) for i in range(args.files)]
+    shared = ['shared_{}.txt'.format(i) for i in range(args.shared_files)]
+    ops = list(args.mix)
+    weights = [args.mix[op] for op in ops]
+    async with AsyncClient(root_dir) as client:
+        for name in private + (shared if user == 0 else []):  # 预先写入文件，不计时
+            await client.write(name, make_content(args.size, rng))
+        await asyncio.get_running_loop().run_in_executor(None, barrier.wait)
+        for _ in range(args.ops):
+            op = rng.choices(ops, weights)[0]
+            name = rng.choice(shared if shared and rng.random() < args.contention else private)
+            before = counter[0]
+            start = time.perf_counter()
+            error = None
+            try:
+                # 读和列表失败时抛出异常；写、删除和同步返回每个副本的结果，有副本失败也算作失败的操作
+                if op == 'readtxt':
+                    await client.read(name)
+                elif op == 'mktxt':
+                    results, reached = await client.write(name, make_content(args.size, rng))
+                    error = None if reached else 'Write quorum not reached: {}'.format(failures(results))
+                elif op == 'deltxt':
+                    error = failures(await client.delete(name))
+                elif op == 'upload_all':
+                    error = failures((await client.sync())[1])
+                else:
+                    async for _ in client.list():
+                        pass
+            except Exception as e:
+                error = repr(e)
+            records.append([op, time.perf_counter() - start, counter[0] - before, error])
+
+def summarize(records, elapsed):  # 吞吐量和延迟只统计成功的操作，失败的操作单独计数
+    report = {}
+    for op in sorted(set(record[0] for record in records)):
+        ops = [record for record in records if record[0] == op]
+        latencies = [record[1] for record in ops if record[3] is None]
+        errors = [record[3] for record in ops if record[3] is not None]
+        report[op] = {
+            'count': len(ops),
+            'errors': len(errors),
+            'throughput': len(latencies) / elapsed,
+            'latency_ms': {'mean': sum(latencies) / len(latencies) * 1000 if latencies else None,
+                           'p50': percentile(latencies, 50) * 1000 if latencies else None,
+                           'p95': percentile(latencies, 95) * 1000 if latencies else None,
+                           'p99': percentile(latencies, 99) * 1000 if latencies else None},
+            'rpcs': sum(record[2] for record in ops),
+            'rpcs_per_op': sum(record[2] for record in ops) / len(ops),
+            'first_error': errors[0] if errors else None,
+        }
+    latencies = [record[1] for record in records if record[3] is None]
+    report['total'] = {
+        'count': len(records),
+        'errors': len(records) - len(latencies),
+        'throughput': len(latencies) / elapsed,
+        'latency_ms': {'p50': percentile(latencies, 50) * 1000 if latencies else None,
+                       'p95': percentile(latencies, 95) * 1000 if latencies else None,
+                       'p99': percentile(latencies, 99) * 1000 if latencies else None},
+        'rpcs': sum(record[2] for record in records),
+    }
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a local cluster and measure it with simulated users.')
+    parser.add_argument('--servers', help='Number of file servers.', type=int, default=3)
+    parser.add_argument('--clients', help='Number of concurrent simulated users.', type=int, default=8)
+    parser.add_argument('--ops', help='Operations per user.', type=int, default=100)
+    parser.add_argument('--size', help='Size of each file in bytes.', type=int, default=4096)
+    parser.add_argument('--files', help='Private files per user.', type=int, default=10)
+    parser.add_argument('--shared-files', help='Files shared by all users.', type=int, default=4)
+    parser.add_argument('--contention', help='Probability that an operation targets a shared file.', type=float, default=0.2)
+    parser.add_argument('--mix', help='Weighted operation mix.', type=parse_mix,
+                        default='readtxt=60,mktxt=25,deltxt=5,upload_all=5,server_ls=5')
+    parser.add_argument('--base-port', help='Port of the first file server.', type=int, default=8001)
+    parser.add_argument('--server-args', help='Extra arguments for every server.py, e.g. "--store dedup".', default='')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='Write the JSON report to this file instead of stdout.')
+    parser.add_argument('--keep', help='Keep the temporary working directory.', action='store_true')
+    args = parser.parse_args()
+
+    # 在临时目录中运行一份代码的拷贝，数据库、服务器目录和本地缓存都不会影响当前目录
+    work_dir = Path(tempfile.mkdtemp(prefix='cloud-bench-'))
+    shutil.copytree(Path(__file__).parent, work_dir, dirs_exist_ok=True,
+                    ignore=shutil.ignore_patterns('cloud_server', 'local_cache', '*.db', '*.db-*', '__pycache__'))
+    processes = start_cluster(work_dir, args.servers, args.base_port, args.server_args.split())
+    try:
+        barrier = multiprocessing.Barrier(args.clients + 1)
+        results = multiprocessing.Queue()
+        users = [multiprocessing.Process(target=run_user, args=(work_dir, user, args, barrier, results))
+                 for user in range(args.clients)]
+        for user in users:
+            user.start()
+        barrier.wait(timeout=600)  # 所有用户写完初始文件后同时开始计时
+        start = time.perf_counter()
+        records = []
+        for _ in users:
+            records.extend(results.get())
+        elapsed = time.perf_counter() - start
+        for user in users:
+            user.join()
+    finally:
+        stop_cluster(processes)
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        'config': {'servers': args.servers, 'clients': args.clients, 'ops': args.ops, 'size': args.size,
+                   'files': args.files, 'shared_files': args.shared_files, 'contention': args.contention,
+                   'mix': args.mix, 'server_args': args.server_args, 'seed': args.seed},
+        'elapsed': elapsed,
+        'operations': summarize(records, elapsed),
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(text)
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
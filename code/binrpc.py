@@ -0,0 +1,239 @@
+import concurrent.futures
+import marshal
+import socket
+import socketserver
+import struct
+import threading
+import time
+from urllib.parse import parse_qs, urlsplit, urlunsplit
+from xmlrpc.client import Binary, Fault
+from config import database_url, database_binary_port, binary_port_offset, binary_max_frame, keepalive_timeout
+from metrics import metrics
+
+# 帧：4字节长度、8字节请求id，之后是marshal编码的内容
+# 请求内容为(方法名, 参数)，响应内容为(是否成功, 结果或错误信息)
+# 同一连接上可以同时有多个请求，响应按完成顺序返回，用请求id对应
+# marshal不能防御恶意构造的数据，只应在集群内部使用
+HEADER = struct.Struct('>IQ')
+
+
+def to_wire(value):  # Binary转为bytes，其余类型marshal可以直接编码
+    if isinstance(value, Binary):
+        return value.data
+    if isinstance(value, (list, tuple)):
+        return [to_wire(item) for item in value]
+    if isinstance(value, dict):
+        return {key: to_wire(item) for key, item in value.items()}
+    return value
+
+def from_wire(value):  # bytes转回Binary，注册的函数和客户端代码与XML-RPC下完全一样
+    if isinstance(value, bytes):
+        return Binary(value)
+    if isinstance(value, (list, tuple)):
+        return [from_wire(item) for item in value]
+    if isinstance(value, dict):
+        return {key: from_wire(item) for key, item in value.items()}
+    return value
+
+def advertised_url(host, port, binary_port):  # 文件服务器向数据库登记的地址，二进制协议的端口作为查询参数随地址一起发布
+    return 'http://{}:{}/?binary={}'.format(host, port, binary_port)
+
+def binary_address(url):  # XML-RPC地址对应的二进制协议地址：同一主机，端口取地址中登记的binary参数
+    if url == database_url:
+        return urlsplit(url).hostname, database_binary_port
+    parts = urlsplit(url)
+    port = parse_qs(parts.query).get('binary')
+    return parts.hostname, int(port[0]) if port else parts.port + binary_port_offset  # 没有登记时按默认偏移
+
+def xmlrpc_url(url):  # 去掉地址中的binary参数，XML-RPC请求只发往服务器的根路径
+    return urlunsplit(urlsplit(url)._replace(query=''))
+
+def recv_exactly(sock, size, started=False):  # started为True或已收到部分数据时，超时不会打断帧的读取
+    data = bytearray()
+    while len(data) < size:
+        try:
+            chunk = sock.recv(min(size - len(data), 1 << 20))
+        except socket.timeout:
+            if started or data:
+                continue
+            raise
+        if not chunk:
+            raise ConnectionError('Connection closed')
+        data += chunk
+    return bytes(data)
+
+def read_frame(sock):  # 返回(请求id, 内容字节)
+    size, request_id = HEADER.unpack(recv_exactly(sock, HEADER.size))
+    if size > binary_max_frame:
+        raise ConnectionError('Frame too large')
+    return request_id, recv_exactly(sock, size, True)
+
+def pack_frame(request_id, payload):
+    return HEADER.pack(len(payload), request_id) + payload
+
+
+class BinaryRequestHandler(socketserver.BaseRequestHandler):  # 一个连接：循环读取请求，每个请求在单独的线程中执行
+    def setup(self):
+        self.write_lock = threading.Lock()
+        self.inflight = 0
+        self.request.settimeout(keepalive_timeout)
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def handle(self):
+        while True:
+            try:
+                request_id, payload = read_frame(self.request)
+            except socket.timeout:
+                if self.inflight:  # 还有请求在执行（例如排队等锁），连接不算空闲
+                    continue
+                return
+            except (ConnectionError, OSError):
+                return
+            with self.write_lock:
+                self.inflight += 1
+            threading.Thread(target=self.execute, args=(request_id, payload), daemon=True).start()
+
+    def execute(self, request_id, payload):
+        local = metrics.local
+        local.method, local.handler = None, 0.0
+        start = time.perf_counter()
+        try:
+            method, params = marshal.loads(payload)
+            result = (True, to_wire(self.server.dispatcher._dispatch(method, from_wire(params))))
+        except Exception as e:
+            result = (False, '{}:{}'.format(type(e).__name__, e))
+        try:
+            out = marshal.dumps(result)
+        except ValueError as e:  # 结果中有marshal不支持的类型
+            out = marshal.dumps((False, 'ValueError:{}'.format(e)))
+        metrics.record_request(local.method or '<invalid>', len(payload), len(out),
+                               time.perf_counter() - start - local.handler)
+        try:
+            with self.write_lock:
+                self.inflight -= 1
+                self.request.sendall(pack_frame(request_id, out))
+        except OSError:
+            pass
+
+
+class BinaryRPCServer(socketserver.ThreadingMixIn, socketserver.TCPServer):  # 与XML-RPC服务器共用同一组注册的函数
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, dispatcher):
+        self.dispatcher = dispatcher  # SimpleXMLRPCServer，经过它的_dispatch调用函数，统计和负载计数照常进行
+        super().__init__(address, BinaryRequestHandler)
+
+def serve_binary(xml_server, port):  # 在指定端口上启动二进制协议服务
+    server = BinaryRPCServer((xml_server.server_address[0], port), xml_server)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class StaleConnection(ConnectionError):  # 请求还没有发出去连接就已断开，可以安全地重试
+    pass
+
+class BinaryConnection(object):  # 到一个服务器的长连接，多个线程可以同时在上面发出请求（流水线）
+    def __init__(self, address):
+        self.sock = socket.create_connection(address)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.write_lock = threading.Lock()
+        self.mutex = threading.Lock()
+        self.pending = {}  # 请求id -> Future
+        self.next_id = 0
+        self.closed = False
+        threading.Thread(target=self.read_loop, daemon=True).start()
+
+    def call(self, method, params, timeout):
+        future = concurrent.futures.Future()
+        with self.mutex:
+            if self.closed:
+                raise StaleConnection('Connection closed')
+            self.next_id += 1
+            request_id = self.next_id
+            self.pending[request_id] = future
+        try:
+            frame = pack_frame(request_id, marshal.dumps((method, to_wire(params))))
+            try:
+                with self.write_lock:
+                    self.sock.sendall(frame)
+            except OSError:
+                self.close()
+                raise StaleConnection('Connection closed')
+            ok, result = future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            raise socket.timeout('timed out')
+        finally:
+            with self.mutex:
+                self.pending.pop(request_id, None)  # 超时后迟到的响应直接丢弃
+        if not ok:
+            raise Fault(1, result)
+        return from_wire(result)
+
+    def read_loop(self):  # 后台线程：读取响应并交给等待的请求
+        try:
+            while True:
+                request_id, payload = read_frame(self.sock)
+                with self.mutex:
+                    future = self.pending.get(request_id)
+                if future is not None:
+                    future.set_result(marshal.loads(payload))
+        except (ConnectionError, OSError, ValueError, EOFError):
+            self.close()
+
+    def close(self):  # 连接断开时，所有未完成的请求都以ConnectionError结束
+        with self.mutex:
+            if self.closed:
+                return
+            self.closed = True
+            pending = list(self.pending.values())
+        self.sock.close()
+        for future in pending:
+            if not future.done():
+                future.set_exception(ConnectionError('Connection closed'))
+
+
+class BinaryMethod(object):  # 与xmlrpc.client中的_Method相同，支持system.multicall这样带点的方法名
+    def __init__(self, proxy, name):
+        self.proxy = proxy
+        self.name = name
+
+    def __getattr__(self, name):
+        return BinaryMethod(self.proxy, '{}.{}'.format(self.name, name))
+
+    def __call__(self, *args):
+        return self.proxy.call(self.name, args)
+
+
+class BinaryServerProxy(object):  # 与ServerProxy用法相同的二进制协议代理，进程内到同一服务器的请求共用一个连接
+    def __init__(self, url, timeout=None):
+        self.address = binary_address(url)
+        self.timeout = timeout
+
+    def call(self, method, params):
+        for attempt in (0, 1):  # 请求发出前连接已被服务器关闭时，重连并重试一次
+            connection = get_connection(self.address)
+            try:
+                return connection.call(method, params, self.timeout)
+            except StaleConnection:
+                if attempt:
+                    raise
+
+    def __getattr__(self, name):
+        return BinaryMethod(self, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+connections = {}  # (host, port) -> BinaryConnection
+connections_lock = threading.Lock()
+
+def get_connection(address):
+    with connections_lock:
+        connection = connections.get(address)
+        if connection is None or connection.closed:
+            connection = connections[address] = BinaryConnection(address)
+        return connection
@@ -1,20 +1,15 @@
-from xmlrpc.client import ServerProxy
 import base64
 import bcrypt
 from pathlib import Path
-from config import database_url
+from config import database_url, write_back
 import argparse
+import asyncio
 import datetime
-import os
-import hashlib
-import time
+import threading
+from transport import connect
+from aioclient import AsyncClient
+
 
-def calculate_file_hash(file_path):  # 计算文件哈希值
-    with open(file_path, 'rb') as file:
-        data = file.read()
-        hash_value = hashlib.sha256(data).hexdigest()
-        return hash_value
-    
 def sign_up(username, password):  # 注册用户
     if len(password) > 72:
         print('Password must be less than 72 characters.')
@@ -45,161 +40,41 @@ def login(username, password):  # 登录
             print('Wrong password.')
     return None
 
-def mktxt(path, name, content):  # 创建txt文件
-    name = name + '.txt'
-    txt_path = path / name
-    try:
-        with txt_path.open(mode='w') as f:
-            # 写入数据
-            f.write(content)
-        print('The local txt file was written successfully.')
-        update(path, name, 'upload')
-    except:
-        print('An error occurred while making the local txt or uploading the txt.')
-
-def deltxt(path, name):  # 删除txt文件
-    name = name + '.txt'
-    txt_path = path / name
-    try:
-        txt_path.unlink()
-        print('The local txt file was deleted successfully.')
-        update(path, name, 'delete')
-    except FileNotFoundError:
-        print("Txt does not exist")
-    except OSError as e:
-        print("An error occurred while deleting the txt:", e)
-
-def get_txt_content(path):  # 获取txt文件内容
-    try:
-        content = path.read_text()
-        return content
-    except IOError:
-        print(f"Unable to open txt {path}")
-        return False
-
-def readtxt(path, name):  # 读文件
-    name = name + '.txt'
-    serverid = proxy.get_server_info()[0][0]  # 随便获取一个服务器id
-    lock = proxy.get_lock(serverid, name)
-    xlock = lock[1]
-    if xlock == 1:  # 如果当前文件被加上了排他锁，则等待
-        print('The txt is being written, please wait...')
-    while proxy.get_lock(serverid, name)[1]:
-        pass
-    proxy.lock_S(serverid, name)  # 给文件加上一个共享锁
-    if not (path / name).exists():  # 如果本地没有这个文件，则从服务器下载
-        print('The txt is not existed loaclly, so we download it from server.')
-        download(serverid, name, path)
-    else:  # 如果本地有文件，但是和服务器的不一致，则从服务器下载更新
-        local_filehash = calculate_file_hash(path / name)
-        cloud_filehash = proxy.get_one_file_hash(serverid, name)[0]
-        if (local_filehash != cloud_filehash):
-            print('Local files are not the same as cloud files, so we update it from server.')
-            download(serverid, name, path)
-    content = get_txt_content(path / name)
-    if content == False:
-        print('Unable to read {}'.format(name))
-    else:
-        print('The content of {} is {}'.format(name, content))
-    proxy.unlock_S(serverid, name)  # 解开一个共享锁
-
-def upload_all(path):  # 将本地的所有txt都上传到服务器
-    for txt in path.rglob('*'):
-        update(path, txt.name, 'upload')
-
-def update(path, name, op):  # 将本地的操作更新到服务器
-    addresses = proxy.get_all_server_addresses()
-    if op == 'upload':  # 上传操作
-        if name.endswith('.txt'):
-            content = get_txt_content(path / name)
-            for address in addresses:  # 遍历所有服务器地址
-                serverid = proxy.get_server_id(address)[0]
-                lock = proxy.get_lock(serverid, name)
-                if lock != None:
-                    slock = lock[0]
-                    xlock = lock[1]
-                    if slock != 0 or xlock != 0:  # 如果该文件已被加上任意一把锁，则等待
-                        print('The txt is being read or written, please wait...')
-                        while True:
-                            lock = proxy.get_lock(serverid, name)
-                            slock = lock[0]
-                            xlock = lock[1]
-                            if slock == 0 and xlock == 0:
-                                break
-                    proxy.lock_X(serverid, name)  # 给文件加上一把排他锁
-                with ServerProxy(address, allow_none=True) as server_proxy:
-                    server_id = proxy.get_server_id(address)[0]
-                    back = server_proxy.mktxt(name[:-4], content)
-                    print('Server_id:{}'.format(str(server_id)), end=' ')
-                    if back == 'success':
-                        lastmodified = os.path.getmtime(os.path.join(path, name))
-                        filehash = calculate_file_hash(os.path.join(path, name))
-                        proxy.add_file([tuple([name, server_id, lastmodified, filehash, 0, 1])])
-                        print('Successfully upload.')
-                    else:
-                        print('Fail to upload.')
-                proxy.unlock_X(serverid, name)  # 解开一个排他锁
-    elif op == 'delete':  # 删除操作
-        if name.endswith('.txt'):
-            for address in addresses:  # 遍历所有服务器地址
-                serverid = proxy.get_server_id(address)[0]
-                lock = proxy.get_lock(serverid, name)
-                slock = lock[0]
-                xlock = lock[1]
-                if slock != 0 or xlock != 0:  # 如果该文件已被加上任意一把锁，则等待
-                    print('The txt is being read or written, please wait...')
-                    while True:
-                        lock = proxy.get_lock(serverid, name)
-                        slock = lock[0]
-                        xlock = lock[1]
-                        if slock == 0 and xlock == 0:
-                            break
-                proxy.lock_X(serverid, name)  # 给文件加上一把排他锁
-                with ServerProxy(address, allow_none=True) as server_proxy:
-                    server_id = proxy.get_server_id(address)[0]
-                    back = server_proxy.deltxt(name[:-4])
-                    print('Server_id:{}'.format(str(server_id)), end=':')
-                    if back == 'success':
-                        proxy.delete_file(server_id, name)
-                        print('Successfully delete.')
-                    else:
-                        print(back)
-                # 文件已经被删了，所以不需要解开排他锁了
-
-def download(server_id, name, local_path):  # 从服务器下载文件
-    address = proxy.get_server_address(server_id)[0]
-    txt_list = proxy.get_file_infos(server_id)
-    try:
-        for info in txt_list:
-            if info[0] == name:
-                with ServerProxy(address, allow_none=True) as server_proxy:
-                    content = server_proxy.get_txt_content(name)
-                local_path = Path(local_path) / name
-                with local_path.open(mode='w') as f:
-                    # 写入数据
-                    f.write(content)
-                print('The txt file was downloaded successfully.')
-    except:
-        print('An error occurred while downloading the txt.')
-
 def print_local_filename(path):  # 打印本地文件名
     for txt in path.rglob('*'):
         print(txt.name)
 
-def print_cloud_filename():  # 打印服务器所有文件信息
-    addresses = proxy.get_all_server_addresses()
-    print('{0:25s} {1:7s} {2}'.format('File Name', 'Server', 'Last Modified Time'))
-    for address in addresses:
-        server_id = proxy.get_server_id(address)[0]
-        txt_list = proxy.get_file_infos(server_id)
-        for info in txt_list:
-            modified_time_str = datetime.datetime.fromtimestamp(info[2]).strftime('%Y-%m-%d %H:%M:%S')
-            print('{0:25s} {1:7s} {2}'.format(info[0], str(info[1]), modified_time_str))
+def histogram_percentile(histogram, bounds, p):  # 用直方图估计百分位数，返回所在桶的上界（毫秒），落在最后一格时返回None
+    rank = p / 100 * sum(histogram)
+    seen = 0
+    for count, bound in zip(histogram, bounds + [None]):
+        seen += count
+        if count and seen >= rank:
+            return bound
+    return None
+
+def print_endpoint_stats(title, address, stats):  # 打印一个服务器的get_stats结果，按总耗时排序，stats也可以是获取时的异常
+    if isinstance(stats, Exception):
+        print('{} {}: {}'.format(title, address, stats))
+        return
+    print('{} {} up {:.0f}s'.format(title, address, stats['uptime']))
+    print('{0:22s} {1:>7s} {2:>5s} {3:>9s} {4:>7s} {5:>7s} {6:>9s} {7:>9s} {8:>9s} {9}'.format(
+        'Method', 'Calls', 'Err', 'Mean(ms)', 'p50', 'p99', 'KB in', 'KB out', 'Codec(ms)', 'Sections(ms)'))
+    for name, method in sorted(stats['methods'].items(), key=lambda item: -item[1]['time_ms']):
+        p50, p99 = [histogram_percentile(method['histogram'], stats['buckets_ms'], p) for p in (50, 99)]
+        print('{0:22s} {1:7d} {2:5d} {3:9.2f} {4:>7s} {5:>7s} {6:9.1f} {7:9.1f} {8:9.1f} {9}'.format(
+            name, method['calls'], method['errors'], method['time_ms'] / max(method['calls'], 1),
+            '<{:g}'.format(p50) if p50 is not None else '-', '<{:g}'.format(p99) if p99 is not None else '-',
+            method['bytes_in'] / 1024, method['bytes_out'] / 1024, method['serialize_ms'],
+            ' '.join('{}={:.1f}'.format(section, ms) for section, ms in sorted(method['sections_ms'].items()))))
+    for name, values in sorted(stats.get('gauges', {}).items()):
+        print('{}: {}'.format(name, ' '.join('{}={:g}'.format(key, value) for key, value in sorted(values.items()))))
 
 class App(object):
     def __init__(self, username):
         self.username = username
         self.root_dir =  Path(__file__).parent / 'local_cache' / username  # 用户的本地缓存
+        self.write_back = write_back  # 写回模式
         if not (Path(__file__).parent / 'local_cache').exists():
             (Path(__file__).parent / 'local_cache').mkdir()
         if not self.root_dir.exists():
@@ -208,52 +83,120 @@ class App(object):
     def print_option(self):  # 打印操作教程
         print('OPTIONS')
         print('- ls')
-        print('- server_ls')
+        print('- server_ls [--latest] [prefix]')
         print('- mktxt <txt_name> <content>')
         print('- deltxt <txt_name>')
         print('- readtxt <txt_name>')
         print('- upload')
+        print('- flush')
         print('- download <server_id> <txt_name>')
+        print('- stats')
         print('- help')
         print('- exit')
 
     def main_loop(self):
+        # 命令在后台线程的事件循环中由异步客户端执行，写操作达到quorum后就返回，其余副本在后台继续上传
+        loop = asyncio.new_event_loop()
+        threading.Thread(target=loop.run_forever, daemon=True).start()
+        run = lambda coro: asyncio.run_coroutine_threadsafe(coro, loop).result()
+        client = run(self.open_client())
         print('Current user:', self.username)
         self.print_option()
         print('Type \'help\' to get tutorial')
-        while True:
-            print('Current user:', self.username)
-            command = str(input('$ ')).split(' ')
-            if command[0] == 'ls' and len(command) == 1:
-                print_local_filename(self.root_dir)
-            elif command[0] == 'server_ls' and len(command) == 1:
-                print_cloud_filename()
-            elif command[0] == 'mktxt' and len(command) == 3:
-                mktxt(self.root_dir, command[1].strip(), command[2])      
-            elif command[0] == 'deltxt' and len(command) == 2:
-                deltxt(self.root_dir, command[1].strip())
-            elif command[0] == 'readtxt' and len(command) == 2:
-                readtxt(self.root_dir, command[1].strip())
-            elif command[0] == 'upload' and len(command) == 1:
-                upload_all(self.root_dir)
-            elif command[0] == 'download' and len(command) == 3:
-                download(int(command[1].strip()), command[2].strip() + '.txt', self.root_dir)
-            elif command[0] == 'help' and len(command) == 1:
-                self.print_option()
-            elif command[0] == 'exit':
-                break
+        try:
+            while True:
+                print('Current user:', self.username)
+                command = str(input('$ ')).split(' ')
+                if command[0] == 'exit':
+                    break
+                try:
+                    self.execute(client, run, command)
+                except Exception as e:
+                    print('An error occurred: {}'.format(e))
+        finally:
+            run(client.close())  # 等待后台的上传完成
+            loop.call_soon_threadsafe(loop.stop)
+
+    async def open_client(self):  # 异步客户端需要在事件循环中创建
+        return AsyncClient(self.root_dir, write_back=self.write_back)
+
+    def execute(self, client, run, command):
+        if command[0] == 'ls' and len(command) == 1:
+            print_local_filename(self.root_dir)
+        elif command[0] == 'server_ls' and len(command) <= 3:
+            latest = '--latest' in command[1:]
+            prefixes = [arg for arg in command[1:] if arg != '--latest']
+            if len(prefixes) <= 1:
+                run(self.print_cloud_filename(client, prefixes[0] if prefixes else None, latest))
             else:
                 print('Invalid Command.')
-
+        elif command[0] == 'mktxt' and len(command) == 3:
+            results, reached = run(client.write(command[1].strip() + '.txt', command[2]))
+            print('The local txt file was written successfully.')
+            if client.write_back:
+                print('It will be uploaded in the background.')
+            self.print_results(results, reached)
+        elif command[0] == 'deltxt' and len(command) == 2:
+            if not (self.root_dir / (command[1].strip() + '.txt')).exists():
+                print('Txt does not exist')
+                return
+            results = run(client.delete(command[1].strip() + '.txt'))
+            print('The local txt file was deleted successfully.')
+            self.print_results(results, True)
+        elif command[0] == 'readtxt' and len(command) == 2:
+            name = command[1].strip() + '.txt'
+            print('The content of {} is {}'.format(name, run(client.read(name))))
+        elif command[0] == 'upload' and len(command) == 1:
+            unchanged, results = run(client.sync())
+            self.print_results(results, True)
+            print('{} files up to date, {} uploads.'.format(unchanged, len(results)))
+        elif command[0] == 'flush' and len(command) == 1:
+            results = run(client.flush())
+            for name, (replicas, reached) in sorted(results.items()):
+                print(name)
+                self.print_results(replicas, reached)
+            print('{} files flushed.'.format(len(results)))
+        elif command[0] == 'download' and len(command) == 3:
+            if run(client.fetch(int(command[1].strip()), command[2].strip() + '.txt')):
+                print('The txt file was downloaded successfully.')
+            else:
+                print('The downloaded txt does not match the server, please try again.')
+        elif command[0] == 'stats' and len(command) == 1:
+            for title, address, stats in run(client.stats()):
+                print_endpoint_stats(title, address, stats)
+        elif command[0] == 'help' and len(command) == 1:
+            self.print_option()
+        else:
+            print('Invalid Command.')
+
+    def print_results(self, results, reached):  # 打印每个副本的结果
+        for _, message in results:
+            print(message)
+        if not reached:
+            print('Write quorum not reached, only some replicas have the new version.')
+
+    async def print_cloud_filename(self, client, prefix, latest):  # 边拉取边打印服务器上的文件信息
+        if latest:
+            print('{0:25s} {1:8s} {2}'.format('File Name', 'Replicas', 'Last Modified Time'))
+            async for name, lastmodified, _, replicas in client.list(prefix, latest=True):
+                modified_time_str = datetime.datetime.fromtimestamp(lastmodified).strftime('%Y-%m-%d %H:%M:%S')
+                print('{0:25s} {1:8s} {2}'.format(name, str(replicas), modified_time_str))
+            return
+        print('{0:25s} {1:7s} {2}'.format('File Name', 'Server', 'Last Modified Time'))
+        async for name, server_id, lastmodified, _ in client.list(prefix):
+            modified_time_str = datetime.datetime.fromtimestamp(lastmodified).strftime('%Y-%m-%d %H:%M:%S')
+            print('{0:25s} {1:7s} {2}'.format(name, str(server_id), modified_time_str))
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('mode', help='Client mode, "signup" or "login".', type=str)
     parser.add_argument('username', help='Username of the user.', type=str)
     parser.add_argument('password', help='Password of the user.', type=str)
+    parser.add_argument('--write-back', help='Return from mktxt after the local write and upload in the background.',
+                        action='store_true', default=write_back)
     args = parser.parse_args()
 
-    proxy = ServerProxy(database_url, allow_none=True)
+    proxy = connect(database_url)  # 注册和登录时使用，登录后的操作都由异步客户端执行
 
     if args.mode == 'signup':
         sign_up(args.username, args.password)
@@ -261,6 +204,7 @@ if __name__ == '__main__':
         app = login(args.username, args.password)
 
         if app is not None:
+            app.write_back = args.write_back
             app.main_loop()
     else:
         print('Invalid operation.')
@@ -0,0 +1,105 @@
+import bisect
+import io
+import lzma
+import struct
+import zlib
+from config import compression_level, compression_min_ratio
+
+# 可用的压缩算法：名称 -> (压缩, 解压)
+CODECS = {
+    'zlib': (lambda data, level: zlib.compress(data, level), zlib.decompress),
+    'lzma': (lambda data, level: lzma.compress(data, preset=level), lzma.decompress),
+}
+CODEC_IDS = ['', 'zlib', 'lzma']  # 帧头中保存的算法编号，''表示未压缩
+MAGIC = b'\x89CFZ'  # 压缩存储的文件以此开头；文件是否压缩由存储位置决定，不根据它判断
+FRAME = struct.Struct('>BII')  # 帧头：算法编号、原始大小、压缩后大小
+SAMPLE_SIZE = 1 << 16  # 判断是否可压缩时先试压缩的数据量
+
+
+def compress(data, codec, level=compression_level):  # 压缩一段数据，返回(实际使用的算法, 数据)，不可压缩时算法为''
+    if not codec or len(data) < FRAME.size:
+        return '', data
+    if len(data) > SAMPLE_SIZE * 2:  # 先用最快的级别试压缩一小段，已经压缩过的数据（图片、压缩包等）直接跳过
+        sample = data[:SAMPLE_SIZE]
+        if len(zlib.compress(sample, 1)) > len(sample) * compression_min_ratio:
+            return '', data
+    out = CODECS[codec][0](data, level)
+    if len(out) > len(data) * compression_min_ratio:
+        return '', data
+    return codec, out
+
+def decompress(codec, data):
+    if not codec:
+        return data
+    return CODECS[codec][1](data)
+
+def write_frames(src, dst, codec, frame_size, level=compression_level):  # 把文件对象src按帧压缩写入dst，每帧可以独立解压
+    dst.write(MAGIC)
+    for data in iter(lambda: src.read(frame_size), b''):
+        used, out = compress(data, codec, level)
+        dst.write(FRAME.pack(CODEC_IDS.index(used), len(data), len(out)))
+        dst.write(out)
+
+def compress_bytes(data, codec, frame_size, level=compression_level):  # write_frames的字节串版本
+    out = io.BytesIO()
+    write_frames(io.BytesIO(data), out, codec, frame_size, level)
+    return out.getvalue()
+
+
+class FrameReader(io.RawIOBase):  # 按帧读取压缩存储的文件，支持随机访问，只解压需要的帧
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.frames = []  # [[在文件中的位置, 算法, 压缩后大小], ...]
+        self.offsets = [0]  # 每帧起始处的原始偏移
+        self.file.seek(len(MAGIC))
+        while True:
+            header = self.file.read(FRAME.size)
+            if len(header) < FRAME.size:
+                break
+            codec, size, stored = FRAME.unpack(header)
+            self.frames.append([self.file.tell(), CODEC_IDS[codec], stored])
+            self.offsets.append(self.offsets[-1] + size)
+            self.file.seek(stored, io.SEEK_CUR)
+        self.pos = 0
+        self.cached = (None, b'')  # 最近解压的一帧，顺序读取时每帧只解压一次
+
+    def size(self):  # 原始数据的大小
+        return self.offsets[-1]
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += self.offsets[-1]
+        self.pos = max(0, offset)
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def frame(self, index):
+        if self.cached[0] != index:
+            position, codec, stored = self.frames[index]
+            self.file.seek(position)
+            self.cached = (index, decompress(codec, self.file.read(stored)))
+        return self.cached[1]
+
+    def readinto(self, buffer):
+        if self.pos >= self.offsets[-1]:
+            return 0
+        index = bisect.bisect_right(self.offsets, self.pos) - 1
+        start = self.pos - self.offsets[index]
+        data = self.frame(index)[start:start + len(buffer)]
+        buffer[:len(data)] = data
+        self.pos += len(data)
+        return len(data)
+
+    def close(self):
+        self.file.close()
+        super().close()
@@ -1,2 +1,49 @@
 database_info = ('localhost', 9999)
 database_url = 'http://{}:{}'.format(database_info[0], database_info[1])
+replica_workers = 8  # 并发向副本推送更新的线程数
+replica_timeout = 10  # 单个副本操作的超时时间（秒）
+lock_lease_time = 60  # 锁租约的有效期（秒），持有者崩溃后锁会在租约到期时自动释放
+lock_wait_timeout = 30  # 客户端排队等待锁的最长时间（秒）
+db_path = 'info.db'  # 元数据数据库文件
+db_workers = 8  # 元数据服务器并发执行sql的工作线程数（每个线程一个sqlite连接）
+group_commit_size = 64  # 组提交时一个事务最多合并的写操作数
+changelog_size = 10000  # 元数据服务器保留的变更日志条数，客户端落后更多时需要全量刷新缓存
+transfer_chunk_size = 1 << 20  # 客户端和文件服务器之间分块传输的块大小（字节）
+delta_sync = True  # 修改已有文件时只上传变化的块（rsync式增量上传）
+delta_block_size = 4096  # 增量上传的块大小（字节）
+delta_min_match = 0.5  # 预计能复用的旧文件内容低于新文件的这个比例时不做增量上传（逐字节的滚动校验和比直接发送还慢）
+delta_samples = 16  # 增量上传前在新文件中抽样检查能否复用旧文件的位置数
+dedup_delta_ratio = 0.5  # 去重上传时服务器缺少的块超过这个比例（例如在文件开头插入了数据，之后的固定大小块全部错位），改用增量上传
+index_workers = 4  # 文件服务器启动时并行计算哈希的线程数
+register_batch_size = 500  # 文件服务器启动时每次向数据库登记的文件数
+read_timeout = 5  # 读副本超过这个时间（秒）没有响应就换一个副本
+latency_ewma_alpha = 0.2  # 副本读延迟EWMA的平滑系数
+latency_floor = 0.05  # 选择读副本时，低于该值（秒）的延迟差异视为噪声
+stats_report_interval = 1  # 文件服务器上报负载的间隔（秒）
+replication_factor = 3  # 每个文件的副本数R
+write_quorum = 2  # 写操作在W个副本确认后即返回，其余副本在后台继续
+ring_vnodes = 64  # 一致性哈希环上每个服务器的虚拟节点数
+rebalance_delay = 2  # 服务器加入或离开后，等待多久（秒）开始在后台迁移文件
+wire_codec = 'zlib'  # 客户端和文件服务器之间传输文件内容使用的压缩算法（zlib或lzma），None表示不压缩
+compression_level = 6  # 压缩级别，zlib为1-9，lzma为0-9
+compression_min_ratio = 0.9  # 压缩后超过原大小的这个比例时视为不可压缩，直接使用原始数据
+list_page_size = 1000  # 分页列出文件时每页最多的条数
+pool_max_per_host = 32  # 一个进程同时发往同一服务器的请求数上限（即到该服务器的最大连接数）
+pool_idle_timeout = 20  # 客户端空闲超过这个时间（秒）的连接不再复用，应小于keepalive_timeout
+keepalive_timeout = 30  # 服务器端长连接空闲超过这个时间（秒）后关闭
+rpc_protocol = 'xmlrpc'  # 同步调用（服务器与数据库、服务器之间、注册和登录）使用的协议，'xmlrpc'或'binary'；异步客户端始终使用binary
+binary_port_offset = 1000  # 文件服务器没有用--binary-port指定时，二进制协议的端口等于XML-RPC端口加上这个偏移
+database_binary_port = database_info[1] + binary_port_offset  # 数据库二进制协议的端口，需与database.py的--binary-port一致
+binary_max_frame = 64 << 20  # 二进制协议单帧的最大字节数
+async_max_inflight = 256  # 异步客户端同时在途的请求数上限，超过时新的请求等待
+write_back = False  # 写回模式：mktxt写完本地就返回，由后台任务合并同一文件的多次修改后再上传到副本
+write_back_delay = 1  # 写回模式下文件第一次被修改后等待多久（秒）开始上传，期间的修改合并为一次上传
+write_back_dirty_limit = 64 << 20  # 写回模式下尚未上传的数据超过这个字节数时立即上传，写入者等待上传腾出空间
+write_back_fsync = True  # 写回模式下每次写入后fsync本地文件，返回时数据至少已经落在本地磁盘上
+antientropy_interval = 30  # 文件服务器之间比较Merkle树、修复不一致副本的间隔（秒）
+merkle_depth = 3  # Merkle树的层数（不含根），每层16叉，共16**merkle_depth个叶子
+antientropy_lock_timeout = 1  # 修复一个文件时等待锁的时间（秒），文件正在被写时留到下一轮
+tombstone_ttl = 7 * 24 * 3600  # 文件服务器保留删除标记的时间（秒），停机超过这个时间的服务器重新加入前应清空其目录
+read_cache_size = 256 << 20  # 文件服务器热点文件读缓存的容量（字节），0表示不缓存
+read_cache_max_file = 64 << 20  # 超过这个大小的文件不经过读缓存
+read_cache_mmap_threshold = 1 << 20  # 不小于这个大小且未压缩保存的文件用mmap映射，按memoryview切片发送，不复制到内存
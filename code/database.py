@@ -1,196 +1,618 @@
 import sqlite3
 from xmlrpc.server import SimpleXMLRPCServer
+from socketserver import ThreadingMixIn
+import argparse
 import base64
-from config import database_info
+import collections
+import concurrent.futures
+import contextlib
+import queue
+import threading
+import time
+import uuid
+from transport import connect, KeepAliveRequestHandler
+from binrpc import serve_binary
+from hashring import HashRing
+from metrics import MetricsMixin, metrics, get_stats, set_profiling, get_profile
+from config import database_info, database_binary_port, lock_lease_time, db_path, db_workers, group_commit_size, \
+    changelog_size, latency_ewma_alpha, replication_factor, write_quorum, ring_vnodes, rebalance_delay, \
+    lock_wait_timeout, list_page_size
 
 
-def init_user_table():
+class ThreadedXMLRPCServer(ThreadingMixIn, MetricsMixin, SimpleXMLRPCServer):  # 多线程服务器，阻塞等待锁的请求不会卡住其他请求
+    daemon_threads = True
+
+def open_connection():  # 打开一个WAL模式的sqlite连接，读写可以并发进行
+    conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None, timeout=30)
+    conn.execute('pragma journal_mode = wal;')
+    conn.execute('pragma synchronous = normal;')
+    return conn
+
+class ConnectionPool(object):  # 读连接池，每个工作线程独占一个连接
+    def __init__(self, size):
+        self.connections = queue.Queue()
+        for _ in range(size):
+            self.connections.put(open_connection())
+
+    @contextlib.contextmanager
+    def cursor(self):
+        with metrics.section('sql'):
+            conn = self.connections.get()  # 连接全部被占用时等待，连接数即为并发处理sql的工作线程数
+            try:
+                yield conn.cursor()
+            finally:
+                self.connections.put(conn)
+
+class GroupCommitter(object):  # 组提交：单独的写线程把排队的多个小写操作合并到一个事务中提交
+    def __init__(self, batch_size):
+        self.batch_size = batch_size
+        self.jobs = queue.Queue()
+        self.connection = open_connection()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def submit(self, job, wait=True, on_commit=None):  # job是一个接收cursor的函数，默认等到事务提交后再返回其结果
+        # on_commit在事务提交成功后由写线程按提交顺序调用
+        future = concurrent.futures.Future()
+        self.jobs.put((job, on_commit, future))
+        if not wait:
+            return future
+        with metrics.section('sql'):  # 等待写线程提交的时间
+            return future.result()
+
+    def run(self):
+        cursor = self.connection.cursor()
+        while True:
+            jobs = [self.jobs.get()]
+            while len(jobs) < self.batch_size:
+                try:
+                    jobs.append(self.jobs.get_nowait())
+                except queue.Empty:
+                    break
+            results = []
+            try:
+                cursor.execute('begin immediate;')
+                for job, on_commit, future in jobs:
+                    # 每个写操作放在单独的保存点中，一个失败不影响同批的其他操作
+                    cursor.execute('savepoint job;')
+                    try:
+                        results.append((future, on_commit, job(cursor), None))
+                        cursor.execute('release savepoint job;')
+                    except Exception as e:  # 写操作中的任何异常都交给对应调用者，不能让写线程退出
+                        cursor.execute('rollback to savepoint job;')
+                        cursor.execute('release savepoint job;')
+                        results.append((future, None, None, e))
+                cursor.execute('commit;')
+            except sqlite3.Error as e:
+                if self.connection.in_transaction:
+                    cursor.execute('rollback;')
+                results = [(future, None, None, e) for _, _, future in jobs]
+            for future, on_commit, result, error in results:
+                if error is None:
+                    if on_commit is not None:
+                        on_commit()
+                    future.set_result(result)
+                else:
+                    future.set_exception(error)
+
+
+class ChangeLog(object):  # 元数据变更日志，版本号单调递增，客户端据此增量刷新缓存
+    def __init__(self, capacity):
+        self.epoch = uuid.uuid4().hex  # 数据库每次启动都会重建表，epoch不同说明客户端的缓存已完全失效
+        self.version = 0
+        self.entries = collections.deque(maxlen=capacity)  # (version, change)
+        self.mutex = threading.Lock()
+
+    def record(self, *changes):
+        with self.mutex:
+            for change in changes:
+                self.version += 1
+                self.entries.append((self.version, change))
+
+    def since(self, epoch, version):  # 返回当前版本和之后的变更，日志已被截断或epoch不同时返回None
+        with self.mutex:
+            if epoch != self.epoch or version > self.version:
+                return self.version, None
+            if version < self.version and (not self.entries or self.entries[0][0] > version + 1):
+                return self.version, None
+            return self.version, [change for v, change in self.entries if v > version]
+
+
+class ServerStats(object):  # 每个文件服务器的负载和延迟统计，客户端据此选择读副本
+    def __init__(self, alpha):
+        self.alpha = alpha  # EWMA的平滑系数
+        self.inflight = {}  # serverid -> 文件服务器上报的正在处理的请求数
+        self.latency = {}  # serverid -> 客户端上报的读延迟EWMA（秒）
+        self.mutex = threading.Lock()
+
+    def report_load(self, serverid, inflight):
+        with self.mutex:
+            self.inflight[serverid] = inflight
+
+    def report_latency(self, samples):
+        with self.mutex:
+            for serverid, latency in samples:
+                old = self.latency.get(serverid)
+                self.latency[serverid] = latency if old is None else old + self.alpha * (latency - old)
+
+    def drop(self, serverid):
+        with self.mutex:
+            self.inflight.pop(serverid, None)
+            self.latency.pop(serverid, None)
+
+    def snapshot(self):  # [[serverid, inflight, latency], ...]，没有数据的项为None
+        with self.mutex:
+            return [[serverid, self.inflight.get(serverid), self.latency.get(serverid)]
+                    for serverid in set(self.inflight) | set(self.latency)]
+
+
+def init_user_table(cursor):
     cursor.execute('drop table if exists users;')
-    connection.commit()
     cursor.execute('create table users (\
 username text primary key,\
 password text,\
 salt text);')
-    connection.commit()
 
-def init_server_table():
+def init_server_table(cursor):
     cursor.execute('drop table if exists servers;')
-    connection.commit()
     cursor.execute('create table servers (\
 serverid integer primary key,\
 address text);')
-    connection.commit()
 
-def init_file_table():
+def init_file_table(cursor):
     cursor.execute('drop table if exists files;')
-    connection.commit()
+    # 主键(filename, serverid)作为聚簇索引，按文件名和前缀的范围查询直接在主键上进行
     cursor.execute('create table files (\
 filename text,\
 serverid integer,\
 lastmodified float,\
 filehash text,\
-S_lock integer check (S_lock >= 0),\
-X_lock integer check (X_lock = 0 or X_lock = 1),\
-primary key (filename, serverid));')
-    connection.commit()
+primary key (filename, serverid)) without rowid;')
+    # 按服务器查询和删除服务器时使用
+    cursor.execute('create index files_by_server on files (serverid, filename);')
+
+def init_tombstone_table(cursor):
+    cursor.execute('drop table if exists tombstones;')
+    # 被客户端删除的文件和删除时间，修改时间不晚于删除时间的版本不再登记，错过删除的服务器重新加入时不会把文件带回来
+    cursor.execute('create table tombstones (\
+filename text primary key,\
+deleted float) without rowid;')
 
 def init_db():
-    init_user_table()
-    init_server_table()
-    init_file_table()
-    connection.commit()
+    conn = open_connection()
+    cursor = conn.cursor()
+    init_user_table(cursor)
+    init_server_table(cursor)
+    init_file_table(cursor)
+    init_tombstone_table(cursor)
+    conn.close()
 
 def add_user(username, hash_password, salt):  # 添加一个用户
+    # 在提交给写线程之前解码，格式错误的参数直接在调用线程中报错
+    hash_password = str(base64.b64decode(hash_password), 'utf-8')
+    salt = str(base64.b64decode(salt), 'utf-8')
     try:
-        cursor.execute('insert into users (username, password, salt) values (?, ?, ?);',
-                       (username, str(base64.b64decode(hash_password), 'utf-8'), str(base64.b64decode(salt), 'utf-8')))
-        connection.commit()
+        committer.submit(lambda cursor: cursor.execute('insert into users (username, password, salt) values (?, ?, ?);',
+                                                       (username, hash_password, salt)))
         return True
     except sqlite3.Error:
         return False
 
 def add_server(server_id, address):  # 添加新的服务器
     try:
-        cursor.execute('insert into servers (serverid, address) values (?, ?);', (server_id, address))
-        connection.commit()
+        committer.submit(lambda cursor: cursor.execute('insert into servers (serverid, address) values (?, ?);',
+                                                       (server_id, address)),
+                         on_commit=lambda: changelog.record(['server', server_id, address]))
+        rebalance_event.set()  # 有服务器加入，按新的哈希环迁移文件
         return True
     except sqlite3.Error:
         return False
 
 def delete_server(server_id):  # 删除服务器，一并删除其存的文件信息
-    cursor.execute('delete from servers where serverid = ?;', (server_id, ))
-    cursor.execute('delete from files where serverid = ?;', (server_id, ))
-    connection.commit()
+    def job(cursor):
+        cursor.execute('delete from servers where serverid = ?;', (server_id, ))
+        cursor.execute('delete from files where serverid = ?;', (server_id, ))
+    committer.submit(job, on_commit=lambda: changelog.record(['server', server_id, None]))
+    server_stats.drop(server_id)
+    rebalance_event.set()  # 有服务器离开，补齐它持有的副本
 
-def add_file(file_list):  # 添加新文件，如果已存在则覆盖
-    try:
-        cursor.executemany('insert or replace into files (filename, serverid, lastmodified, filehash, S_lock, X_lock)\
-                              values (?, ?, ?, ?, ?, ?)', file_list)
-        connection.commit()
-        return True
-    except sqlite3.Error:
-        return False
+def add_file(file_list):  # 添加新文件，如果已存在则覆盖；已被删除的旧版本不登记，返回这些文件名，出错时返回False
+    accepted = []
+    rejected = []
 
-def lock_S(serverid, filename):  # 给定文件名和所在服务器，获取共享锁
+    def job(cursor):
+        for filename, serverid, lastmodified, filehash in file_list:
+            cursor.execute('select deleted from tombstones where filename = ?;', (filename, ))
+            tombstone = cursor.fetchone()
+            if tombstone is not None:
+                if tombstone[0] >= lastmodified:  # 删除发生在这个版本之后，例如错过删除的服务器重新加入
+                    rejected.append(filename)
+                    continue
+                cursor.execute('delete from tombstones where filename = ?;', (filename, ))  # 删除之后又写入了新版本
+            accepted.append((filename, serverid, lastmodified, filehash))
+        cursor.executemany('insert or replace into files (filename, serverid, lastmodified, filehash) \
+values (?, ?, ?, ?)', accepted)
     try:
-        cursor.execute('update files set S_lock = S_lock + 1 where serverid = ? and filename = ?;', (serverid, filename))
-        connection.commit()
-        return True
+        committer.submit(job, on_commit=lambda: changelog.record(*[['file', serverid, filename, lastmodified, filehash]
+                                                                   for filename, serverid, lastmodified, filehash in accepted]))
+        return rejected
     except sqlite3.Error:
         return False
 
-def unlock_S(serverid, filename):  # 给定文件名和所在服务器，归还共享锁
-    try:
-        cursor.execute('update files set S_lock = S_lock - 1 where serverid = ? and filename = ?;', (serverid, filename))
-        connection.commit()
-        return True
-    except sqlite3.Error:
-        return False
-    
-def lock_X(serverid, filename):  # 给定文件名和所在服务器，获取排他锁
+def add_tombstone(filename, deleted):  # 客户端删除文件时记录删除时间（客户端的时钟，与文件的修改时间可比）
     try:
-        cursor.execute('update files set X_lock = X_lock + 1 where serverid = ? and filename = ?;', (serverid, filename))
-        connection.commit()
+        committer.submit(lambda cursor: cursor.execute('insert or replace into tombstones (filename, deleted) values \
+(?, max(?, coalesce((select deleted from tombstones where filename = ?), 0)));', (filename, deleted, filename)))
         return True
     except sqlite3.Error:
         return False
 
-def unlock_X(serverid, filename):  # 给定文件名和所在服务器，归还排他锁
-    try:
-        cursor.execute('update files set X_lock = X_lock - 1 where serverid = ? and filename = ?;', (serverid, filename))
-        connection.commit()
-        return True
-    except sqlite3.Error:
-        return False
+class LockEntry(object):  # 一个文件上的锁：当前持有者和排队的请求
+    def __init__(self, mutex):
+        self.holders = {}  # lease_id -> [mode, 过期时间]
+        self.waiters = collections.deque()  # 排队的请求[mode, lease_id]，授予后填入lease_id
+        self.cond = threading.Condition(mutex)
+
+class LockManager(object):  # 内存中的锁表，以(serverid, filename)为键，锁的获取和归还只是字典操作，不再写sqlite
+    def __init__(self, lease_time):
+        self.lease_time = lease_time
+        self.mutex = threading.Lock()
+        self.table = {}  # (serverid, filename) -> LockEntry
+        self.leases = {}  # lease_id -> (serverid, filename)
+
+    def grant(self, entry):  # 按FIFO顺序授予队首的请求，调用者需持有mutex
+        granted = False
+        while entry.waiters:
+            request = entry.waiters[0]
+            modes = [mode for mode, _ in entry.holders.values()]
+            # 排他锁要求没有持有者；共享锁要求没有排他锁持有者。
+            # 队首是写者时，后到的读者也只能排在它后面，避免写者饿死
+            if modes and (request[0] == 'X' or 'X' in modes):
+                break
+            entry.waiters.popleft()
+            lease_id = uuid.uuid4().hex
+            entry.holders[lease_id] = [request[0], time.time() + self.lease_time]
+            request[1] = lease_id
+            granted = True
+        if granted:
+            entry.cond.notify_all()
+
+    def expire(self, entry):  # 回收已过期的租约，防止崩溃的客户端一直占着锁
+        now = time.time()
+        expired = [lease_id for lease_id, (_, expire) in entry.holders.items() if expire <= now]
+        for lease_id in expired:
+            del entry.holders[lease_id]
+            self.leases.pop(lease_id, None)
+        if expired:
+            self.grant(entry)
+
+    def cleanup(self, key, entry):  # 文件上没有锁也没有等待者时，从锁表中移除
+        if not entry.holders and not entry.waiters:
+            del self.table[key]
+
+    def acquire(self, key, mode, timeout):
+        deadline = time.time() + timeout
+        with self.mutex:
+            entry = self.table.get(key)
+            if entry is None:
+                entry = self.table[key] = LockEntry(self.mutex)
+            self.expire(entry)
+            request = [mode, None]
+            entry.waiters.append(request)
+            self.grant(entry)
+            while request[1] is None:
+                now = time.time()
+                if now >= deadline:
+                    entry.waiters.remove(request)
+                    self.grant(entry)  # 队首的写者放弃后，排在后面的读者可能可以获得锁
+                    self.cleanup(key, entry)
+                    return ''
+                # 最迟在当前持有者的租约到期时醒来检查
+                wait = min([deadline] + [expire for _, expire in entry.holders.values()]) - now
+                entry.cond.wait(max(0, wait))
+                self.expire(entry)
+            self.leases[request[1]] = key
+            return request[1]
+
+    def renew(self, lease_id):
+        with self.mutex:
+            key = self.leases.get(lease_id)
+            if key is None:
+                return False
+            self.table[key].holders[lease_id][1] = time.time() + self.lease_time
+            return True
+
+    def release(self, lease_id):
+        with self.mutex:
+            key = self.leases.pop(lease_id, None)
+            if key is None:
+                return False
+            entry = self.table[key]
+            del entry.holders[lease_id]
+            self.grant(entry)
+            self.cleanup(key, entry)
+            return True
+
+    def counts(self, key):  # 返回共享锁和排他锁的数量
+        with self.mutex:
+            entry = self.table.get(key)
+            if entry is None:
+                return [0, 0]
+            self.expire(entry)
+            modes = [mode for mode, _ in entry.holders.values()]
+            return [modes.count('S'), modes.count('X')]
+
+locks = LockManager(lock_lease_time)
+
+def acquire_lock(serverid, filename, mode, timeout):  # 阻塞获取共享锁(S)或排他锁(X)，成功返回租约id，超时返回空字符串
+    with metrics.section('lock_wait'):
+        return locks.acquire((serverid, filename), mode, timeout)
+
+def renew_lock(lease_id):  # 续约，延长锁的有效期
+    return locks.renew(lease_id)
+
+def release_lock(lease_id):  # 归还租约对应的锁
+    return locks.release(lease_id)
 
 def get_lock(serverid, filename):  # 给定文件名和所在服务器，返回共享锁和排他锁的情况
-    try:
-        cursor.execute('select S_lock, X_lock from files where serverid = ? and filename = ?;', (serverid, filename))
-        res = cursor.fetchone()
-        return res
-    except sqlite3.Error:
-        return None
+    return locks.counts((serverid, filename))
 
 def get_user_info(username):  # 获取用户信息
     try:
-        cursor.execute('select password, salt from users where username = ?;', (username, ))
-        res = cursor.fetchone()
+        with pool.cursor() as cursor:
+            cursor.execute('select password, salt from users where username = ?;', (username, ))
+            res = cursor.fetchone()
         return res
     except sqlite3.Error:
         return None
 
 def get_server_info():  # 获取所有服务器信息
     try:
-        cursor.execute('select serverid, address from servers;')
-        res = cursor.fetchall()
+        with pool.cursor() as cursor:
+            cursor.execute('select serverid, address from servers;')
+            res = cursor.fetchall()
         return res
     except sqlite3.Error:
         return []
 
 def get_server_id(address):  # 输入服务器地址，返回服务器id
     try:
-        cursor.execute('select serverid from servers where address = ?', (address, ))
-        res = cursor.fetchone()
+        with pool.cursor() as cursor:
+            cursor.execute('select serverid from servers where address = ?', (address, ))
+            res = cursor.fetchone()
         return res
     except sqlite3.Error:
         return []
     
 def get_server_address(serverid):  # 输入服务器id，返回服务器地址
     try:
-        cursor.execute('select address from servers where serverid = ?;', (serverid, ))
-        res = cursor.fetchone()
+        with pool.cursor() as cursor:
+            cursor.execute('select address from servers where serverid = ?;', (serverid, ))
+            res = cursor.fetchone()
         return res
     except sqlite3.Error:
         return []
 
 def get_all_server_addresses():  # 获取所有服务器的地址
     try:
-        cursor.execute('select address from servers')
-        res = cursor.fetchall()
+        with pool.cursor() as cursor:
+            cursor.execute('select address from servers')
+            res = cursor.fetchall()
         return [address for (address, ) in res]
     except sqlite3.Error:
         return []
 
 def get_file_infos(serverid):  # 输入服务器id，获取该服务器的所有文件信息
     try:
-        cursor.execute('select filename, serverid, lastmodified, filehash from files\
-                        where serverid = ?;', (serverid, ))
-        res = cursor.fetchall()
+        with pool.cursor() as cursor:
+            cursor.execute('select filename, serverid, lastmodified, filehash from files\
+                            where serverid = ?;', (serverid, ))
+            res = cursor.fetchall()
         return res
     except sqlite3.Error:
         return []
 
 def get_one_file_hash(serverid, filename):  # 给定服务器id和文件名，返回文件哈希值
     try:
-        cursor.execute('select filehash from files where serverid = ? and filename = ?;', (serverid, filename))
-        res = cursor.fetchone()
+        with pool.cursor() as cursor:
+            cursor.execute('select filehash from files where serverid = ? and filename = ?;', (serverid, filename))
+            res = cursor.fetchone()
         return res
     except sqlite3.Error:
         return []
 
+def prefix_range(prefix):  # 前缀匹配转为主键上的范围查询
+    return 'filename >= ? and filename < ?', (prefix, prefix + '\U0010ffff')
+
+def where(conditions):
+    return 'where ' + ' and '.join(conditions) if conditions else ''
+
+def list_files(after=None, limit=list_page_size, serverid=None, prefix=None):  # 按(文件名, 服务器id)顺序分页列出文件
+    # after是上一页返回的游标，返回{'files': [[filename, serverid, lastmodified, filehash], ...], 'cursor': 下一页的游标}
+    # 游标为None表示已经是最后一页
+    conditions = []
+    params = []
+    if serverid is not None:
+        conditions.append('serverid = ?')
+        params.append(serverid)
+        if after is not None:
+            conditions.append('filename > ?')
+            params.append(after[0])
+    elif after is not None:
+        conditions.append('(filename, serverid) > (?, ?)')
+        params.extend(after)
+    if prefix:
+        condition, values = prefix_range(prefix)
+        conditions.append(condition)
+        params.extend(values)
+    limit = max(1, min(limit, list_page_size))
+    try:
+        with pool.cursor() as cursor:
+            cursor.execute('select filename, serverid, lastmodified, filehash from files {}\
+                            order by filename, serverid limit ?;'.format(where(conditions)), params + [limit])
+            res = cursor.fetchall()
+    except sqlite3.Error:
+        return {'files': [], 'cursor': None}
+    return {'files': res, 'cursor': list(res[-1][:2]) if len(res) == limit else None}
+
+def list_latest(after=None, limit=list_page_size, prefix=None):  # 按文件名分页列出每个文件的最新版本
+    # 返回{'files': [[filename, lastmodified, filehash, 持有最新版本的副本数], ...], 'cursor': 下一页的游标}
+    conditions = []
+    params = []
+    if after is not None:
+        conditions.append('filename > ?')
+        params.append(after)
+    if prefix:
+        condition, values = prefix_range(prefix)
+        conditions.append(condition)
+        params.extend(values)
+    limit = max(1, min(limit, list_page_size))
+    try:
+        with pool.cursor() as cursor:
+            # max()聚合时，sqlite中的其他列取自最大值所在的行；按主键顺序分组，不需要排序
+            # 副本数在同一条语句中按主键连接统计，一页只执行一次查询
+            cursor.execute('with latest as (select filename, max(lastmodified) as lastmodified, filehash from files {}\
+                            group by filename order by filename limit ?)\
+                            select l.filename, l.lastmodified, l.filehash, count(*) from latest l\
+                            join files f on f.filename = l.filename and f.filehash = l.filehash\
+                            group by l.filename order by l.filename;'.format(where(conditions)), params + [limit])
+            res = [list(row) for row in cursor.fetchall()]
+    except sqlite3.Error:
+        return {'files': [], 'cursor': None}
+    return {'files': res, 'cursor': res[-1][0] if len(res) == limit else None}
+
+def get_changes(epoch, version):  # 返回自version以来的元数据变更，客户端缓存过旧时返回完整快照的第一页
+    current, changes = changelog.since(epoch, version)
+    if changes is not None:
+        return {'epoch': changelog.epoch, 'version': current, 'reset': False, 'changes': changes}
+    # 先取版本号再读快照，快照之后才记录的变更会在下次刷新时重放，重放是幂等的
+    # 快照的其余部分由客户端用list_files从cursor开始分页拉取，文件信息的格式与list_files相同
+    try:
+        with pool.cursor() as cursor:
+            cursor.execute('select serverid, address from servers;')
+            servers = cursor.fetchall()
+    except sqlite3.Error:
+        servers = []
+    page = list_files()
+    return {'epoch': changelog.epoch, 'version': current, 'reset': True, 'servers': servers,
+            'files': page['files'], 'cursor': page['cursor']}
+
+def report_load(serverid, inflight):  # 文件服务器定期上报正在处理的请求数
+    server_stats.report_load(serverid, inflight)
+    return True
+
+def report_latency(samples):  # 客户端上报读延迟样本[[serverid, 秒], ...]
+    server_stats.report_latency(samples)
+    return True
+
+def get_server_stats():  # 返回每个文件服务器的负载和延迟
+    return server_stats.snapshot()
+
+def get_ring():  # 返回一致性哈希环的参数，客户端据此在本地计算文件的放置位置
+    return {'vnodes': ring_vnodes, 'replication_factor': replication_factor, 'write_quorum': write_quorum}
+
+rebalance_event = threading.Event()
+
+def rebalance_file(filename, holders, servers, ring):  # 把一个文件复制到应在的服务器上，成功后删除多余的副本
+    lastmodified, filehash = max(holders.values())  # 最新版本
+    source = servers[next(serverid for serverid, info in holders.items() if info[1] == filehash)]
+    targets = ring.lookup(filename, replication_factor)
+    complete = True
+    for target in targets:
+        if holders.get(target, (None, None))[1] == filehash:
+            continue
+        lease = locks.acquire((target, filename), 'X', lock_wait_timeout)
+        if not lease:
+            complete = False
+            continue
+        try:
+            with connect(source) as server_proxy:
+                back = server_proxy.replicate_to(filename, servers[target])
+            if back != 'success' or add_file([(filename, target, lastmodified, filehash)]) != []:
+                complete = False
+        except Exception:
+            complete = False
+        finally:
+            locks.release(lease)
+    if not complete:  # 副本数还不够时保留多余的副本
+        return
+    for extra in set(holders) - set(targets):
+        lease = locks.acquire((extra, filename), 'X', lock_wait_timeout)
+        if not lease:
+            continue
+        try:
+            with connect(servers[extra]) as server_proxy:
+                if server_proxy.remove_file(filename) == 'success':
+                    delete_file(extra, filename)
+        except Exception:
+            pass
+        finally:
+            locks.release(lease)
+
+def rebalance_loop():  # 后台线程：服务器加入或离开后，在后台按哈希环重新分布文件
+    while True:
+        rebalance_event.wait()
+        time.sleep(rebalance_delay)  # 等待新服务器登记完已有的文件，并合并短时间内的多次变化
+        rebalance_event.clear()
+        files = {}  # filename -> {serverid: (lastmodified, filehash)}
+        try:
+            with pool.cursor() as cursor:
+                # 服务器、文件和删除记录在同一个读事务中读取，互相一致
+                cursor.execute('begin;')
+                try:
+                    cursor.execute('select serverid, address from servers;')
+                    servers = dict(cursor.fetchall())
+                    cursor.execute('select filename, serverid, lastmodified, filehash from files;')
+                    rows = cursor.fetchall()
+                    cursor.execute('select filename, deleted from tombstones;')
+                    tombstones = dict(cursor.fetchall())
+                finally:
+                    cursor.execute('commit;')
+        except sqlite3.Error:
+            continue
+        if not servers:
+            continue
+        ring = HashRing(servers, ring_vnodes)
+        for filename, serverid, lastmodified, filehash in rows:
+            if serverid in servers:
+                files.setdefault(filename, {})[serverid] = (lastmodified, filehash)
+        for filename, holders in files.items():
+            if tombstones.get(filename, -1) >= max(holders.values())[0]:  # 已被删除，剩下的是没删掉的旧版本
+                continue
+            try:
+                rebalance_file(filename, holders, servers, ring)
+            except Exception as e:  # 一个文件出错不能让迁移线程退出
+                print('Failed to rebalance {}: {}'.format(filename, e))
+
 def delete_file(serverid, filename):  # 给定服务器id和文件名，删除该文件
     try:
-        cursor.execute('delete from files where serverid = ? and filename = ?;', (serverid, filename))
-        connection.commit()
+        committer.submit(lambda cursor: cursor.execute('delete from files where serverid = ? and filename = ?;',
+                                                       (serverid, filename)),
+                         on_commit=lambda: changelog.record(['file', serverid, filename, None, None]))
         return True
     except sqlite3.Error:
         return False
 
 
-
-
 if __name__ == '__main__':
-    server_counter = 0
-    connection = sqlite3.connect('info.db')
-    cursor = connection.cursor()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', help='Number of sqlite worker connections.', type=int, default=db_workers)
+    parser.add_argument('--binary-port', help='Port of the binary protocol.', type=int, default=database_binary_port)
+    args = parser.parse_args()
+
     init_db()
-    with SimpleXMLRPCServer(database_info, allow_none=True) as server:
+    pool = ConnectionPool(args.workers)  # 读操作的连接池
+    committer = GroupCommitter(group_commit_size)  # 写操作统一交给组提交线程
+    changelog = ChangeLog(changelog_size)
+    server_stats = ServerStats(latency_ewma_alpha)
+    threading.Thread(target=rebalance_loop, daemon=True).start()
+    with ThreadedXMLRPCServer(database_info, requestHandler=KeepAliveRequestHandler, allow_none=True) as server:
         # 创建一个XML-RPC服务器，并注册多个函数来处理远程调用请求
         server.register_function(add_user)
         server.register_function(add_server)
         server.register_function(add_file)
         server.register_function(delete_server)
         server.register_function(delete_file)
+        server.register_function(add_tombstone)
         server.register_function(get_user_info)
         server.register_function(get_file_infos)
         server.register_function(get_all_server_addresses)
@@ -199,13 +621,23 @@ if __name__ == '__main__':
         server.register_function(get_one_file_hash)
         server.register_function(get_server_info)
         server.register_function(get_lock)
-        server.register_function(lock_S)
-        server.register_function(unlock_S)
-        server.register_function(lock_X)
-        server.register_function(unlock_X)
+        server.register_function(acquire_lock)
+        server.register_function(renew_lock)
+        server.register_function(release_lock)
+        server.register_function(list_files)
+        server.register_function(list_latest)
+        server.register_function(get_changes)
+        server.register_function(report_load)
+        server.register_function(report_latency)
+        server.register_function(get_server_stats)
+        server.register_function(get_ring)
+        server.register_function(get_stats)
+        server.register_function(set_profiling)
+        server.register_function(get_profile)
+        server.register_multicall_functions()  # 支持system.multicall，一次请求执行多个加锁和元数据操作
+        serve_binary(server, args.binary_port)  # 同一组函数也通过二进制协议提供
         try:
             print('Welcome to Tangzhj\'s database.')
             server.serve_forever()  # 启动服务器并开始监听端口上的请求
         except KeyboardInterrupt:
             print('Good bye.')
-            connection.close()
@@ -0,0 +1,109 @@
+import hashlib
+import itertools
+import mmap
+import os
+import struct
+
+MOD = 1 << 16
+RECORD = struct.Struct('>I16s')  # 每个块的弱校验和（4字节）与强校验和（md5，16字节）
+
+
+def weak_checksum(block):  # rsync的滚动校验和，返回(a, b)
+    a = sum(block) % MOD
+    b = sum(itertools.accumulate(block)) % MOD  # 等于sum((len - i) * block[i])
+    return a, b
+
+def strong_checksum(block):
+    return hashlib.md5(block).digest()
+
+def block_checksums(f, block_size):  # 计算文件对象中每个块的校验和，打包成字节串
+    records = []
+    for block in iter(lambda: f.read(block_size), b''):
+        a, b = weak_checksum(block)
+        records.append(RECORD.pack((b << 16) | a, strong_checksum(block)))
+    return b''.join(records)
+
+def unpack_checksums(blob):  # block_checksums的逆操作，返回[(weak, strong), ...]
+    return [RECORD.unpack_from(blob, offset) for offset in range(0, len(blob), RECORD.size)]
+
+def checksum_table(checksums):  # 弱校验和 -> {强校验和: 块序号}
+    table = {}
+    for index, (weak, strong) in enumerate(checksums):
+        table.setdefault(weak, {}).setdefault(strong, index)
+    return table
+
+def sample_matches(path, checksums, block_size, samples):
+    # 在文件中均匀取samples处，每处滑动一个块长的距离查找服务器上已有的块，返回找到的比例，用来估计增量上传能复用多少
+    table = checksum_table(checksums)
+    size = os.path.getsize(path)
+    if size < block_size * 2 or not table:
+        return 0.0
+    hits = 0
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        for i in range(samples):
+            start = (size - block_size * 2) * i // max(1, samples - 1)
+            a, b = weak_checksum(data[start:start + block_size])
+            for pos in range(start, start + block_size + 1):
+                candidates = table.get((b << 16) | a)
+                if candidates and strong_checksum(data[pos:pos + block_size]) in candidates:
+                    hits += 1
+                    break
+                if pos < start + block_size:
+                    out, new = data[pos], data[pos + block_size]
+                    a = (a - out + new) % MOD
+                    b = (b - block_size * out + a) % MOD
+    return hits / samples
+
+def compute_delta(path, checksums, base_size, block_size, max_literal):
+    # 生成增量指令：int表示复用服务器上对应序号的块，bytes表示需要发送的新数据
+    table = checksum_table(checksums)
+    last_index = len(checksums) - 1
+    size = os.path.getsize(path)
+    if size == 0:
+        return
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        literal_start = pos = 0
+        if size >= block_size:
+            a, b = weak_checksum(data[0:block_size])
+        while pos + block_size <= size:
+            candidates = table.get((b << 16) | a)
+            if candidates:
+                index = candidates.get(strong_checksum(data[pos:pos + block_size]))
+                if index is not None:
+                    if literal_start < pos:
+                        yield data[literal_start:pos]
+                    yield index
+                    pos += block_size
+                    literal_start = pos
+                    if pos + block_size <= size:
+                        a, b = weak_checksum(data[pos:pos + block_size])
+                    continue
+            if pos + block_size < size:  # 窗口向后滚动一个字节
+                out, new = data[pos], data[pos + block_size]
+                a = (a - out + new) % MOD
+                b = (b - block_size * out + a) % MOD
+            pos += 1
+            if pos - literal_start >= max_literal:
+                yield data[literal_start:pos]
+                literal_start = pos
+        # 服务器文件的最后一块可能不足block_size，单独尝试匹配文件末尾
+        tail = data[literal_start:size]
+        last_size = base_size - last_index * block_size
+        if tail and 0 < last_size < block_size and len(tail) >= last_size:
+            piece = tail[len(tail) - last_size:]
+            a, b = weak_checksum(piece)
+            if ((b << 16) | a, strong_checksum(piece)) == tuple(checksums[last_index]):
+                if len(tail) > last_size:
+                    yield tail[:len(tail) - last_size]
+                yield last_index
+                return
+        if tail:
+            yield tail
+
+def apply_delta(base, out, instructions, block_size):  # 用服务器上的旧文件base和增量指令重建文件，写入out
+    for item in instructions:
+        if isinstance(item, int):
+            base.seek(item * block_size)
+            out.write(base.read(block_size))
+        else:
+            out.write(item)
@@ -0,0 +1,24 @@
+import bisect
+import hashlib
+
+
+def ring_hash(key):
+    return int(hashlib.md5(key.encode()).hexdigest()[:16], 16)
+
+class HashRing(object):  # 带虚拟节点的一致性哈希环，决定每个文件放在哪几个服务器上
+    def __init__(self, serverids, vnodes):
+        self.ring = sorted((ring_hash('{}#{}'.format(serverid, i)), serverid)
+                           for serverid in serverids for i in range(vnodes))
+        self.keys = [key for key, _ in self.ring]
+        self.count = len(set(serverids))
+
+    def lookup(self, filename, replicas):  # 从文件名的哈希位置顺时针找replicas个不同的服务器
+        res = []
+        start = bisect.bisect(self.keys, ring_hash(filename))
+        for i in range(len(self.ring)):
+            serverid = self.ring[(start + i) % len(self.ring)][1]
+            if serverid not in res:
+                res.append(serverid)
+                if len(res) == min(replicas, self.count):
+                    break
+        return res
@@ -0,0 +1,53 @@
+import hashlib
+from hashring import ring_hash
+
+FANOUT = 16  # 每个内部节点的子节点数
+EMPTY = hashlib.sha256(b'').hexdigest()
+
+
+def leaf_hash(entries):  # 叶子的哈希值只取决于其中的(文件名, sha256)
+    sha256 = hashlib.sha256()
+    for name in sorted(entries):
+        sha256.update('{}\0{}\n'.format(name, entries[name][0]).encode())
+    return sha256.hexdigest()
+
+class MerkleTree(object):  # 固定形状的Merkle树：文件按文件名的哈希分到叶子上，两个服务器上同一位置的节点覆盖同一批文件名
+    def __init__(self, depth):
+        self.depth = depth
+        self.leaves = [{} for _ in range(FANOUT ** depth)]  # 叶子 -> {filename: [filehash, lastmodified]}
+        self.levels = [[EMPTY] * FANOUT ** level for level in range(depth + 1)]  # levels[0]是根，levels[depth]是叶子
+        self.dirty = set()  # 哈希值需要重新计算的叶子
+
+    def leaf(self, name):
+        return ring_hash(name) % len(self.leaves)
+
+    def put(self, name, filehash, lastmodified):
+        index = self.leaf(name)
+        self.leaves[index][name] = [filehash, lastmodified]
+        self.dirty.add(index)
+
+    def remove(self, name):
+        index = self.leaf(name)
+        if self.leaves[index].pop(name, None) is not None:
+            self.dirty.add(index)
+
+    def refresh(self):  # 只重新计算修改过的叶子到根路径上的节点
+        nodes = self.dirty
+        self.dirty = set()
+        for index in nodes:
+            self.levels[self.depth][index] = leaf_hash(self.leaves[index]) if self.leaves[index] else EMPTY
+        for level in range(self.depth, 0, -1):
+            nodes = {index // FANOUT for index in nodes}
+            for index in nodes:
+                children = self.levels[level][index * FANOUT:(index + 1) * FANOUT]
+                if children.count(EMPTY) == FANOUT:  # 空子树的哈希值与是否曾经有过文件无关
+                    self.levels[level - 1][index] = EMPTY
+                else:
+                    self.levels[level - 1][index] = hashlib.sha256(''.join(children).encode()).hexdigest()
+
+    def nodes(self, level, indices):  # 第level层上给定节点的哈希值
+        self.refresh()
+        return [self.levels[level][index] for index in indices]
+
+    def entries(self, indices):  # 给定叶子中的文件[[filename, filehash, lastmodified], ...]
+        return [[name] + info for index in indices for name, info in self.leaves[index].items()]
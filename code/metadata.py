@@ -0,0 +1,119 @@
+import random
+from hashring import HashRing
+from config import latency_ewma_alpha, latency_floor
+
+
+class MetadataCache(object):  # 客户端元数据缓存：服务器拓扑以及每个文件的修改时间和哈希值
+    def __init__(self):  # 由客户端拉取get_changes的结果后调用apply
+        self.epoch = ''
+        self.version = 0
+        self.servers = {}  # serverid -> address
+        self.files = {}  # filename -> {serverid: (lastmodified, filehash)}
+        self.by_server = {}  # serverid -> {filename, ...}，服务器下线时据此删除它的文件信息
+        self.ring_params = None  # 数据库上一致性哈希环的参数
+        self.ring = None
+
+    def apply(self, res):  # 应用get_changes的结果，完整快照的第一页之后的部分由调用者用add_files补上
+        if res['reset']:  # 缓存过旧，整体替换；哈希环的参数是静态配置，不随之清空
+            self.servers = {serverid: address for serverid, address in res['servers']}
+            self.files = {}
+            self.by_server = {}
+            self.add_files(res['files'])
+        else:
+            for change in res['changes']:
+                if change[0] == 'server':
+                    _, serverid, address = change
+                    if address is None:  # 服务器下线，一并删除其文件信息
+                        self.servers.pop(serverid, None)
+                        for filename in self.by_server.pop(serverid, ()):
+                            self.drop(serverid, filename)
+                    else:
+                        self.servers[serverid] = address
+                else:
+                    _, serverid, filename, lastmodified, filehash = change
+                    if filehash is None:
+                        self.drop(serverid, filename)
+                        self.by_server.get(serverid, set()).discard(filename)
+                    else:
+                        self.put(serverid, filename, lastmodified, filehash)
+        self.epoch = res['epoch']
+        self.version = res['version']
+
+    def add_files(self, rows):  # 添加快照中的一页[[filename, serverid, lastmodified, filehash], ...]
+        for filename, serverid, lastmodified, filehash in rows:
+            self.put(serverid, filename, lastmodified, filehash)
+
+    def put(self, serverid, filename, lastmodified, filehash):
+        self.files.setdefault(filename, {})[serverid] = (lastmodified, filehash)
+        self.by_server.setdefault(serverid, set()).add(filename)
+
+    def drop(self, serverid, filename):
+        holders = self.files.get(filename)
+        if holders is not None:
+            holders.pop(serverid, None)
+            if not holders:
+                del self.files[filename]
+
+    def server_info(self):
+        return sorted(self.servers.items())
+
+    def file_hash(self, serverid, filename):
+        info = self.files.get(filename, {}).get(serverid)
+        return None if info is None else info[1]
+
+    def latest_hash(self, filename):  # 最近一次修改的副本的哈希值，即最新版本
+        holders = self.files.get(filename)
+        return max(holders.values())[1] if holders else None
+
+    def holders(self, filename):  # 持有该文件（任意版本）的服务器[(serverid, address), ...]
+        holders = self.files.get(filename, {})
+        return [(serverid, self.servers[serverid]) for serverid in sorted(holders) if serverid in self.servers]
+
+    def placement(self, filename):  # 按一致性哈希环计算文件应存放的服务器[(serverid, address), ...]，调用者需先设置ring_params
+        if self.ring is None or self.ring[0] != set(self.servers):
+            self.ring = (set(self.servers), HashRing(self.servers, self.ring_params['vnodes']))
+        return [(serverid, self.servers[serverid])
+                for serverid in self.ring[1].lookup(filename, self.ring_params['replication_factor'])]
+
+    def replicas(self, filename):  # 持有最新版本的副本[(serverid, address), ...]
+        latest = self.latest_hash(filename)
+        return [(serverid, address) for serverid, address in self.holders(filename)
+                if self.file_hash(serverid, filename) == latest]
+
+class ReplicaSelector(object):  # 根据负载和延迟选择读副本（power of two choices）
+    def __init__(self):
+        self.inflight = {}  # serverid -> 文件服务器上报的正在处理的请求数
+        self.latency = {}  # serverid -> 读延迟EWMA（秒），来自数据库汇总的统计和本地观测
+        self.samples = []  # 还没有上报给数据库的延迟样本
+
+    def update_stats(self, stats):
+        for serverid, inflight, latency in stats:
+            if inflight is not None:
+                self.inflight[serverid] = inflight
+            if latency is not None:
+                self.latency[serverid] = latency
+
+    def record(self, serverid, latency):
+        old = self.latency.get(serverid)
+        self.latency[serverid] = latency if old is None else old + latency_ewma_alpha * (latency - old)
+        self.samples.append([serverid, latency])
+
+    def take_samples(self):
+        samples, self.samples = self.samples, []
+        return samples
+
+    def score(self, serverid):  # 分数越低越好：排队的请求越多、延迟越大，分数越高
+        known = list(self.latency.values())
+        latency = self.latency.get(serverid, sum(known) / len(known) if known else 0)
+        # 低于latency_floor的延迟差异视为噪声，此时只按负载比较
+        return (self.inflight.get(serverid, 0) + 1) * max(latency, latency_floor)
+
+    def order(self, replicas):  # 随机取两个副本，较好的排在最前，其余按分数排列作为故障转移的候选
+        replicas = list(replicas)
+        if len(replicas) < 2:
+            return replicas
+        pair = sorted(random.sample(replicas, 2), key=lambda replica: self.score(replica[0]))
+        # 分数相差不大时随机选一个，避免延迟的微小差异让所有读请求都落到同一个副本
+        first = pair[0] if self.score(pair[0][0]) * 1.25 < self.score(pair[1][0]) else random.choice(pair)
+        return [first] + sorted((replica for replica in replicas if replica != first),
+                                key=lambda replica: self.score(replica[0]))
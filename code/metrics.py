@@ -0,0 +1,173 @@
+import contextlib
+import cProfile
+import io
+import pstats
+import threading
+import time
+
+BUCKETS = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]  # 延迟直方图的上界（秒）
+
+
+class MethodStats(object):  # 一个RPC方法的统计
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.time = 0.0  # 执行函数本身的总时间
+        self.max = 0.0
+        self.histogram = [0] * (len(BUCKETS) + 1)  # 最后一格是超过最大上界的调用
+        self.requests = 0  # 作为顶层请求（而不是multicall中的子调用）的次数
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.serialize = 0.0  # 解析请求和编码响应的总时间
+        self.sections = {}  # 函数内各阶段（sql、等锁、哈希等）的总时间
+
+    def snapshot(self):  # xmlrpc的int只有32位，字节数用float表示
+        return {'calls': self.calls, 'errors': self.errors, 'time_ms': self.time * 1000, 'max_ms': self.max * 1000,
+                'histogram': self.histogram, 'requests': self.requests, 'bytes_in': float(self.bytes_in),
+                'bytes_out': float(self.bytes_out), 'serialize_ms': self.serialize * 1000,
+                'sections_ms': {name: seconds * 1000 for name, seconds in self.sections.items()}}
+
+
+class Metrics(object):  # 进程内所有RPC的统计，每次调用只多一次加锁和几次计时
+    def __init__(self):
+        self.mutex = threading.Lock()
+        self.methods = {}  # 方法名 -> MethodStats
+        self.started = time.time()
+        self.local = threading.local()  # 当前线程正在处理的请求
+        self.profiling = False
+        self.profile = None  # 开启剖析以来累积的pstats.Stats
+        self.profile_lock = threading.Lock()  # 正在剖析的请求持有
+        self.gauges = {}  # 名称 -> 返回当前计数的函数，例如文件服务器读缓存的命中统计
+
+    def method(self, name):  # 调用者需持有mutex
+        stats = self.methods.get(name)
+        if stats is None:
+            stats = self.methods[name] = MethodStats()
+        return stats
+
+    def record_call(self, name, elapsed, error, sections):
+        with self.mutex:
+            stats = self.method(name)
+            stats.calls += 1
+            stats.errors += error
+            stats.time += elapsed
+            stats.max = max(stats.max, elapsed)
+            index = 0
+            while index < len(BUCKETS) and elapsed > BUCKETS[index]:
+                index += 1
+            stats.histogram[index] += 1
+            for section, seconds in sections.items():
+                stats.sections[section] = stats.sections.get(section, 0.0) + seconds
+
+    def record_request(self, name, bytes_in, bytes_out, serialize):
+        with self.mutex:
+            stats = self.method(name)
+            stats.requests += 1
+            stats.bytes_in += bytes_in
+            stats.bytes_out += bytes_out
+            stats.serialize += serialize
+
+    @contextlib.contextmanager
+    def section(self, name):  # 把一段代码的耗时记到当前RPC的name阶段上，不在RPC中时不记录
+        stack = getattr(self.local, 'stack', None)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if stack:
+                stack[-1][name] = stack[-1].get(name, 0.0) + time.perf_counter() - start
+
+    def run_profiled(self, func, *args):  # 剖析一个请求，结束后合并到累积结果中
+        # Python 3.12起一个进程中同时只能有一个剖析器在运行，同时到达的其他请求不剖析，相当于按请求抽样
+        if not self.profile_lock.acquire(blocking=False):
+            return func(*args)
+        try:
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:  # 调试器等其他剖析工具正在运行
+                return func(*args)
+            try:
+                return func(*args)
+            finally:
+                profile.disable()
+                with self.mutex:
+                    if self.profiling:
+                        if self.profile is None:
+                            self.profile = pstats.Stats(profile)
+                        else:
+                            self.profile.add(profile)
+        finally:
+            self.profile_lock.release()
+
+    def snapshot(self, reset):
+        gauges = {name: gauge() for name, gauge in self.gauges.items()}
+        with self.mutex:
+            res = {'uptime': time.time() - self.started, 'profiling': self.profiling,
+                   'buckets_ms': [bound * 1000 for bound in BUCKETS],
+                   'methods': {name: stats.snapshot() for name, stats in self.methods.items()}, 'gauges': gauges}
+            if reset:
+                self.methods = {}
+                self.started = time.time()
+            return res
+
+
+class MetricsMixin(object):  # 为SimpleXMLRPCServer上注册的每个函数记录统计，放在SimpleXMLRPCServer之前混入
+    def _marshaled_dispatch(self, data, dispatch_method=None, path=None):
+        local = metrics.local
+        local.method, local.handler = None, 0.0
+        start = time.perf_counter()
+        response = super()._marshaled_dispatch(data, dispatch_method, path)
+        # 整个请求的时间减去执行函数的时间，就是解析xml和编码响应的时间
+        metrics.record_request(local.method or '<invalid>', len(data), len(response),
+                               time.perf_counter() - start - local.handler)
+        return response
+
+    def _dispatch(self, method, params):
+        local = metrics.local
+        if not hasattr(local, 'stack'):
+            local.stack = []
+        top = not local.stack  # system.multicall中的子调用也会经过这里
+        if top:
+            local.method = method
+        local.stack.append({})
+        start = time.perf_counter()
+        error = False
+        try:
+            if top and metrics.profiling:
+                return metrics.run_profiled(super()._dispatch, method, params)
+            return super()._dispatch(method, params)
+        except BaseException:
+            error = True
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            sections = local.stack.pop()
+            if local.stack:  # 子调用的各阶段时间也计入multicall
+                for name, seconds in sections.items():
+                    local.stack[-1][name] = local.stack[-1].get(name, 0.0) + seconds
+            else:
+                local.handler = elapsed
+            metrics.record_call(method, elapsed, error, sections)
+
+
+def get_stats(reset=False):  # 返回每个RPC的调用次数、延迟直方图、字节数、序列化时间和各阶段时间
+    return metrics.snapshot(reset)
+
+def set_profiling(enabled):  # 开启或关闭cProfile剖析，开启时清空之前的结果
+    with metrics.mutex:
+        if enabled and not metrics.profiling:
+            metrics.profile = None
+        metrics.profiling = bool(enabled)
+    return metrics.profiling
+
+def get_profile(limit=30):  # 返回按累计时间排序的剖析结果文本
+    with metrics.mutex:
+        if metrics.profile is None:
+            return ''
+        out = io.StringIO()
+        metrics.profile.stream = out
+        metrics.profile.sort_stats('cumulative').print_stats(limit)
+        return out.getvalue()
+
+metrics = Metrics()
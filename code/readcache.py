@@ -0,0 +1,120 @@
+import collections
+import mmap
+import threading
+from xmlrpc.client import Binary
+
+
+def binary_view(data):  # 不复制数据地构造Binary，data可以是memoryview，两种协议编码时都直接读取它
+    value = Binary()
+    value.data = data
+    return value
+
+def cost(value):  # 缓存项占用的字节数
+    if isinstance(value, (list, tuple)):
+        return sum(len(item) for item in value)
+    return len(value)
+
+
+class CacheEntry(object):
+    def __init__(self, name, version, data, mapped):
+        self.name = name
+        self.version = version  # (修改时间, 大小)，文件被替换后不再匹配
+        self.data = data  # 原始内容的memoryview，较大的未压缩文件直接映射磁盘文件
+        self.mapped = mapped
+        self.derived = {}  # 由内容派生的结果（解码后的文本、压缩后的块），与内容一起失效
+        self.cost = len(data)
+
+
+class ReadCache(object):  # 文件服务器上的热点文件读缓存，按(文件名, 修改时间, 大小)缓存原始内容，超过容量时淘汰最久未用的
+    def __init__(self, store, capacity, max_file, mmap_threshold):
+        self.store = store
+        self.capacity = capacity  # 缓存内容和派生结果的总字节数上限
+        self.max_file = max_file  # 超过这个大小的文件不经过缓存
+        self.mmap_threshold = mmap_threshold  # 不小于这个大小且未压缩保存的文件用mmap映射，不读入内存
+        self.mutex = threading.Lock()
+        self.entries = collections.OrderedDict()  # name -> CacheEntry，越靠后越新
+        self.large = {}  # name -> 版本，太大而不经过缓存的文件，避免每次读取都重新判断
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes_served = 0  # 经过缓存返回给客户端的字节数
+        self.bytes_loaded = 0  # 未命中时从磁盘读取的字节数
+
+    def get(self, name):  # 返回文件的缓存项，文件太大不缓存时返回None，文件不存在时抛出OSError
+        version = self.store.version(name)
+        with self.mutex:
+            entry = self.entries.get(name)
+            if entry is not None and entry.version == version:
+                self.entries.move_to_end(name)
+                self.hits += 1
+                return entry
+            if self.large.get(name) == version:
+                return None
+        if self.store.stat(name)[0] > min(self.max_file, self.capacity):  # 按原始大小判断，压缩保存的文件磁盘上更小
+            with self.mutex:
+                self.large[name] = version
+            return None
+        with self.mutex:
+            self.misses += 1
+        path = self.store.raw_path(name)
+        if path is not None and version[1] >= self.mmap_threshold:
+            with open(path, 'rb') as f:
+                data = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+            entry = CacheEntry(name, version, data, True)
+        else:
+            with self.store.open(name) as f:
+                entry = CacheEntry(name, version, memoryview(f.read()), False)
+        with self.mutex:
+            self.bytes_loaded += len(entry.data)
+        if self.store.version(name) == version:  # 读取期间文件没有被替换，才放入缓存
+            with self.mutex:
+                self.remove(name)
+                self.entries[name] = entry
+                self.size += entry.cost
+                self.evict()
+        return entry
+
+    def derive(self, entry, key, func):  # 返回func(内容)，同一缓存项上算过的结果直接返回，结果的大小也计入缓存
+        value = entry.derived.get(key)
+        if value is not None:
+            return value
+        value = func(entry.data)
+        with self.mutex:
+            if key not in entry.derived:
+                entry.derived[key] = value
+                entry.cost += cost(value)
+                if self.entries.get(entry.name) is entry:  # 已被淘汰的缓存项不再计入
+                    self.size += cost(value)
+                    self.evict()
+        return value
+
+    def served(self, size):
+        with self.mutex:
+            self.bytes_served += size
+
+    def remove(self, name):  # 调用者需持有mutex
+        self.large.pop(name, None)
+        entry = self.entries.pop(name, None)
+        if entry is not None:
+            self.size -= entry.cost
+
+    def evict(self):  # 调用者需持有mutex
+        # 被淘汰的mmap不主动关闭，正在发送的memoryview切片释放后由垃圾回收关闭
+        while self.size > self.capacity and self.entries:
+            _, entry = self.entries.popitem(last=False)
+            self.size -= entry.cost
+            self.evictions += 1
+
+    def invalidate(self, name):  # 文件被写入或删除后丢弃缓存项
+        with self.mutex:
+            self.remove(name)
+
+    def snapshot(self):  # xmlrpc的int只有32位，字节数用float表示
+        with self.mutex:
+            lookups = self.hits + self.misses
+            return {'entries': len(self.entries), 'mapped': sum(entry.mapped for entry in self.entries.values()),
+                    'bytes': float(self.size), 'capacity': float(self.capacity), 'hits': self.hits,
+                    'misses': self.misses, 'hit_ratio': self.hits / lookups if lookups else 0.0,
+                    'evictions': self.evictions, 'bytes_served': float(self.bytes_served),
+                    'bytes_loaded': float(self.bytes_loaded)}
@@ -1,52 +1,249 @@
-import os
 from pathlib import Path
+import threading
+import time
 import hashlib
 import argparse
 from xmlrpc.server import SimpleXMLRPCServer
-from xmlrpc.client import ServerProxy
-from config import database_url
+from xmlrpc.client import Binary
+from socketserver import ThreadingMixIn
+from config import database_url, binary_port_offset, transfer_chunk_size, index_workers, register_batch_size, \
+    stats_report_interval, wire_codec, read_cache_size, read_cache_max_file, read_cache_mmap_threshold
+from storage import FileStore, ChunkStore, calculate_file_hash
+from compression import CODECS, compress, decompress
+from transport import connect, KeepAliveRequestHandler
+from binrpc import serve_binary, advertised_url
+from antientropy import AntiEntropy
+from readcache import ReadCache, binary_view
+from metrics import MetricsMixin, metrics, get_stats, set_profiling, get_profile
+import delta
 
 
-def mktxt(name, content):  # 写文件
-    path = root_dir / (name + '.txt')
+class ThreadedXMLRPCServer(ThreadingMixIn, MetricsMixin, SimpleXMLRPCServer):  # 多线程服务器，大文件传输时不阻塞其他请求
+    daemon_threads = True
+    inflight = 0  # 正在处理的请求数，定期上报给数据库用于读副本选择
+
+    def _dispatch(self, method, params):
+        with inflight_lock:
+            self.inflight += 1
+        try:
+            return super()._dispatch(method, params)
+        finally:
+            with inflight_lock:
+                self.inflight -= 1
+
+inflight_lock = threading.Lock()
+
+def report_load(server, server_id):  # 后台线程：定期把负载上报给数据库
+    with connect(database_url) as proxy:
+        while True:
+            try:
+                proxy.report_load(server_id, server.inflight)
+            except OSError:
+                pass
+            time.sleep(stats_report_interval)
+
+
+def file_changed(name):  # 文件被写入或删除后，丢弃读缓存并更新反熵的Merkle树
+    read_cache.invalidate(name)
+    anti_entropy.changed(name)
+
+def store_bytes(name, data):  # 把一段数据作为完整文件存入
+    part = upload_dir / name
+    part.write_bytes(data)
+    store.commit(name, part, hashlib.sha256(data).hexdigest())
+    file_changed(name)
+
+def mktxt(name, content, codec=None):  # 写文件，codec不为None时content是压缩后的Binary
     try:
-        with path.open(mode='w') as f:
-            # 写入数据
-            f.write(content)
+        store_bytes(name + '.txt', decompress(codec, content.data) if codec is not None else content.encode())
         return 'success'
     except:
         return ''
     
 def deltxt(name):  # 删除文件
-    path = root_dir / (name + '.txt')
     try:
-        path.unlink()
+        store.remove(name + '.txt')
     except FileNotFoundError:
         return 'Txt does not exist'
     except OSError as e:
         return 'An error occurred while deleting the txt'
+    file_changed(name + '.txt')
     return 'success'
 
 def print_cloud_filename():  # 获取云端服务器中所有文件名
-    res = []
-    for txt in root_dir.rglob('*'):
-        res.append(txt.name)
-    return res
+    return store.names()
 
-def get_txt_content(name):  # 获取txt文件内容
-    path = root_dir / name
+def get_txt_content(name, codec=None):  # 获取txt文件内容，codec不为None时返回[实际使用的算法, 压缩后的Binary]
     try:
-        content = path.read_text()
-        return content
+        entry = read_cache.get(name)
+        if entry is None:  # 文件太大，不经过缓存
+            with store.open(name) as f:
+                if codec is not None:
+                    used, data = compress(f.read(), codec)
+                    return [used, Binary(data)]
+                return f.read().decode()
+        read_cache.served(len(entry.data))
+        # 热点文件的解码结果和压缩结果也缓存起来，重复读取不再解码或压缩
+        if codec is not None:
+            used, data = read_cache.derive(entry, codec, lambda data: compress(data, codec))
+            return [used, binary_view(data)]
+        return read_cache.derive(entry, 'text', lambda data: bytes(data).decode())
     except IOError:
-        print(f"Unable to open txt {path}")
+        print(f"Unable to open txt {name}")
         return False
-    
-def calculate_file_hash(file_path):  # 计算文件的哈希值
-    with open(file_path, 'rb') as file:
-        data = file.read()
-        hash_value = hashlib.sha256(data).hexdigest()
-        return hash_value
+
+def valid_name(name):  # 文件名不能包含路径，防止访问服务器目录之外的文件
+    return name not in ('', '.', '..') and Path(name).name == name
+
+def get_capabilities():  # 告诉客户端本服务器支持的传输方式
+    return {'dedup': store.dedup, 'codecs': sorted(CODECS)}
+
+def stat_file(name):  # 返回文件的大小和哈希值，文件不存在时返回None
+    if not valid_name(name) or not store.exists(name):
+        return None
+    size, _, filehash = store.stat(name)
+    return [size, filehash]
+
+def read_chunk(name, offset, length, codec=None):  # 读取文件中的一段字节，codec不为None时返回[实际使用的算法, 压缩后的Binary]
+    if not valid_name(name):
+        return None
+    try:
+        entry = read_cache.get(name)
+        if entry is None:  # 文件太大，不经过缓存
+            with store.open(name) as f:
+                f.seek(offset)
+                data = f.read(min(length, transfer_chunk_size))
+                if codec is not None:
+                    with metrics.section('compress'):
+                        used, data = compress(data, codec)
+                    return [used, Binary(data)]
+                return Binary(data)
+        data = entry.data[offset:offset + min(length, transfer_chunk_size)]  # memoryview切片，不复制数据
+        read_cache.served(len(data))
+        if codec is not None:
+            with metrics.section('compress'):
+                used, data = read_cache.derive(entry, (offset, len(data), codec), lambda _: compress(data, codec))
+            return [used, binary_view(data)]
+        return binary_view(data)
+    except OSError:
+        return None
+
+def open_upload(name):  # 开始或继续上传一个文件，返回服务器已收到的字节数，客户端从这里续传
+    if not valid_name(name):
+        return -1
+    part = upload_dir / name
+    return part.stat().st_size if part.exists() else 0
+
+def write_chunk(name, offset, data, codec=None):  # 在上传中的文件的offset处写入一段字节，返回已收到的字节数
+    # codec不为None时data是压缩后的数据，offset和返回值都按原始字节计算
+    if not valid_name(name):
+        return -1
+    with metrics.section('compress'):
+        data = decompress(codec, data.data)
+    part = upload_dir / name
+    size = part.stat().st_size if part.exists() else 0
+    if offset > size:  # 中间缺了数据，让客户端从已收到的位置重新发送
+        return size
+    with part.open(mode='r+b' if part.exists() else 'wb') as f:
+        f.seek(offset)
+        f.write(data)
+        f.truncate()
+    return offset + len(data)
+
+def get_block_checksums(name, block_size):  # 返回文件大小和每个块的滚动校验和与强校验和，用于增量上传
+    if not valid_name(name) or not store.exists(name):
+        return None
+    with store.open(name) as f:
+        blob = delta.block_checksums(f, block_size)
+        return [f.tell(), Binary(blob)]
+
+def write_delta(name, offset, block_size, instructions):  # 用现有文件和增量指令重建文件，写入上传中的文件
+    if not valid_name(name) or not store.exists(name):
+        return -1
+    part = upload_dir / name
+    size = part.stat().st_size if part.exists() else 0
+    if offset > size:
+        return size
+    with store.open(name) as base, part.open(mode='r+b' if part.exists() else 'wb') as f:
+        f.seek(offset)
+        f.truncate()
+        delta.apply_delta(base, f, [item if isinstance(item, int) else item.data for item in instructions], block_size)
+        return f.tell()
+
+def commit_upload(name, filehash, lastmodified=None):  # 校验上传完的文件的哈希值，通过后存入，lastmodified为客户端上的修改时间
+    if not valid_name(name):
+        return 'Invalid file name'
+    part = upload_dir / name
+    if not part.exists():
+        part.touch()  # 空文件不会发送任何分块
+    with metrics.section('hash'):
+        actual = calculate_file_hash(part, transfer_chunk_size)
+    if actual != filehash:
+        part.unlink()
+        return 'Hash mismatch'
+    store.commit(name, part, filehash, lastmodified)
+    file_changed(name)
+    return 'success'
+
+def abort_upload(name):  # 放弃上传，删除已收到的部分
+    if valid_name(name) and (upload_dir / name).exists():
+        (upload_dir / name).unlink()
+    return 'success'
+
+def missing_chunks(chunks):  # 给定块的sha256列表，返回服务器上还没有的块（仅去重存储）
+    return store.missing_chunks(chunks) if store.dedup else chunks
+
+def put_chunk(data, codec=None):  # 上传一个块，返回其sha256（仅去重存储）
+    return store.put_chunk(decompress(codec, data.data)) if store.dedup else ''
+
+def commit_chunks(name, chunks, filehash, lastmodified=None):  # 用已上传的块组成文件（仅去重存储）
+    if not valid_name(name):
+        return 'Invalid file name'
+    if not store.dedup:
+        return 'Not supported'
+    with metrics.section('hash'):  # 校验整体哈希
+        back = store.commit_chunks(name, chunks, filehash, lastmodified)
+    if back == 'success':
+        file_changed(name)
+    return back
+
+def replicate_to(name, address):  # 把本服务器上的文件分块推送到另一个文件服务器，用于后台迁移副本
+    if not valid_name(name) or not store.exists(name):
+        return 'File does not exist'
+    _, lastmodified, filehash = store.stat(name)
+    with connect(address) as target:
+        codecs = target.get_capabilities().get('codecs', [])
+        target.abort_upload(name)
+        offset = 0
+        with store.open(name) as f:
+            for data in iter(lambda: f.read(transfer_chunk_size), b''):
+                if wire_codec in codecs:
+                    used, packed = compress(data, wire_codec)
+                    offset = target.write_chunk(name, offset, Binary(packed), used)
+                else:
+                    offset = target.write_chunk(name, offset, Binary(data))
+        return target.commit_upload(name, filehash, lastmodified)  # 目标上的修改时间与本服务器相同
+
+def remove_file(name, deleted=None):  # 按完整文件名删除文件
+    # deleted是客户端删除文件的时间，记录为删除标记，由反熵传播给错过这次删除的副本；迁移时删除多余的副本不传
+    if not valid_name(name):
+        return 'Invalid file name'
+    try:
+        store.remove(name)
+    except FileNotFoundError:
+        return 'File does not exist'
+    except OSError:
+        return 'An error occurred while deleting the file'
+    if deleted is not None:
+        anti_entropy.deleted(name, deleted)
+    file_changed(name)
+    return 'success'
+
+def merkle_nodes(peer, level, indices):  # 返回本服务器为peer维护的Merkle树上第level层给定节点的哈希值
+    return anti_entropy.nodes(peer, level, indices)
+
+def merkle_entries(peer, indices):  # 返回本服务器为peer维护的Merkle树上给定叶子中的文件
+    return anti_entropy.entries(peer, indices)
 
 if __name__ == '__main__':
     root_dir =  Path(__file__).parent / 'cloud_server'  # 云端服务器
@@ -56,42 +253,78 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('server_id', help='ID of the file server.', type=int)
     parser.add_argument('port', help='Port of the file server.', type=int)
+    parser.add_argument('--store', help='Storage engine, "file" or "dedup".', choices=['file', 'dedup'], default='file')
+    parser.add_argument('--compress', help='Codec for files at rest, "none", "zlib" or "lzma".',
+                        choices=['none'] + sorted(CODECS), default='none')
+    parser.add_argument('--binary-port', help='Port of the binary protocol, defaults to port + {}.'.format(binary_port_offset),
+                        type=int)
     args = parser.parse_args()
+    binary_port = args.port + binary_port_offset if args.binary_port is None else args.binary_port
 
-    with SimpleXMLRPCServer(('localhost', args.port)) as server:
+    with ThreadedXMLRPCServer(('localhost', args.port), requestHandler=KeepAliveRequestHandler, allow_none=True) as server:
         # 注册函数
         server.register_function(mktxt)
         server.register_function(deltxt)
         server.register_function(print_cloud_filename)
         server.register_function(get_txt_content)
+        server.register_function(stat_file)
+        server.register_function(read_chunk)
+        server.register_function(open_upload)
+        server.register_function(write_chunk)
+        server.register_function(commit_upload)
+        server.register_function(get_block_checksums)
+        server.register_function(write_delta)
+        server.register_function(abort_upload)
+        server.register_function(remove_file)
+        server.register_function(get_capabilities)
+        server.register_function(missing_chunks)
+        server.register_function(put_chunk)
+        server.register_function(commit_chunks)
+        server.register_function(replicate_to)
+        server.register_function(merkle_nodes)
+        server.register_function(merkle_entries)
+        server.register_function(get_stats)
+        server.register_function(set_profiling)
+        server.register_function(get_profile)
+        serve_binary(server, binary_port)  # 同一组函数也通过二进制协议提供
 
-        # 服务器地址
-        server_address = 'http://{}:{}'.format(server.server_address[0], server.server_address[1])
+        # 服务器地址，带上二进制协议的端口，客户端和其他服务器从数据库得到地址后直接连接
+        server_address = advertised_url(server.server_address[0], server.server_address[1], binary_port)
 
         # 更新数据库中服务器的信息
         server_registered = False
-        with ServerProxy(database_url, allow_none=True) as proxy:
+        with connect(database_url) as proxy:
             server_registered = proxy.add_server(args.server_id, server_address)
 
         if server_registered:
             # 更新数据库中的文件信息
-            root_dir = root_dir / str(args.server_id)
-
-            if not root_dir.exists():
-                root_dir.mkdir(parents=True)
+            upload_dir = root_dir / 'partial' / str(args.server_id)  # 上传中的文件，支持断点续传
+            tombstone_path = root_dir / 'tombstones' / '{}.json'.format(args.server_id)  # 反熵使用的删除标记
+            codec = None if args.compress == 'none' else args.compress  # 落盘时的压缩算法
+            if args.store == 'dedup':  # 内容寻址的去重存储
+                root_dir = root_dir / 'dedup' / str(args.server_id)
+                store = ChunkStore(root_dir, transfer_chunk_size, codec)
+            else:
+                store = FileStore(root_dir / str(args.server_id), root_dir / 'index' / '{}.json'.format(args.server_id),
+                                  codec, transfer_chunk_size, root_dir / 'frames' / str(args.server_id))
+                root_dir = root_dir / str(args.server_id)
+            if not upload_dir.exists():
+                upload_dir.mkdir(parents=True)
+            anti_entropy = AntiEntropy(store, args.server_id, server_address, tombstone_path)
+            read_cache = ReadCache(store, read_cache_size, read_cache_max_file, read_cache_mmap_threshold)
+            metrics.gauges['read_cache'] = read_cache.snapshot  # 命中率和字节数随get_stats返回
             print('Welcome to Tangzhj\'s server.')
             print('Initializing cloud server for files in "{}"...'.format(str(root_dir)))
 
-            # 将云端服务器中已有的文件的信息添加进数据库中
-            files_registered = False
-            file_list = []
-            for filename in os.listdir(root_dir):
-                path = os.path.join(root_dir, filename)
-                lastmodified = os.path.getmtime(path)
-                filehash = calculate_file_hash(path)
-                file_list.append(tuple([filename, args.server_id, lastmodified, filehash, 0, 0]))
-            with ServerProxy(database_url, allow_none=True) as proxy:
-                files_registered = proxy.add_file(file_list)
+            # 将云端服务器中已有的文件的信息添加进数据库中，只有变化过的文件才重新计算哈希
+            file_list = [tuple([filename, args.server_id, lastmodified, filehash])
+                         for filename, lastmodified, filehash in store.index(index_workers)]
+            files_registered = True
+            with connect(database_url) as proxy:
+                for start in range(0, len(file_list), register_batch_size):  # 分批登记，避免单个请求过大
+                    # 被删除记录拒绝的是错过删除的旧版本，不影响启动，反熵会删除它们
+                    files_registered = files_registered and \
+                        proxy.add_file(file_list[start:start + register_batch_size]) is not False
 
             if files_registered:
                 print('Serving file cloud server on {}.'.format(server.server_address))
@@ -99,13 +332,16 @@ if __name__ == '__main__':
                     print('Successfully synchronized existing files:')
                     for file_info in file_list:
                         print(file_info[0])
+                threading.Thread(target=report_load, args=(server, args.server_id), daemon=True).start()
+                threading.Thread(target=anti_entropy.run, daemon=True).start()  # 后台与其他副本比较并修复
                 try:
                     server.serve_forever()
                 except KeyboardInterrupt:
-                    with ServerProxy(database_url, allow_none=True) as proxy:
+                    with connect(database_url) as proxy:
                         # 关闭服务器，清理数据库中有关该服务器的信息和文件
                         proxy.delete_server(args.server_id)
                         print('Shutting down the server and cleaning up the files in database.')
+                    store.save_index()
             else:
                 print('Failed file registration.')
         else:
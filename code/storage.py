@@ -0,0 +1,338 @@
+import bisect
+import concurrent.futures
+import hashlib
+import io
+import json
+import os
+import threading
+from pathlib import Path
+from compression import write_frames, compress_bytes, FrameReader
+
+
+def hash_stream(f, chunk_size=1 << 20):  # 计算文件对象剩余内容的哈希值
+    sha256 = hashlib.sha256()
+    for chunk in iter(lambda: f.read(chunk_size), b''):
+        sha256.update(chunk)
+    return sha256.hexdigest()
+
+def calculate_file_hash(file_path, chunk_size=1 << 20):  # 计算文件的哈希值，分块读取，内存占用与文件大小无关
+    with open(file_path, 'rb') as file:
+        return hash_stream(file, chunk_size)
+
+def hash_chunks(f, chunk_size):  # 一次读取同时计算文件对象剩余内容和每个块的哈希值
+    sha256 = hashlib.sha256()
+    chunks = []
+    for chunk in iter(lambda: f.read(chunk_size), b''):
+        sha256.update(chunk)
+        chunks.append(hashlib.sha256(chunk).hexdigest())
+    return sha256.hexdigest(), chunks
+
+def calculate_chunk_hashes(file_path, chunk_size=1 << 20):  # 一次读取同时计算整个文件和每个传输块的哈希值
+    with open(file_path, 'rb') as file:
+        return hash_chunks(file, chunk_size)
+
+
+class FileStore(object):  # 整文件存储：每个文件保存在服务器目录下，codec不为None时按帧压缩保存
+    dedup = False
+
+    def __init__(self, root, index_path, codec=None, frame_size=1 << 20, frame_root=None, chunk_size=None):
+        self.root = Path(root)
+        self.codec = codec
+        self.frame_size = frame_size
+        self.chunk_size = chunk_size  # 不为None时索引中还记录每个这么大的块的sha256（客户端去重上传时使用），与整体哈希一起算出
+        # 压缩保存的文件放在单独的目录中，格式由位置决定而不是根据内容猜测；为None时所有文件都原样保存
+        self.frame_root = Path(frame_root) if frame_root is not None else None
+        for path in (self.root, self.frame_root):
+            if path is not None and not path.exists():
+                path.mkdir(parents=True)
+        # 持久化的哈希索引：name -> [磁盘上的size, mtime_ns, inode, sha256, 原始size(, 块大小, 每块的sha256)]，
+        # 只有变化过的文件才需要重新计算哈希
+        self.index_path = Path(index_path)
+        if not self.index_path.parent.exists():
+            self.index_path.parent.mkdir(parents=True)
+        self.hashes = {}
+        if self.index_path.exists():
+            try:
+                self.hashes = json.loads(self.index_path.read_text())
+            except ValueError:
+                pass
+        self.mutex = threading.Lock()
+
+    def location(self, name):  # 返回(文件在磁盘上的路径, 是否压缩保存)
+        if self.frame_root is not None:
+            packed = self.frame_root / name
+            if packed.is_file():
+                return packed, True
+        return self.root / name, False
+
+    def names(self):
+        names = {path.name for path in self.root.iterdir() if path.is_file()}
+        if self.frame_root is not None:
+            names.update(path.name for path in self.frame_root.iterdir() if path.is_file())
+        return list(names)
+
+    def exists(self, name):
+        return self.location(name)[0].is_file()
+
+    def version(self, name):  # 磁盘上文件的(修改时间, 大小)，文件被替换后会变化
+        st = self.location(name)[0].stat()
+        return st.st_mtime_ns, st.st_size
+
+    def raw_path(self, name):  # 未压缩保存的文件的路径，可以直接映射到内存；压缩保存时返回None
+        path, packed = self.location(name)
+        return None if packed else path
+
+    def stat(self, name):  # 返回[原始大小, 修改时间, 原始内容的sha256]
+        st = self.location(name)[0].stat()
+        key = [st.st_size, st.st_mtime_ns, st.st_ino]
+        entry = self.hashes.get(name)
+        if entry is not None and len(entry) == 4:  # 旧版索引中的文件都没有压缩
+            entry.append(entry[0])
+        if entry is None or entry[:3] != key or (self.chunk_size is not None and entry[5:6] != [self.chunk_size]):
+            with self.open(name) as f:
+                if self.chunk_size is None:
+                    entry = key + [hash_stream(f), f.tell()]
+                else:
+                    filehash, chunks = hash_chunks(f, self.chunk_size)
+                    entry = key + [filehash, f.tell(), self.chunk_size, chunks]
+            self.hashes[name] = entry
+        return [entry[4], st.st_mtime, entry[3]]
+
+    def stat_chunks(self, name):  # stat的结果加上每块的sha256，需要设置chunk_size
+        return self.stat(name) + [self.hashes[name][6]]
+
+    def index(self, workers):  # 启动时并行地为所有文件建立索引，返回[[name, 修改时间, sha256], ...]
+        names = self.index_names()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:  # hashlib计算时会释放GIL
+            stats = list(pool.map(self.stat, names))
+        self.save_index()
+        return [[name, lastmodified, filehash] for name, (_, lastmodified, filehash) in zip(names, stats)]
+
+    def index_names(self):  # 清理索引中已经不存在的文件，返回所有文件名，之后由调用者逐个stat
+        if self.frame_root is not None:  # 切换压缩方式后覆盖写入时崩溃，两个目录中会各有一份，保留后放入的
+            for name in {path.name for path in self.frame_root.iterdir()} & {path.name for path in self.root.iterdir()}:
+                paths = sorted([self.root / name, self.frame_root / name], key=lambda path: path.stat().st_ctime_ns)
+                paths[0].unlink()
+        names = self.names()
+        for name in set(self.hashes) - set(names):  # 已经不存在的文件
+            del self.hashes[name]
+        return names
+
+    def save_index(self):
+        with self.mutex:
+            tmp = self.index_path.with_name(self.index_path.name + '.tmp')
+            tmp.write_text(json.dumps(self.hashes))
+            os.replace(tmp, self.index_path)
+
+    def open(self, name):  # 以二进制只读方式打开文件，读到的总是原始内容
+        path, packed = self.location(name)
+        if packed:
+            return io.BufferedReader(FrameReader(path), self.frame_size)
+        return path.open(mode='rb')
+
+    def commit(self, name, part, filehash, lastmodified=None):  # 把校验过的上传文件放入存储，哈希值已知，直接记入索引
+        # lastmodified不为None时作为文件的修改时间，各副本上同一版本的修改时间相同
+        size = os.path.getsize(part)
+        if self.codec and self.frame_root is not None:
+            packed = part.with_name(part.name + '.z')
+            with open(part, 'rb') as src, open(packed, 'wb') as dst:
+                write_frames(src, dst, self.codec, self.frame_size)
+            os.unlink(part)
+            part, target, stale = packed, self.frame_root / name, self.root / name
+        else:
+            target, stale = self.root / name, self.frame_root / name if self.frame_root is not None else None
+        os.replace(part, target)
+        if stale is not None and stale.exists():  # 之前以另一种格式保存的旧版本
+            stale.unlink()
+        if lastmodified is not None:
+            os.utime(target, (lastmodified, lastmodified))
+        st = target.stat()
+        self.hashes[name] = [st.st_size, st.st_mtime_ns, st.st_ino, filehash, size]
+
+    def remove(self, name):
+        self.location(name)[0].unlink()
+        self.hashes.pop(name, None)
+
+
+class ChunkReader(io.RawIOBase):  # 把清单中的多个块拼接成一个可随机读取的文件对象
+    def __init__(self, store, chunks):
+        self.store = store
+        self.chunks = chunks  # [[sha256, size], ...]
+        self.offsets = [0]
+        for _, size in chunks:
+            self.offsets.append(self.offsets[-1] + size)
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += self.offsets[-1]
+        self.pos = max(0, offset)
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def readinto(self, buffer):
+        if self.pos >= self.offsets[-1]:
+            return 0
+        index = bisect.bisect_right(self.offsets, self.pos) - 1
+        start = self.pos - self.offsets[index]
+        with self.store.open_chunk(self.chunks[index][0]) as f:
+            f.seek(start)
+            n = f.readinto(memoryview(buffer)[:self.chunks[index][1] - start])
+        self.pos += n
+        return n
+
+
+class ChunkStore(object):  # 内容寻址的去重存储：块按sha256存放，文件用清单表示，引用计数为零的块被回收
+    dedup = True
+
+    def __init__(self, root, chunk_size, codec=None):
+        self.root = Path(root)
+        self.chunk_size = chunk_size
+        self.codec = codec  # 块的压缩算法，块名始终是原始内容的sha256
+        self.manifest_dir = self.root / 'manifests'
+        self.chunk_dir = self.root / 'chunks'
+        self.tmp_dir = self.root / 'tmp'
+        for path in (self.manifest_dir, self.chunk_dir, self.tmp_dir):
+            if not path.exists():
+                path.mkdir(parents=True)
+        self.mutex = threading.Lock()
+        # 启动时从清单重建引用计数，并清理没有被任何清单引用的块（例如上传到一半的块）
+        self.refcounts = {}
+        for name in self.names():
+            for chunk, _ in self.manifest(name)['chunks']:
+                self.refcounts[chunk] = self.refcounts.get(chunk, 0) + 1
+        for path in self.chunk_dir.glob('*/*'):
+            if (path.name[:-2] if path.name.endswith('.z') else path.name) not in self.refcounts:
+                path.unlink()
+
+    def chunk_path(self, chunk, packed=False):  # 压缩保存的块带.z后缀，块名是十六进制的哈希值，不会与后缀混淆
+        return self.chunk_dir / chunk[:2] / (chunk + '.z' if packed else chunk)
+
+    def chunk_file(self, chunk):  # 返回(块在磁盘上的路径, 是否压缩保存)，块不存在时返回(None, False)
+        for packed in (True, False):
+            path = self.chunk_path(chunk, packed)
+            if path.exists():
+                return path, packed
+        return None, False
+
+    def open_chunk(self, chunk):
+        path, packed = self.chunk_file(chunk)
+        if path is None:
+            raise FileNotFoundError(chunk)
+        if packed:
+            return FrameReader(path)
+        return path.open(mode='rb')
+
+    def chunk_length(self, chunk):  # 块的原始大小
+        with self.open_chunk(chunk) as f:
+            return f.seek(0, io.SEEK_END)
+
+    def manifest(self, name):
+        return json.loads((self.manifest_dir / name).read_text())
+
+    def names(self):
+        return [path.name for path in self.manifest_dir.iterdir() if path.is_file()]
+
+    def exists(self, name):
+        return (self.manifest_dir / name).is_file()
+
+    def version(self, name):  # 清单的(修改时间, 大小)，文件被替换后会变化
+        st = (self.manifest_dir / name).stat()
+        return st.st_mtime_ns, st.st_size
+
+    def raw_path(self, name):  # 内容分散在多个块中，不能直接映射
+        return None
+
+    def stat(self, name):  # 大小和哈希值记录在清单中，不需要重新计算
+        manifest = self.manifest(name)
+        return [manifest['size'], (self.manifest_dir / name).stat().st_mtime, manifest['sha256']]
+
+    def index(self, workers):  # 清单中已有哈希值，不需要读取文件内容
+        return [[name] + self.stat(name)[1:] for name in self.names()]
+
+    def save_index(self):
+        pass
+
+    def open(self, name):
+        return io.BufferedReader(ChunkReader(self, self.manifest(name)['chunks']), self.chunk_size)
+
+    def missing_chunks(self, chunks):  # 返回服务器上还没有的块
+        return [chunk for chunk in chunks if self.chunk_file(chunk)[0] is None]
+
+    def put_chunk(self, data):  # 保存一个块，返回其sha256
+        chunk = hashlib.sha256(data).hexdigest()
+        if self.chunk_file(chunk)[0] is None:
+            path = self.chunk_path(chunk, bool(self.codec))
+            if not path.parent.exists():
+                path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_name('{}.{}.tmp'.format(chunk, threading.get_ident()))
+            tmp.write_bytes(compress_bytes(data, self.codec, self.chunk_size) if self.codec else data)
+            os.replace(tmp, path)
+        return chunk
+
+    def commit_chunks(self, name, chunks, filehash, lastmodified=None):  # 用已有的块组成文件，校验整体哈希后写入清单
+        # 在mutex之外读取和校验，大文件的校验不会挡住其他文件的提交和删除
+        try:
+            entries = [[chunk, self.chunk_length(chunk)] for chunk in chunks]
+            sha256 = hashlib.sha256()
+            with io.BufferedReader(ChunkReader(self, entries), self.chunk_size) as f:
+                for data in iter(lambda: f.read(self.chunk_size), b''):
+                    sha256.update(data)
+        except FileNotFoundError:  # 块不存在，或者校验期间被回收了
+            return 'Missing chunks'
+        if sha256.hexdigest() != filehash:
+            return 'Hash mismatch'
+        with self.mutex:  # 块按内容命名，只需确认校验之后块没有被回收，写入清单之前也不会被回收
+            if self.missing_chunks(chunks):
+                return 'Missing chunks'
+            self.install(name, {'size': sum(size for _, size in entries), 'sha256': filehash, 'chunks': entries},
+                         lastmodified)
+        return 'success'
+
+    def commit(self, name, part, filehash, lastmodified=None):  # 把校验过的上传文件切块存入
+        entries = []
+        with open(part, 'rb') as f:
+            for data in iter(lambda: f.read(self.chunk_size), b''):
+                entries.append([self.put_chunk(data), len(data)])
+            with self.mutex:
+                for index, (chunk, _) in enumerate(entries):
+                    if self.chunk_file(chunk)[0] is None:  # 写入之后被回收了（其他文件刚好释放了相同内容的块），重新写入
+                        f.seek(index * self.chunk_size)
+                        self.put_chunk(f.read(self.chunk_size))
+                self.install(name, {'size': sum(size for _, size in entries), 'sha256': filehash, 'chunks': entries},
+                             lastmodified)
+        os.unlink(part)
+
+    def install(self, name, manifest, lastmodified=None):  # 原子地替换清单并更新引用计数，调用者需持有mutex
+        old = self.manifest(name)['chunks'] if self.exists(name) else []
+        tmp = self.tmp_dir / '{}.{}'.format(name, threading.get_ident())
+        tmp.write_text(json.dumps(manifest))
+        if lastmodified is not None:  # 清单的修改时间就是文件的修改时间
+            os.utime(tmp, (lastmodified, lastmodified))
+        os.replace(tmp, self.manifest_dir / name)
+        for chunk, _ in manifest['chunks']:
+            self.refcounts[chunk] = self.refcounts.get(chunk, 0) + 1
+        self.release(old)
+
+    def remove(self, name):
+        with self.mutex:
+            old = self.manifest(name)['chunks']
+            (self.manifest_dir / name).unlink()
+            self.release(old)
+
+    def release(self, chunks):  # 减少引用计数，回收不再被引用的块，调用者需持有mutex
+        for chunk, _ in chunks:
+            self.refcounts[chunk] -= 1
+            if self.refcounts[chunk] == 0:
+                del self.refcounts[chunk]
+                self.chunk_file(chunk)[0].unlink()
@@ -0,0 +1,16 @@
+import sys
+from pathlib import Path
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))  # 被测模块都在code目录下，与服务器的运行方式一致
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):  # 临时目录中的元数据数据库，模块级的连接池、写线程和变更日志与database.py启动时相同
+    import database
+    monkeypatch.setattr(database, 'db_path', str(tmp_path / 'test.db'))
+    database.init_db()
+    monkeypatch.setattr(database, 'pool', database.ConnectionPool(2), raising=False)
+    monkeypatch.setattr(database, 'committer', database.GroupCommitter(8), raising=False)
+    monkeypatch.setattr(database, 'changelog', database.ChangeLog(100), raising=False)
+    return database
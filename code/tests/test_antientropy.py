@@ -0,0 +1,62 @@
+import time
+import antientropy
+from antientropy import AntiEntropy, version
+from storage import FileStore
+
+SERVERS = {1: 'http://a', 2: 'http://b'}
+RING = {'vnodes': 8, 'replication_factor': 2, 'write_quorum': 1}
+
+
+def make(tmp_path):
+    store = FileStore(tmp_path / 'files', tmp_path / 'index.json')
+    anti_entropy = AntiEntropy(store, 1, SERVERS[1], tmp_path / 'tombstones.json')
+    return store, anti_entropy
+
+def write(store, tmp_path, name, content, lastmodified):
+    part = tmp_path / 'part'
+    part.write_bytes(content)
+    store.commit(name, part, 'hash-' + content.decode(), lastmodified)
+
+def entries(anti_entropy):  # 为服务器2维护的树上的所有文件
+    tree = anti_entropy.trees[2]
+    return sorted(tuple(entry) for entry in tree.entries(range(len(tree.leaves))))
+
+
+def test_version_order():
+    assert version(['b', 2.0]) > version(['a', 1.0])
+    assert version(['', 1.0]) > version(['a', 1.0])  # 时间相同时删除胜出
+    assert version(['a', 2.0]) > version(['', 1.0])  # 删除之后写入的新版本胜出
+
+def test_delete_leaves_tombstone_in_tree(tmp_path):
+    store, anti_entropy = make(tmp_path)
+    write(store, tmp_path, 'a.txt', b'one', 10.0)
+    anti_entropy.rebuild(SERVERS, RING)
+    assert entries(anti_entropy) == [('a.txt', 'hash-one', 10.0)]
+    store.remove('a.txt')
+    anti_entropy.deleted('a.txt', 20.0)
+    anti_entropy.changed('a.txt')
+    assert entries(anti_entropy) == [('a.txt', '', 20.0)]
+    _, restarted = make(tmp_path)  # 删除标记持久化保存，重启后仍在树上
+    restarted.rebuild(SERVERS, RING)
+    assert entries(restarted) == [('a.txt', '', 20.0)]
+
+def test_new_write_replaces_tombstone(tmp_path):
+    store, anti_entropy = make(tmp_path)
+    anti_entropy.rebuild(SERVERS, RING)
+    anti_entropy.deleted('a.txt', 20.0)
+    anti_entropy.changed('a.txt')
+    write(store, tmp_path, 'a.txt', b'two', 30.0)
+    anti_entropy.changed('a.txt')
+    assert entries(anti_entropy) == [('a.txt', 'hash-two', 30.0)]
+    assert anti_entropy.tombstones == {}
+
+def test_expired_tombstones_leave_tree(tmp_path, monkeypatch):
+    store, anti_entropy = make(tmp_path)
+    anti_entropy.rebuild(SERVERS, RING)
+    anti_entropy.deleted('old.txt', time.time() - 100)
+    anti_entropy.deleted('new.txt', time.time())
+    for name in ('old.txt', 'new.txt'):
+        anti_entropy.changed(name)
+    monkeypatch.setattr(antientropy, 'tombstone_ttl', 50)
+    anti_entropy.expire()
+    assert [name for name, _, _ in entries(anti_entropy)] == ['new.txt']
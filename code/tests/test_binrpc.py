@@ -0,0 +1,82 @@
+import socket
+import threading
+import time
+from xmlrpc.client import Binary, Fault
+from xmlrpc.server import SimpleXMLRPCServer
+import pytest
+import binrpc
+from binrpc import pack_frame, read_frame, to_wire, from_wire, binary_address, xmlrpc_url, advertised_url, \
+    serve_binary, BinaryServerProxy
+from config import database_url, database_binary_port, binary_port_offset
+
+
+def test_frames_survive_partial_writes():
+    a, b = socket.socketpair()
+    with a, b:
+        frame = pack_frame(7, b'x' * 1000) + pack_frame(8, b'')
+        sender = threading.Thread(target=lambda: [a.sendall(frame[i:i + 3]) for i in range(0, len(frame), 3)])
+        sender.start()
+        assert read_frame(b) == (7, b'x' * 1000)
+        assert read_frame(b) == (8, b'')
+        sender.join()
+
+def test_oversized_frame_rejected(monkeypatch):
+    monkeypatch.setattr(binrpc, 'binary_max_frame', 10)
+    a, b = socket.socketpair()
+    with a, b:
+        a.sendall(pack_frame(1, b'x' * 11))
+        with pytest.raises(ConnectionError):
+            read_frame(b)
+
+def test_wire_conversion():
+    value = {'data': Binary(b'abc'), 'rows': [(1, Binary(b'd')), 'text'], 'none': None}
+    wire = to_wire(value)
+    assert wire == {'data': b'abc', 'rows': [[1, b'd'], 'text'], 'none': None}
+    back = from_wire(wire)
+    assert back['data'] == Binary(b'abc') and back['rows'][0][1] == Binary(b'd') and back['rows'][1] == 'text'
+
+def test_addresses():
+    url = advertised_url('localhost', 8201, 7777)
+    assert binary_address(url) == ('localhost', 7777)
+    assert xmlrpc_url(url) == 'http://localhost:8201/'
+    assert binary_address('http://localhost:8201') == ('localhost', 8201 + binary_port_offset)  # 没有登记端口时按默认偏移
+    assert binary_address(database_url)[1] == database_binary_port
+
+
+@pytest.fixture
+def server():
+    xml_server = SimpleXMLRPCServer(('127.0.0.1', 0), logRequests=False, allow_none=True)
+    release = threading.Event()
+    xml_server.register_function(lambda data: Binary(data.data[::-1]), 'reverse')
+    xml_server.register_function(lambda: release.wait(10), 'slow')
+    xml_server.register_function(lambda: 1 / 0, 'fail')
+    xml_server.register_multicall_functions()
+    binary_server = serve_binary(xml_server, 0)
+    url = advertised_url('127.0.0.1', xml_server.server_address[1], binary_server.server_address[1])
+    yield url, release
+    release.set()
+    binary_server.shutdown()
+    binary_server.server_close()
+    xml_server.server_close()
+
+def test_round_trip(server):
+    url, _ = server
+    with BinaryServerProxy(url, timeout=5) as proxy:
+        assert proxy.reverse(Binary(b'abc')) == Binary(b'cba')
+        with pytest.raises(Fault, match='ZeroDivisionError'):
+            proxy.fail()
+        results = proxy.system.multicall([{'methodName': 'reverse', 'params': [Binary(b'xy')]}])
+        assert results == [[Binary(b'yx')]]
+
+def test_responses_return_out_of_order(server):
+    url, release = server
+    proxy = BinaryServerProxy(url, timeout=5)
+    slow = []
+    thread = threading.Thread(target=lambda: slow.append(proxy.slow()))
+    thread.start()
+    time.sleep(0.1)
+    assert proxy.reverse(Binary(b'ab')) == Binary(b'ba')  # 同一连接上的慢请求没有挡住后面的请求
+    assert not slow
+    release.set()
+    thread.join(5)
+    assert slow == [True]
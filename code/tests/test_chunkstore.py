@@ -0,0 +1,99 @@
+import hashlib
+import threading
+from compression import MAGIC
+from storage import ChunkStore, calculate_chunk_hashes
+
+CHUNK = 8
+
+
+def commit(store, tmp_path, name, content):
+    part = tmp_path / 'part'
+    part.write_bytes(content)
+    store.commit(name, part, hashlib.sha256(content).hexdigest())
+
+def read(store, name):
+    with store.open(name) as f:
+        return f.read()
+
+def chunk_files(store):
+    return sorted(path.name for path in store.chunk_dir.glob('*/*'))
+
+
+def test_shared_chunks_are_stored_once(tmp_path):
+    store = ChunkStore(tmp_path / 'store', CHUNK)
+    commit(store, tmp_path, 'a', b'01234567abcdefgh')
+    commit(store, tmp_path, 'b', b'01234567ABCDEFGH')
+    assert read(store, 'a') == b'01234567abcdefgh'
+    assert read(store, 'b') == b'01234567ABCDEFGH'
+    assert len(chunk_files(store)) == 3
+    assert store.refcounts[hashlib.sha256(b'01234567').hexdigest()] == 2
+
+def test_unreferenced_chunks_are_collected(tmp_path):
+    store = ChunkStore(tmp_path / 'store', CHUNK)
+    commit(store, tmp_path, 'a', b'01234567abcdefgh')
+    commit(store, tmp_path, 'b', b'01234567ABCDEFGH')
+    store.remove('a')
+    assert len(chunk_files(store)) == 2  # 共享的块还被b引用
+    commit(store, tmp_path, 'b', b'xxxxxxxx')  # 覆盖时释放旧版本的块
+    assert chunk_files(store) == [hashlib.sha256(b'xxxxxxxx').hexdigest()]
+    store.remove('b')
+    assert chunk_files(store) == [] and store.refcounts == {}
+
+def test_commit_chunks_checks_chunks_and_hash(tmp_path):
+    store = ChunkStore(tmp_path / 'store', CHUNK)
+    content = b'01234567abcdefgh'
+    path = tmp_path / 'local'
+    path.write_bytes(content)
+    filehash, chunks = calculate_chunk_hashes(path, CHUNK)
+    assert store.missing_chunks(chunks) == chunks
+    assert store.commit_chunks('a', chunks, filehash) == 'Missing chunks'
+    assert store.put_chunk(content[:CHUNK]) == chunks[0]
+    assert store.missing_chunks(chunks) == chunks[1:]
+    store.put_chunk(content[CHUNK:])
+    assert store.commit_chunks('a', chunks, 'wrong') == 'Hash mismatch'
+    assert store.commit_chunks('a', chunks, filehash) == 'success'
+    assert read(store, 'a') == content
+    assert store.stat('a')[0] == len(content) and store.stat('a')[2] == filehash
+
+def test_restart_rebuilds_refcounts_and_drops_orphans(tmp_path):
+    store = ChunkStore(tmp_path / 'store', CHUNK)
+    commit(store, tmp_path, 'a', b'01234567abcdefgh')
+    orphan = store.put_chunk(b'uploaded')  # 上传了块但没有提交
+    store = ChunkStore(tmp_path / 'store', CHUNK)
+    assert orphan not in chunk_files(store)
+    assert sorted(store.refcounts) == chunk_files(store)
+    assert read(store, 'a') == b'01234567abcdefgh'
+
+def test_compressed_chunks(tmp_path):
+    store = ChunkStore(tmp_path / 'store', CHUNK, 'zlib')
+    content = MAGIC + b'\0' * 20  # 内容以MAGIC开头也不会被误认
+    commit(store, tmp_path, 'a', content)
+    assert all(name.endswith('.z') for name in chunk_files(store))
+    assert read(store, 'a') == content
+    plain = ChunkStore(tmp_path / 'store', CHUNK)  # 换成不压缩后，已压缩的块仍然可读，也可以复用
+    assert plain.missing_chunks([hashlib.sha256(content[:CHUNK]).hexdigest()]) == []
+    assert read(plain, 'a') == content
+
+def test_concurrent_commits_keep_refcounts(tmp_path):
+    store = ChunkStore(tmp_path / 'store', CHUNK)
+    shared = b'shared!!'
+
+    def worker(i):
+        for j in range(20):
+            part = tmp_path / 'part{}'.format(i)
+            content = shared + '{:08}'.format(i * 100 + j).encode()
+            part.write_bytes(content)
+            store.commit('f{}'.format(i), part, hashlib.sha256(content).hexdigest())
+            if j % 3 == 0:
+                store.remove('f{}'.format(i))
+    threads = [threading.Thread(target=worker, args=(i, )) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    expected = {}
+    for name in store.names():
+        for chunk, _ in store.manifest(name)['chunks']:
+            expected[chunk] = expected.get(chunk, 0) + 1
+    assert store.refcounts == expected
+    assert sorted(expected) == chunk_files(store)
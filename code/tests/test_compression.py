@@ -0,0 +1,49 @@
+import io
+import os
+from compression import compress, decompress, compress_bytes, FrameReader
+
+
+def test_compress_roundtrip():
+    data = b'hello world ' * 1000
+    for codec in ('zlib', 'lzma'):
+        used, out = compress(data, codec)
+        assert used == codec and len(out) < len(data)
+        assert decompress(used, out) == data
+
+def test_incompressible_data_stored_raw():
+    data = os.urandom(1 << 18)  # 超过两倍试压缩大小，走抽样判断
+    assert compress(data, 'zlib') == ('', data)
+    assert compress(b'abc', 'zlib') == ('', b'abc')
+    assert compress(data, '') == ('', data)
+
+def test_frame_reader_random_access(tmp_path):
+    frame_size = 1000
+    data = b''.join(b'%05d ' % i for i in range(2000)) + os.urandom(3000)  # 可压缩的帧和原样保存的帧混合
+    path = tmp_path / 'file'
+    path.write_bytes(compress_bytes(data, 'zlib', frame_size))
+    with FrameReader(path) as raw:
+        assert raw.size() == len(data)
+        assert len(raw.frames) == -(-len(data) // frame_size)
+        assert {frame[1] for frame in raw.frames} == {'zlib', ''}
+        raw.seek(995)
+        assert raw.read(10) == data[995:1000]  # 无缓冲读取不跨帧
+    with io.BufferedReader(FrameReader(path), frame_size) as reader:
+        for offset, length in ((0, 10), (995, 10), (4321, 2500), (len(data) - 5, 100)):
+            reader.seek(offset)
+            assert reader.read(length) == data[offset:offset + length]
+        reader.seek(-7, io.SEEK_END)
+        assert reader.read() == data[-7:]
+        assert reader.read(1) == b''
+
+def test_frame_reader_sequential(tmp_path):
+    data = b'abcdefgh' * 5000
+    path = tmp_path / 'file'
+    path.write_bytes(compress_bytes(data, 'lzma', 4096))
+    with io.BufferedReader(FrameReader(path), 4096) as reader:
+        assert reader.read() == data
+
+def test_empty_file(tmp_path):
+    path = tmp_path / 'file'
+    path.write_bytes(compress_bytes(b'', 'zlib', 1024))
+    with FrameReader(path) as reader:
+        assert reader.size() == 0 and reader.read() == b''
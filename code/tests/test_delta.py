@@ -0,0 +1,86 @@
+import io
+import os
+import random
+import delta
+from aioclient import next_batch
+
+BLOCK = 64
+
+
+def round_trip(tmp_path, base, new, max_literal=1 << 20):
+    path = tmp_path / 'new'
+    path.write_bytes(new)
+    checksums = delta.unpack_checksums(delta.block_checksums(io.BytesIO(base), BLOCK))
+    instructions = list(delta.compute_delta(path, checksums, len(base), BLOCK, max_literal))
+    out = io.BytesIO()
+    delta.apply_delta(io.BytesIO(base), out, instructions, BLOCK)
+    assert out.getvalue() == new
+    return instructions
+
+def literal_bytes(instructions):
+    return sum(len(item) for item in instructions if not isinstance(item, int))
+
+def test_weak_checksum_rolls():
+    data = os.urandom(BLOCK * 2)
+    a, b = delta.weak_checksum(data[:BLOCK])
+    for pos in range(BLOCK):
+        out, new = data[pos], data[pos + BLOCK]
+        a = (a - out + new) % delta.MOD
+        b = (b - BLOCK * out + a) % delta.MOD
+        assert (a, b) == delta.weak_checksum(data[pos + 1:pos + 1 + BLOCK])
+
+def test_unchanged_file_reuses_every_block(tmp_path):
+    base = os.urandom(BLOCK * 10 + 17)  # 最后一块不足BLOCK
+    instructions = round_trip(tmp_path, base, base)
+    assert instructions == list(range(11))
+
+def test_insert_at_start_sends_only_new_bytes(tmp_path):
+    base = os.urandom(BLOCK * 20)
+    instructions = round_trip(tmp_path, base, b'x' + base)
+    assert literal_bytes(instructions) == 1
+
+def test_edits_in_the_middle_and_end(tmp_path):
+    rng = random.Random(1)
+    base = bytes(rng.getrandbits(8) for _ in range(BLOCK * 30 + 5))
+    new = base[:BLOCK * 7] + b'changed' + base[BLOCK * 8:BLOCK * 20] + base[BLOCK * 21:] + b'appended'
+    instructions = round_trip(tmp_path, base, new)
+    assert literal_bytes(instructions) < BLOCK * 3
+
+def test_unrelated_and_empty_files(tmp_path):
+    base = os.urandom(BLOCK * 4)
+    assert round_trip(tmp_path, base, b'') == []
+    assert literal_bytes(round_trip(tmp_path, base, os.urandom(BLOCK * 3 + 1))) == BLOCK * 3 + 1
+    round_trip(tmp_path, b'', os.urandom(BLOCK))  # 服务器上是空文件
+
+def test_literals_are_split(tmp_path):
+    new = os.urandom(BLOCK * 10)
+    instructions = round_trip(tmp_path, os.urandom(BLOCK * 2), new, max_literal=BLOCK)
+    assert all(len(item) <= BLOCK for item in instructions)
+
+def test_next_batch_preserves_instructions():
+    instructions = [0, b'a' * 10, 1, 2, b'b' * (3 << 20), 3]
+    it = iter(instructions)
+    batches = []
+    while True:
+        batch = next_batch(it)
+        if not batch:
+            break
+        batches.append(batch)
+    flat = [item if isinstance(item, int) else item.data for batch in batches for item in batch]
+    assert flat == instructions
+    assert len(batches) == 2  # 新数据超过一个传输块时分批发送
+
+def test_sample_matches_estimates_reuse(tmp_path):
+    rng = random.Random(2)
+    base = bytes(rng.getrandbits(8) for _ in range(BLOCK * 64))
+    checksums = delta.unpack_checksums(delta.block_checksums(io.BytesIO(base), BLOCK))
+    path = tmp_path / 'new'
+
+    def sample(new):
+        path.write_bytes(new)
+        return delta.sample_matches(path, checksums, BLOCK, 16)
+    assert sample(base) == 1.0
+    assert sample(b'x' + base) == 1.0  # 插入之后的块错位了，滑动查找仍能找到
+    assert sample(os.urandom(len(base))) == 0.0
+    assert 0.25 <= sample(os.urandom(BLOCK * 32) + base[BLOCK * 32:]) <= 0.75
+    assert sample(b'x' * BLOCK) == 0.0  # 文件太小时不抽样
@@ -0,0 +1,56 @@
+import hashlib
+import os
+import storage
+from storage import FileStore
+
+CHUNK = 8
+
+
+def expected(content, size):  # (整体的sha256, 每块的sha256)
+    return [hashlib.sha256(content).hexdigest(),
+            [hashlib.sha256(content[i:i + size]).hexdigest() for i in range(0, len(content), size)]]
+
+def counting(monkeypatch):  # 记录读取文件内容计算哈希的次数
+    calls = []
+    hash_chunks = storage.hash_chunks
+    monkeypatch.setattr(storage, 'hash_chunks', lambda f, size: calls.append(size) or hash_chunks(f, size))
+    return calls
+
+def test_stat_chunks_hashes_each_file_once(tmp_path, monkeypatch):
+    calls = counting(monkeypatch)
+    root = tmp_path / 'files'
+    root.mkdir()
+    (root / 'a').write_bytes(b'0123456789abcdefXYZ')
+    store = FileStore(root, tmp_path / 'index.json', chunk_size=CHUNK)
+    assert store.index_names() == ['a']
+    size, _, filehash, chunks = store.stat_chunks('a')
+    assert size == 19 and [filehash, chunks] == expected(b'0123456789abcdefXYZ', CHUNK)
+    store.save_index()
+    assert len(calls) == 1
+    store = FileStore(root, tmp_path / 'index.json', chunk_size=CHUNK)  # 重新打开时从索引中读取
+    assert store.stat_chunks('a')[3] == chunks
+    assert len(calls) == 1
+
+def test_changed_files_and_chunk_size_are_rehashed(tmp_path, monkeypatch):
+    calls = counting(monkeypatch)
+    root = tmp_path / 'files'
+    root.mkdir()
+    (root / 'a').write_bytes(b'0123456789abcdef')
+    store = FileStore(root, tmp_path / 'index.json', chunk_size=CHUNK)
+    store.stat_chunks('a')
+    (root / 'a').write_bytes(b'changed')
+    os.utime(root / 'a', ns=(1, 1))
+    assert store.stat_chunks('a')[3] == expected(b'changed', CHUNK)[1]
+    store.save_index()
+    store = FileStore(root, tmp_path / 'index.json', chunk_size=4)
+    assert store.stat_chunks('a')[3] == expected(b'changed', 4)[1]
+    assert len(calls) == 3
+
+def test_index_without_chunks(tmp_path):
+    root = tmp_path / 'files'
+    root.mkdir()
+    (root / 'a').write_bytes(b'abc')
+    store = FileStore(root, tmp_path / 'index.json')
+    [[name, _, filehash]] = store.index(2)
+    assert name == 'a' and filehash == expected(b'abc', CHUNK)[0]
+    assert len(store.hashes['a']) == 5  # 服务器上不记录块的哈希值
@@ -0,0 +1,32 @@
+import pytest
+import database
+from database import GroupCommitter
+
+
+def test_group_commit_isolates_failed_jobs(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, 'db_path', str(tmp_path / 'test.db'))
+    committer = GroupCommitter(8)
+    committer.submit(lambda cursor: cursor.execute('create table t (x integer primary key);'))
+
+    def insert(x):
+        return lambda cursor: cursor.execute('insert into t values (?);', (x, )).rowcount
+
+    def fail(cursor):
+        cursor.execute('insert into t values (100);')
+        raise ValueError('bad request')
+
+    committed = []
+    futures = [committer.submit(insert(1), wait=False, on_commit=lambda: committed.append(1)),
+               committer.submit(fail, wait=False, on_commit=lambda: committed.append('fail')),
+               committer.submit(insert(1), wait=False),
+               committer.submit(insert(2), wait=False, on_commit=lambda: committed.append(2))]
+    assert futures[0].result() == 1
+    with pytest.raises(ValueError):
+        futures[1].result()
+    with pytest.raises(database.sqlite3.IntegrityError):
+        futures[2].result()
+    assert futures[3].result() == 1
+    assert committed == [1, 2]
+    # 失败的操作被回滚到保存点，写线程继续工作
+    rows = committer.submit(lambda cursor: cursor.execute('select x from t order by x;').fetchall())
+    assert rows == [(1, ), (2, )]
@@ -0,0 +1,34 @@
+from hashring import HashRing
+
+NAMES = ['file{}.txt'.format(i) for i in range(2000)]
+
+
+def test_lookup_returns_distinct_servers():
+    ring = HashRing([1, 2, 3, 4], 64)
+    for name in NAMES[:100]:
+        servers = ring.lookup(name, 3)
+        assert len(servers) == len(set(servers)) == 3
+    assert sorted(HashRing([1, 2], 64).lookup('a.txt', 3)) == [1, 2]  # 服务器不足R个时全部使用
+    assert HashRing([], 64).lookup('a.txt', 3) == []
+
+def test_placement_does_not_depend_on_server_order():
+    a = HashRing([1, 2, 3, 4], 64)
+    b = HashRing([4, 2, 3, 1], 64)
+    assert all(a.lookup(name, 3) == b.lookup(name, 3) for name in NAMES)
+
+def test_adding_server_moves_few_files():
+    old = HashRing([1, 2, 3, 4], 64)
+    new = HashRing([1, 2, 3, 4, 5], 64)
+    moved = 0
+    for name in NAMES:
+        before = old.lookup(name, 3)
+        after = new.lookup(name, 3)
+        # 新服务器只会插入到原来的顺序中，其余服务器的相对顺序不变
+        assert [serverid for serverid in after if serverid != 5] == before[:len(after) - (5 in after)]
+        moved += 5 in after
+    assert moved < len(NAMES) * 0.8
+
+def test_load_is_spread():
+    ring = HashRing([1, 2, 3, 4], 64)
+    primaries = [ring.lookup(name, 1)[0] for name in NAMES]
+    assert all(primaries.count(serverid) > len(NAMES) / 4 * 0.5 for serverid in [1, 2, 3, 4])
@@ -0,0 +1,48 @@
+import pytest
+
+
+@pytest.fixture
+def files(db):
+    rows = [['d{}/f{}.txt'.format(d, f), serverid, 10.0 + serverid, 'h{}'.format(serverid)]
+            for d in range(3) for f in range(4) for serverid in (1, 2)]
+    rows += [['d0/f0.txt', 3, 5.0, 'old']]  # 服务器3上是旧版本
+    assert db.add_file(rows) == []
+    return db
+
+def pages(list_page, **kwargs):  # 按游标取完所有页，返回所有行和页数
+    rows, count, cursor = [], 0, None
+    while True:
+        page = list_page(after=cursor, **kwargs)
+        rows += [list(row) for row in page['files']]
+        count += 1
+        cursor = page['cursor']
+        if cursor is None:
+            return rows, count
+
+
+def test_list_files_pages_cover_all_rows(files):
+    rows, count = pages(files.list_files, limit=5)
+    assert len(rows) == 25 and count == 6  # 最后一页恰好取满时，还要再取一个空页才知道结束
+    assert [row[:2] for row in rows] == sorted(row[:2] for row in rows)  # 按(文件名, 服务器id)顺序，不重不漏
+    assert len({tuple(row[:2]) for row in rows}) == 25
+
+def test_list_files_by_server_and_prefix(files):
+    rows, _ = pages(files.list_files, limit=3, serverid=2)
+    assert len(rows) == 12 and {row[1] for row in rows} == {2}
+    rows, _ = pages(files.list_files, limit=3, prefix='d1/')
+    assert len(rows) == 8 and all(row[0].startswith('d1/') for row in rows)
+    assert files.list_files(prefix='x/') == {'files': [], 'cursor': None}
+
+def test_list_files_limit_is_capped(files, monkeypatch):
+    monkeypatch.setattr(files, 'list_page_size', 4)
+    assert len(files.list_files(limit=1000)['files']) == 4
+    assert len(files.list_files(limit=0)['files']) == 1
+
+def test_list_latest(files):
+    rows, count = pages(files.list_latest, limit=5)
+    assert count == 3
+    assert [row[0] for row in rows] == ['d{}/f{}.txt'.format(d, f) for d in range(3) for f in range(4)]
+    latest = {row[0]: row[1:] for row in rows}
+    assert latest['d0/f0.txt'] == [12.0, 'h2', 1]  # 最新版本只在服务器2上
+    rows, _ = pages(files.list_latest, limit=2, prefix='d2/')
+    assert [row[0] for row in rows] == ['d2/f{}.txt'.format(f) for f in range(4)]
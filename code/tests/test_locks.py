@@ -0,0 +1,95 @@
+import threading
+import time
+from database import LockManager
+
+KEY = (1, 'a.txt')
+
+
+def queued(locks, count):  # 等到锁上有count个排队的请求
+    deadline = time.time() + 5
+    while time.time() < deadline:
+        with locks.mutex:
+            entry = locks.table.get(KEY)
+            if entry is not None and len(entry.waiters) >= count:
+                return
+        time.sleep(0.01)
+    raise AssertionError('request was not queued')
+
+def acquire_later(locks, mode, timeout, results):
+    thread = threading.Thread(target=lambda: results.append(locks.acquire(KEY, mode, timeout)))
+    thread.start()
+    return thread
+
+def test_shared_locks_are_compatible():
+    locks = LockManager(60)
+    assert locks.acquire(KEY, 'S', 1)
+    assert locks.acquire(KEY, 'S', 1)
+    assert locks.counts(KEY) == [2, 0]
+    assert locks.acquire(KEY, 'X', 0.1) == ''
+
+def test_exclusive_lock_blocks_everyone():
+    locks = LockManager(60)
+    lease = locks.acquire(KEY, 'X', 1)
+    assert locks.acquire(KEY, 'S', 0.1) == ''
+    assert locks.acquire(KEY, 'X', 0.1) == ''
+    assert locks.release(lease)
+    assert locks.acquire(KEY, 'S', 0.1)
+
+def test_waiters_are_granted_in_order():
+    locks = LockManager(60)
+    lease = locks.acquire(KEY, 'X', 1)
+    results = []
+    threads = []
+    for mode in ['X', 'S', 'S']:
+        threads.append(acquire_later(locks, mode, 5, results))
+        queued(locks, len(threads))
+    locks.release(lease)
+    threads[0].join()
+    assert locks.counts(KEY) == [0, 1]  # 只有队首的写者拿到锁，读者继续等待
+    locks.release(results[0])
+    for thread in threads[1:]:
+        thread.join()
+    assert locks.counts(KEY) == [2, 0]  # 写者释放后，排队的读者一起获得锁
+
+def test_readers_do_not_starve_queued_writer():
+    locks = LockManager(60)
+    reader = locks.acquire(KEY, 'S', 1)
+    results = []
+    writer = acquire_later(locks, 'X', 5, results)
+    queued(locks, 1)
+    assert locks.acquire(KEY, 'S', 0.1) == ''  # 后到的读者排在写者后面
+    locks.release(reader)
+    writer.join()
+    assert results[0] and locks.counts(KEY) == [0, 1]
+
+def test_readers_proceed_when_queued_writer_gives_up():
+    locks = LockManager(60)
+    locks.acquire(KEY, 'S', 1)
+    results = []
+    writer = acquire_later(locks, 'X', 0.3, results)
+    queued(locks, 1)
+    reader = acquire_later(locks, 'S', 5, results)
+    queued(locks, 2)
+    writer.join()
+    reader.join()
+    assert results[0] == '' and results[1]
+    assert locks.counts(KEY) == [2, 0]
+
+def test_expired_lease_is_reclaimed():
+    locks = LockManager(0.2)
+    lease = locks.acquire(KEY, 'X', 1)
+    start = time.time()
+    assert locks.acquire(KEY, 'X', 5)  # 持有者崩溃后，等待者在租约到期时获得锁
+    assert 0.1 < time.time() - start < 2
+    assert not locks.renew(lease)
+    assert not locks.release(lease)
+
+def test_renew_extends_lease():
+    locks = LockManager(0.3)
+    lease = locks.acquire(KEY, 'X', 1)
+    for _ in range(3):
+        time.sleep(0.15)
+        assert locks.renew(lease)
+    assert locks.acquire(KEY, 'X', 0.1) == ''
+    assert locks.release(lease)
+    assert KEY not in locks.table
@@ -0,0 +1,61 @@
+from merkle import MerkleTree, FANOUT, EMPTY
+
+DEPTH = 2
+
+
+def diff(a, b):  # 与反熵相同的逐层比较，返回内容不同的叶子
+    indices = [0]
+    for level in range(1, DEPTH + 1):
+        parents = [index for index, x, y in zip(indices, a.nodes(level - 1, indices), b.nodes(level - 1, indices))
+                   if x != y]
+        indices = [parent * FANOUT + i for parent in parents for i in range(FANOUT)]
+    return [index for index, x, y in zip(indices, a.nodes(DEPTH, indices), b.nodes(DEPTH, indices)) if x != y]
+
+def build(files):
+    tree = MerkleTree(DEPTH)
+    for name, filehash in files.items():
+        tree.put(name, filehash, 0)
+    return tree
+
+FILES = {'file{}.txt'.format(i): 'hash{}'.format(i) for i in range(200)}
+
+
+def test_same_files_same_root():
+    a = build(FILES)
+    b = build(dict(reversed(list(FILES.items()))))
+    assert a.nodes(0, [0]) == b.nodes(0, [0]) != [EMPTY]
+    assert diff(a, b) == []
+
+def test_lastmodified_does_not_change_hash():
+    a = build(FILES)
+    b = build(FILES)
+    b.put('file3.txt', 'hash3', 123)
+    assert diff(a, b) == []
+
+def test_diff_finds_changed_leaves():
+    a = build(FILES)
+    b = build(FILES)
+    b.put('file7.txt', 'other', 0)
+    b.remove('file9.txt')
+    b.put('new.txt', 'hash', 0)
+    leaves = diff(a, b)
+    assert sorted(leaves) == sorted({a.leaf('file7.txt'), a.leaf('file9.txt'), a.leaf('new.txt')})
+    names = {name for name, _, _ in b.entries(leaves)} | {name for name, _, _ in a.entries(leaves)}
+    assert {'file7.txt', 'file9.txt', 'new.txt'} <= names
+
+def test_incremental_refresh_matches_rebuild():
+    a = build(FILES)
+    a.nodes(0, [0])
+    a.put('file1.txt', 'changed', 0)
+    a.remove('file2.txt')
+    files = dict(FILES, **{'file1.txt': 'changed'})
+    del files['file2.txt']
+    assert a.nodes(0, [0]) == build(files).nodes(0, [0])
+
+def test_removing_everything_gives_empty_root():
+    a = build(FILES)
+    a.nodes(0, [0])
+    for name in FILES:
+        a.remove(name)
+    assert a.nodes(0, [0]) == [EMPTY]
+    assert a.nodes(0, [0]) == MerkleTree(DEPTH).nodes(0, [0])
@@ -0,0 +1,62 @@
+from database import ChangeLog
+from metadata import MetadataCache
+
+
+def snapshot(servers, files, version=1, cursor=None):
+    return {'epoch': 'e', 'version': version, 'reset': True, 'servers': servers, 'files': files, 'cursor': cursor}
+
+def changes(*changes, version=2):
+    return {'epoch': 'e', 'version': version, 'reset': False, 'changes': list(changes)}
+
+def cache():
+    metadata = MetadataCache()
+    metadata.apply(snapshot([[1, 'http://a'], [2, 'http://b'], [3, 'http://c']],
+                            [['x.txt', 1, 1.0, 'old'], ['x.txt', 2, 2.0, 'new']]))
+    metadata.add_files([['x.txt', 3, 2.0, 'new'], ['y.txt', 1, 1.0, 'y']])  # 快照的第二页
+    return metadata
+
+
+def test_changelog_since():
+    log = ChangeLog(3)
+    log.record('a', 'b')
+    assert log.since(log.epoch, 0) == (2, ['a', 'b'])
+    assert log.since(log.epoch, 2) == (2, [])
+    log.record('c', 'd')
+    assert log.since(log.epoch, 0) == (4, None)  # 日志已被截断，需要全量刷新
+    assert log.since(log.epoch, 1) == (4, ['b', 'c', 'd'])
+    assert log.since('other', 4) == (4, None)
+    assert log.since(log.epoch, 5) == (4, None)
+
+def test_snapshot_pages_are_indexed_by_filename():
+    metadata = cache()
+    assert metadata.latest_hash('x.txt') == 'new'
+    assert metadata.replicas('x.txt') == [(2, 'http://b'), (3, 'http://c')]
+    assert metadata.holders('x.txt') == [(1, 'http://a'), (2, 'http://b'), (3, 'http://c')]
+    assert metadata.file_hash(1, 'x.txt') == 'old'
+    assert metadata.latest_hash('missing.txt') is None
+    assert metadata.replicas('missing.txt') == []
+
+def test_incremental_changes():
+    metadata = cache()
+    metadata.apply(changes(['file', 1, 'x.txt', 3.0, 'newer'], ['file', 3, 'x.txt', None, None],
+                           ['file', 1, 'y.txt', None, None]))
+    assert metadata.replicas('x.txt') == [(1, 'http://a')]
+    assert metadata.holders('x.txt') == [(1, 'http://a'), (2, 'http://b')]
+    assert 'y.txt' not in metadata.files
+    assert metadata.version == 2
+
+def test_server_leaving_drops_its_files():
+    metadata = cache()
+    metadata.apply(changes(['server', 1, None]))
+    assert metadata.holders('x.txt') == [(2, 'http://b'), (3, 'http://c')]
+    assert 'y.txt' not in metadata.files and 1 not in metadata.by_server
+    metadata.apply(changes(['server', 1, 'http://a2'], ['file', 1, 'x.txt', 3.0, 'newer'], version=3))
+    assert metadata.replicas('x.txt') == [(1, 'http://a2')]
+
+def test_reset_replaces_files_but_keeps_ring_params():
+    metadata = cache()
+    metadata.ring_params = {'vnodes': 4, 'replication_factor': 2, 'write_quorum': 1}
+    metadata.apply(snapshot([[2, 'http://b']], [['z.txt', 2, 1.0, 'z']], version=9))
+    assert list(metadata.files) == ['z.txt'] and metadata.by_server == {2: {'z.txt'}}
+    assert metadata.ring_params is not None
+    assert metadata.placement('z.txt') == [(2, 'http://b')]
@@ -0,0 +1,76 @@
+from readcache import ReadCache
+from storage import FileStore
+
+
+def make(tmp_path, capacity=100, max_file=50, mmap_threshold=1000, codec=None):
+    root = tmp_path / 'files'
+    root.mkdir()
+    frame_root = None
+    if codec:
+        frame_root = tmp_path / 'frames'
+        frame_root.mkdir()
+    store = FileStore(root, tmp_path / 'index.json', codec=codec, frame_root=frame_root)
+    return store, ReadCache(store, capacity, max_file, mmap_threshold)
+
+def write(store, tmp_path, name, content, lastmodified):
+    part = tmp_path / 'part'
+    part.write_bytes(content)
+    store.commit(name, part, 'hash', lastmodified)
+
+
+def test_hit_after_miss(tmp_path):
+    store, cache = make(tmp_path)
+    write(store, tmp_path, 'a', b'hello', 10)
+    assert bytes(cache.get('a').data) == b'hello'
+    assert cache.get('a') is cache.get('a')
+    assert (cache.hits, cache.misses) == (2, 1)
+
+def test_replaced_file_is_reloaded(tmp_path):
+    store, cache = make(tmp_path)
+    write(store, tmp_path, 'a', b'hello', 10)
+    entry = cache.get('a')
+    cache.derive(entry, 'text', lambda data: bytes(data).decode())
+    write(store, tmp_path, 'a', b'world', 20)  # 大小相同，修改时间不同
+    entry = cache.get('a')
+    assert bytes(entry.data) == b'world' and entry.derived == {}  # 派生结果与内容一起失效
+    assert cache.size == 5 and cache.misses == 2
+
+def test_invalidate(tmp_path):
+    store, cache = make(tmp_path)
+    write(store, tmp_path, 'a', b'hello', 10)
+    cache.get('a')
+    cache.invalidate('a')
+    assert cache.entries == {} and cache.size == 0
+    cache.get('a')
+    assert cache.misses == 2
+
+def test_lru_eviction_counts_derived_results(tmp_path):
+    store, cache = make(tmp_path, capacity=100)
+    for name in 'abc':
+        write(store, tmp_path, name, name.encode() * 30, 10)
+        cache.get(name)
+    assert list(cache.entries) == ['a', 'b', 'c'] and cache.size == 90
+    cache.get('a')  # a变为最近使用
+    cache.derive(cache.get('c'), 'copy', lambda data: bytes(data))  # 派生结果也计入容量，超出后淘汰最久未用的b
+    assert list(cache.entries) == ['a', 'c'] and cache.size == 90 and cache.evictions == 1
+
+def test_large_files_bypass_cache(tmp_path):
+    store, cache = make(tmp_path, max_file=10)
+    write(store, tmp_path, 'big', b'x' * 20, 10)
+    assert cache.get('big') is None and cache.entries == {}
+    write(store, tmp_path, 'big', b'x' * 5, 20)  # 变小之后重新判断
+    assert bytes(cache.get('big').data) == b'x' * 5
+
+def test_large_raw_files_are_mapped(tmp_path):
+    store, cache = make(tmp_path, mmap_threshold=10)
+    write(store, tmp_path, 'small', b'xyz', 10)
+    write(store, tmp_path, 'raw', b'xyz' * 10, 10)
+    assert not cache.get('small').mapped
+    entry = cache.get('raw')
+    assert entry.mapped and bytes(entry.data) == b'xyz' * 10
+
+def test_compressed_files_are_read_not_mapped(tmp_path):
+    store, cache = make(tmp_path, mmap_threshold=10, codec='zlib')
+    write(store, tmp_path, 'packed', b'abc' * 10, 10)
+    entry = cache.get('packed')
+    assert not entry.mapped and bytes(entry.data) == b'abc' * 10  # 压缩保存的文件读出原始内容
@@ -0,0 +1,27 @@
+def test_versions_older_than_a_delete_are_rejected(db):
+    assert db.add_file([['a.txt', 1, 10.0, 'h1'], ['b.txt', 1, 10.0, 'h2']]) == []
+    assert db.add_tombstone('a.txt', 20.0)
+    db.delete_file(1, 'a.txt')
+    # 时钟落后的客户端上传的旧版本，以及错过删除的服务器重新登记的旧版本，都不会被登记
+    assert db.add_file([['a.txt', 2, 15.0, 'h1'], ['b.txt', 2, 15.0, 'h3']]) == ['a.txt']
+    assert db.get_one_file_hash(2, 'a.txt') is None
+    assert db.get_one_file_hash(2, 'b.txt') == ('h3', )
+    assert db.add_file([['a.txt', 2, 20.0, 'h1']]) == ['a.txt']  # 时间相同时删除胜出
+
+def test_newer_write_clears_tombstone(db):
+    db.add_tombstone('a.txt', 20.0)
+    assert db.add_file([['a.txt', 1, 30.0, 'new']]) == []
+    assert db.add_file([['a.txt', 2, 15.0, 'old']]) == []  # 删除标记已被新版本清除
+    assert db.get_one_file_hash(1, 'a.txt') == ('new', )
+
+def test_tombstone_keeps_latest_delete(db):
+    db.add_tombstone('a.txt', 20.0)
+    db.add_tombstone('a.txt', 10.0)  # 迟到的较早删除不会让删除时间倒退
+    assert db.add_file([['a.txt', 1, 15.0, 'h']]) == ['a.txt']
+
+def test_rejected_rows_are_not_in_changelog(db):
+    version = db.changelog.version
+    db.add_tombstone('a.txt', 20.0)
+    db.add_file([['a.txt', 1, 15.0, 'h'], ['b.txt', 1, 15.0, 'h']])
+    _, changes = db.changelog.since(db.changelog.epoch, version)
+    assert changes == [['file', 1, 'b.txt', 15.0, 'h']]
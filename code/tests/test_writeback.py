@@ -0,0 +1,108 @@
+import asyncio
+import aioclient
+from aioclient import AsyncClient
+
+
+class FakeUploads(object):  # 代替上传到副本：记录上传时的文件内容，可以让上传失败或暂停
+    def __init__(self, client):
+        self.client = client
+        self.uploads = []
+        self.active = set()
+        self.overlapped = False
+        self.fail = set()  # 下一次上传失败的文件
+        self.gate = None  # 设置后上传等待它
+        client.upload = self.upload
+
+    async def upload(self, name):
+        if name in self.active:
+            self.overlapped = True
+        self.active.add(name)
+        try:
+            if self.gate is not None:
+                await self.gate.wait()
+            self.uploads.append((name, (self.client.root_dir / name).read_text()))
+            if name in self.fail:
+                self.fail.discard(name)
+                return [(False, 'Server: down')], False
+            return [(True, 'ok')], True
+        finally:
+            self.active.discard(name)
+
+def run(tmp_path, main):
+    async def wrapper():
+        async with AsyncClient(tmp_path / 'cache', write_back=True) as client:
+            await main(client, FakeUploads(client))
+    asyncio.run(wrapper())
+
+
+def test_writes_within_delay_coalesce(tmp_path, monkeypatch):
+    monkeypatch.setattr(aioclient, 'write_back_delay', 0.1)
+
+    async def main(client, fake):
+        for i in range(5):
+            assert await client.write('a.txt', 'v{}'.format(i)) == ([], True)
+        await client.write('b.txt', 'b')
+        assert fake.uploads == [] and client.dirty_bytes == 3
+        await asyncio.sleep(0.3)
+        assert sorted(fake.uploads) == [('a.txt', 'v4'), ('b.txt', 'b')]  # 每个文件只上传最后一个版本
+        assert client.dirty == {} and client.dirty_bytes == 0
+    run(tmp_path, main)
+
+def test_write_during_upload_is_uploaded_again(tmp_path, monkeypatch):
+    monkeypatch.setattr(aioclient, 'write_back_delay', 10)
+
+    async def main(client, fake):
+        fake.gate = asyncio.Event()
+        await client.write('a.txt', 'first')
+        flushing = asyncio.ensure_future(client.flush())
+        await asyncio.sleep(0.05)
+        assert 'a.txt' in client.flushing
+        await client.write('a.txt', 'second')  # 上传过程中又被修改，留到下一轮
+        fake.gate.set()
+        results = await flushing
+        assert results['a.txt'][1]
+        assert [content for _, content in fake.uploads] == ['second', 'second']
+        assert not fake.overlapped  # 同一文件不会同时有两个上传
+        assert client.dirty == {} and client.flushing == {}
+    run(tmp_path, main)
+
+def test_failed_upload_is_requeued(tmp_path, monkeypatch):
+    monkeypatch.setattr(aioclient, 'write_back_delay', 10)
+
+    async def main(client, fake):
+        await client.write('a.txt', 'data')
+        fake.fail.add('a.txt')
+        results = await client.flush()
+        assert results['a.txt'] == ([(False, 'Server: down')], False)
+        assert client.dirty == {'a.txt': 4} and client.dirty_bytes == 4  # 没有达到写quorum，重新排队
+        results = await client.flush()
+        assert results['a.txt'][1] and client.dirty == {} and client.dirty_bytes == 0
+    run(tmp_path, main)
+
+def test_dirty_limit_blocks_writer(tmp_path, monkeypatch):
+    monkeypatch.setattr(aioclient, 'write_back_delay', 10)
+    monkeypatch.setattr(aioclient, 'write_back_dirty_limit', 8)
+
+    async def main(client, fake):
+        await client.write('a.txt', 'x' * 6)
+        assert fake.uploads == []
+        await asyncio.wait_for(client.write('b.txt', 'y' * 6), 2)  # 超过上限时立即上传，等到腾出空间才返回
+        assert fake.uploads and client.dirty_bytes <= 8
+    run(tmp_path, main)
+
+def test_delete_drops_pending_upload(tmp_path, monkeypatch):
+    monkeypatch.setattr(aioclient, 'write_back_delay', 10)
+
+    async def main(client, fake):
+        async def no_replicas(*args):  # 没有副本，只检查本地的写回状态
+            return []
+        async def multicall(*calls):
+            return [True, None]
+        client.multicall = multicall
+        client.apply_changes = client.placement = no_replicas
+        client.metadata.holders = lambda name: []
+        await client.write('a.txt', 'data')
+        await client.delete('a.txt')
+        assert client.dirty == {} and client.dirty_bytes == 0
+        assert await client.flush() == {} and fake.uploads == []
+    run(tmp_path, main)
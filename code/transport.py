@@ -0,0 +1,87 @@
+import http.client
+import threading
+import time
+from xmlrpc.client import ServerProxy, Transport
+from xmlrpc.server import SimpleXMLRPCRequestHandler
+from binrpc import BinaryServerProxy, xmlrpc_url
+from config import pool_max_per_host, pool_idle_timeout, keepalive_timeout, rpc_protocol
+
+
+class KeepAliveRequestHandler(SimpleXMLRPCRequestHandler):  # 服务器端使用HTTP/1.1长连接，空闲超时后关闭连接和线程
+    protocol_version = 'HTTP/1.1'
+    timeout = keepalive_timeout
+
+
+class HTTPConnectionPool(object):  # 按服务器地址缓存空闲的长连接，进程内所有ServerProxy共享
+    def __init__(self, max_per_host, idle_timeout):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.mutex = threading.Lock()
+        self.idle = {}  # host -> [[connection, 放回的时间], ...]，越靠后越新
+        self.limits = {}  # host -> 信号量，限制同时发往一个服务器的请求数
+
+    def evict(self, idle, now):  # 关闭空闲太久的连接（服务器可能已经关闭了它），调用者需持有mutex
+        while idle and now - idle[0][1] >= self.idle_timeout:
+            idle.pop(0)[0].close()
+
+    def acquire(self, host):  # 借出一个空闲连接，没有时返回None，由调用者新建
+        with self.mutex:
+            limit = self.limits.get(host)
+            if limit is None:
+                limit = self.limits[host] = threading.BoundedSemaphore(self.max_per_host)
+        limit.acquire()  # 达到上限时等待其他请求归还连接
+        with self.mutex:
+            idle = self.idle.get(host, [])
+            self.evict(idle, time.time())
+            return idle.pop()[0] if idle else None
+
+    def release(self, host, connection, reuse):  # 归还连接，请求出错时连接状态未知，直接关闭
+        with self.mutex:
+            if connection is not None:
+                if reuse:
+                    idle = self.idle.setdefault(host, [])
+                    idle.append([connection, time.time()])
+                    self.evict(idle, time.time())
+                else:
+                    connection.close()
+        self.limits[host].release()
+
+
+class PooledTransport(Transport):  # 每次请求从连接池借用长连接的传输层，可以设置超时
+    # 连接只在一次请求期间被占用，ServerProxy关闭后连接仍留在池中供后续请求复用
+    def __init__(self, timeout=None, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.timeout = timeout
+
+    def make_connection(self, host):  # 连接失效后重试时由基类调用
+        connection = super().make_connection(host)
+        connection.timeout = self.timeout
+        return connection
+
+    def request(self, host, handler, request_body, verbose=False):
+        chost, self._extra_headers, _ = self.get_host_info(host)
+        connection = connections.acquire(chost)
+        if connection is None:
+            connection = http.client.HTTPConnection(chost)
+        connection.timeout = self.timeout
+        if connection.sock is not None:
+            connection.sock.settimeout(self.timeout)
+        self._connection = (host, connection)
+        ok = False
+        try:
+            # 基类在连接被服务器关闭时会重连并重试一次
+            res = super().request(host, handler, request_body, verbose)
+            ok = True
+            return res
+        finally:
+            connection = self._connection[1]
+            self._connection = (None, None)
+            connections.release(chost, connection, ok)
+
+
+def connect(url, timeout=None):  # 创建使用连接池的ServerProxy，或者按配置使用二进制协议的代理
+    if rpc_protocol == 'binary':
+        return BinaryServerProxy(url, timeout)
+    return ServerProxy(xmlrpc_url(url), allow_none=True, transport=PooledTransport(timeout))
+
+connections = HTTPConnectionPool(pool_max_per_host, pool_idle_timeout)